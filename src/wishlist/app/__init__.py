@@ -1,6 +1,7 @@
 from flask import Flask, jsonify
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.util import LRUCache
 
 from app.config import Config
 
@@ -9,16 +10,41 @@ from app.config import Config
 db = SQLAlchemy()
 bcrypt = Bcrypt()
 
+# Signs bearer and profiling tokens when no SECRET_KEY is set. Public, so only ever used in
+# development.
+_DEV_SECRET_KEY = "dev-secret-key"
+_DEV_ENVS = ("dev", "development")
 
-def create_app() -> Flask:
+
+def create_app(config: dict = None) -> Flask:
     """Using the `factory` pattern, return an initialized instance of the Flask app that will persist
     for a single request/response lifecycle.
 
+    Args:
+        config (dict, optional): settings that override `Config`. Defaults to None.
+
+    Raises:
+        RuntimeError: No SECRET_KEY is set outside of development.
+
     Returns:
         Flask: instance of the Flask app with registered Blueprints and initialized Database.
     """
     app = Flask(__name__)
     app.config.from_object(Config)
+    app.config.update(config or {})
+
+    # Anyone could sign tokens for any user with a default key, so never fall back to one in production.
+    if not app.config["SECRET_KEY"]:
+        if app.config["ENV"] not in _DEV_ENVS:
+            raise RuntimeError("SECRET_KEY must be set outside of development.")
+        app.config["SECRET_KEY"] = _DEV_SECRET_KEY
+
+    # Keep compiled SQL for statements that are executed repeatedly, keyed by the statement object, so
+    # that the module-level statements in `app.models` are only compiled once.
+    engine_options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+    engine_options.setdefault("execution_options", {})["compiled_cache"] = LRUCache(
+        app.config["SQLALCHEMY_COMPILED_CACHE_SIZE"]
+    )
     
     from app.routes import bp
     app.register_blueprint(bp)
@@ -28,4 +54,20 @@ def create_app() -> Flask:
     db.init_app(app)
     bcrypt.init_app(app)
 
+    # Registered first so that a profiled request covers every other hook.
+    from app.profiling import request_profiler
+    request_profiler.init_app(app)
+
+    from app.admission import admission
+    admission.init_app(app)
+
+    from app.compression import compressor
+    compressor.init_app(app)
+
+    from app.query_budget import query_monitor
+    query_monitor.init_app(app)
+
+    from app.deadlines import deadlines
+    deadlines.init_app(app)
+
     return app
@@ -0,0 +1,147 @@
+from logging import getLogger
+from threading import Lock
+from time import perf_counter
+
+from flask import Flask, current_app, g, jsonify, request
+from sqlalchemy.pool import QueuePool
+
+from app import db
+
+"""
+Admission control for the API.
+
+When the database slows down, requests pile up waiting on a connection from the pool and every
+request's latency grows until the instance falls over. Rather than queueing indefinitely, we track
+how many requests are in flight (with separate budgets for reads and writes) and how long requests
+have recently waited on the connection pool. Once either passes its configured limit we reject the
+excess early with a 503 and a `Retry-After` header, which keeps latency bounded for the requests we
+do admit.
+
+All state is per process, so limits should be sized for the number of threads in a single worker.
+"""
+
+_LOGGER = getLogger(__name__)
+
+READ = "read"
+WRITE = "write"
+_READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class AdmissionController(object):
+    # Endpoints that must always be served, even while shedding load.
+    exempt_endpoints = {"api.healthcheck"}
+
+    # Smoothing factor for the moving average of connection pool wait times.
+    pool_wait_alpha = 0.2
+
+    def __init__(self):
+        self._lock = Lock()
+        self.in_flight = {READ: 0, WRITE: 0}
+        self.pool_wait_ms = 0.0
+
+    def init_app(self, app: Flask):
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        # Must be set before the engine is first created. Flask-SQLAlchemy picks its own pool for
+        # SQLite, whose connections are never waited on.
+        app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {}).setdefault("poolclass", TimedQueuePool)
+
+    def saturation(self) -> dict:
+        """Report the current load on this instance against the configured limits.
+
+        Returns:
+            dict: in-flight counts, recent pool wait and whether any limit has been reached.
+        """
+        config = current_app.config
+        limits = {
+            READ: config["ADMISSION_MAX_IN_FLIGHT_READS"],
+            WRITE: config["ADMISSION_MAX_IN_FLIGHT_WRITES"],
+        }
+        with self._lock:
+            in_flight = dict(self.in_flight)
+            pool_wait_ms = self.pool_wait_ms
+
+        return {
+            "saturated": (
+                any(in_flight[kind] >= limits[kind] for kind in limits)
+                or pool_wait_ms > config["ADMISSION_MAX_POOL_WAIT_MS"]
+            ),
+            "in_flight": in_flight,
+            "limits": limits,
+            "pool_wait_ms": round(pool_wait_ms, 3),
+        }
+
+    def _try_admit(self, kind: str) -> bool:
+        config = current_app.config
+        limit = config[
+            "ADMISSION_MAX_IN_FLIGHT_READS" if kind == READ else "ADMISSION_MAX_IN_FLIGHT_WRITES"
+        ]
+        with self._lock:
+            in_flight = self.in_flight[kind]
+            if in_flight >= limit:
+                return False
+            # While the pool is slow, only let a single probe request of each kind through. Its
+            # pool wait is what tells us when the database has recovered.
+            if self.pool_wait_ms > config["ADMISSION_MAX_POOL_WAIT_MS"] and in_flight > 0:
+                return False
+            self.in_flight[kind] = in_flight + 1
+        return True
+
+    def _record_pool_wait(self, wait_ms: float):
+        with self._lock:
+            self.pool_wait_ms += self.pool_wait_alpha * (wait_ms - self.pool_wait_ms)
+
+    def probe_pool_wait(self):
+        """Check out a connection, measuring the pool, if recent pool waits are over the limit.
+
+        The pool is only measured when a request checks out a connection, and an instance reported
+        as saturated may not be sent any. The health check probes the pool itself so that the
+        instance can see the database recover and return to rotation.
+        """
+        config = current_app.config
+        if not config["ADMISSION_CONTROL_ENABLED"]:
+            return
+        with self._lock:
+            if self.pool_wait_ms <= config["ADMISSION_MAX_POOL_WAIT_MS"]:
+                return
+        # A connection of its own, returned straight away, rather than one held by the session.
+        db.engine.connect().close()
+
+    def _before_request(self):
+        if not current_app.config["ADMISSION_CONTROL_ENABLED"]:
+            return
+        if request.endpoint in self.exempt_endpoints:
+            return
+
+        kind = READ if request.method in _READ_METHODS else WRITE
+        if not self._try_admit(kind):
+            _LOGGER.warning(f"admission: shedding {kind} request to {request.path}")
+            res = jsonify("service overloaded, retry later")
+            res.status_code = 503
+            res.headers["Retry-After"] = str(current_app.config["ADMISSION_RETRY_AFTER_SECONDS"])
+            return res
+        g.admission_kind = kind
+
+    def _teardown_request(self, exc):
+        kind = g.pop("admission_kind", None)
+        if kind is None:
+            return
+        with self._lock:
+            self.in_flight[kind] -= 1
+
+
+admission = AdmissionController()
+
+
+class TimedQueuePool(QueuePool):
+    """Connection pool that reports how long every checkout waited on it to `admission`. Requests
+    that never touch the database never check out a connection, so they are neither delayed by a
+    slow pool nor hold a connection they don't need.
+    """
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            admission._record_pool_wait((perf_counter() - start) * 1000)
@@ -0,0 +1,127 @@
+import base64
+import hashlib
+import hmac
+import json
+from functools import wraps
+from threading import Lock
+from time import time
+
+from flask import current_app, g, request
+
+"""
+Token authentication for the API.
+
+Checking a password with bcrypt is deliberately slow, so it only happens once, at POST `/login`,
+which hands back a signed, expiring token. Every other request presents that token as
+`Authorization: Bearer <token>` and is authenticated with a single HMAC check. Verified claims are
+kept in an in-process cache keyed by the token, so repeat requests with the same token only pay for
+a dictionary lookup and an expiry comparison.
+
+Token format: `<base64url(json claims)>.<base64url(hmac_sha256(SECRET_KEY, encoded claims))>`
+"""
+
+
+class InvalidToken(Exception):
+    pass
+
+
+_claims_cache = {}
+_claims_cache_lock = Lock()
+
+
+def _b64encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(payload: bytes) -> bytes:
+    key = current_app.config["SECRET_KEY"].encode()
+    return _b64encode(hmac.new(key, payload, hashlib.sha256).digest())
+
+
+def issue_token(user_id: str) -> str:
+    """Issue a signed token for a user that expires after `AUTH_TOKEN_TTL_SECONDS`.
+
+    Args:
+        user_id (str): uuid of the authenticated user.
+
+    Returns:
+        str: token
+    """
+    claims = {
+        "sub": str(user_id),
+        "exp": int(time() + current_app.config["AUTH_TOKEN_TTL_SECONDS"]),
+    }
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    return (payload + b"." + _sign(payload)).decode()
+
+
+def verify_token(token: str) -> dict:
+    """Verify a token's signature and expiry.
+
+    Args:
+        token (str): token issued by `issue_token`
+
+    Raises:
+        InvalidToken: The token is malformed, has been tampered with or has expired.
+
+    Returns:
+        dict: the token's claims.
+    """
+    claims = _claims_cache.get(token)
+    if claims is None:
+        claims = _verify_signature(token)
+        with _claims_cache_lock:
+            if len(_claims_cache) >= current_app.config["AUTH_TOKEN_CACHE_SIZE"]:
+                # Evict the oldest entry, dicts keep insertion order.
+                del _claims_cache[next(iter(_claims_cache))]
+            _claims_cache[token] = claims
+
+    if claims["exp"] <= time():
+        raise InvalidToken("token has expired")
+    return claims
+
+
+def _verify_signature(token: str) -> dict:
+    payload, _, signature = token.partition(".")
+    if not payload or not signature:
+        raise InvalidToken("malformed token")
+    if not hmac.compare_digest(_sign(payload.encode()), signature.encode()):
+        raise InvalidToken("invalid token signature")
+    # The signature matched, so the claims are ones we issued.
+    return json.loads(_b64decode(payload))
+
+
+def authenticate(authorization: str) -> dict:
+    """Authenticate the value of a request's `Authorization` header.
+
+    Args:
+        authorization (str): header value, expected to be `Bearer <token>`
+
+    Raises:
+        InvalidToken: The header is missing or does not carry a valid token.
+
+    Returns:
+        dict: the token's claims.
+    """
+    if not authorization or not authorization.startswith("Bearer "):
+        raise InvalidToken("missing bearer token")
+    return verify_token(authorization[7:])
+
+
+def token_required(view):
+    """Decorate a view so that it requires a valid bearer token. The authenticated user's id is
+    available to the view as `g.user_id`.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            claims = authenticate(request.headers.get("Authorization"))
+        except InvalidToken as e:
+            return str(e), 401, {"WWW-Authenticate": 'Bearer realm="wishlist"'}
+        g.user_id = claims["sub"]
+        return view(*args, **kwargs)
+    return wrapper
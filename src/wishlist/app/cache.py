@@ -0,0 +1,180 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Callable, Optional
+from uuid import UUID
+
+from flask import current_app
+
+from app.compression import compress
+
+"""
+In-process caches of rendered GET `/wishlist/<wishlist_id>` responses and of book popularity rankings.
+
+Each wishlist entry holds the serialized JSON body along with any compressed variants of it that have been
+requested, so the CPU cost of compressing a wishlist is paid once per version of that wishlist rather
+than once per request. Writes to a wishlist invalidate its entry in this process; other processes
+will keep serving their copy for up to `WISHLIST_CACHE_TTL_SECONDS`. A TTL of 0 disables the cache.
+"""
+
+
+def _cache_key(wishlist_id) -> str:
+    # Normalize so that e.g. upper-case and hyphen-less spellings of an id share an entry.
+    return str(UUID(str(wishlist_id)))
+
+
+class CachedResponse(object):
+    def __init__(self, body: bytes, owner_id: str = None):
+        self.body = body
+        # User the wishlist was loaded for, only they are served this entry.
+        self.owner_id = owner_id
+        self.created = monotonic()
+        self._encoded = {}
+
+    def encoded(self, encoding: str) -> bytes:
+        """Return the body compressed with the given encoding, compressing it at most once.
+
+        Args:
+            encoding (str): content encoding
+
+        Returns:
+            bytes: compressed body
+        """
+        body = self._encoded.get(encoding)
+        if body is None:
+            body = self._encoded[encoding] = compress(self.body, encoding)
+        return body
+
+
+class WishlistCache(object):
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        # Bumped on every invalidation. A response rendered from a query that started before an
+        # invalidation may be stale, so it is not stored.
+        self._generation = 0
+
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, wishlist_id, owner_id: str = None) -> Optional[CachedResponse]:
+        """Get the cached response for a wishlist.
+
+        Args:
+            wishlist_id: uuid of a wishlist
+            owner_id (str, optional): user the response is for. Defaults to None.
+
+        Returns:
+            None: Nothing cached for the user or the entry has expired.
+            CachedResponse: The cached response.
+        """
+        ttl = current_app.config["WISHLIST_CACHE_TTL_SECONDS"]
+        if ttl <= 0:
+            return None
+
+        key = _cache_key(wishlist_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if monotonic() - entry.created > ttl:
+                del self._entries[key]
+                return None
+            if entry.owner_id != owner_id:
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, wishlist_id, body: bytes, generation: int, owner_id: str = None) -> CachedResponse:
+        """Cache a rendered wishlist body.
+
+        Args:
+            wishlist_id: uuid of a wishlist
+            body (bytes): serialized response body
+            generation (int): value of `generation()` taken before the wishlist was queried
+            owner_id (str, optional): user the wishlist was loaded for. Defaults to None.
+
+        Returns:
+            CachedResponse: entry for the body, returned even if it was not stored.
+        """
+        entry = CachedResponse(body, owner_id)
+        config = current_app.config
+        if config["WISHLIST_CACHE_TTL_SECONDS"] <= 0:
+            return entry
+
+        key = _cache_key(wishlist_id)
+        with self._lock:
+            if generation != self._generation:
+                return entry
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > config["WISHLIST_CACHE_MAX_ENTRIES"]:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, wishlist_id):
+        """Drop the cached response for a wishlist after it has been written to.
+
+        Args:
+            wishlist_id: uuid of a wishlist
+        """
+        key = _cache_key(wishlist_id)
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+wishlist_cache = WishlistCache()
+
+
+class PopularBooksCache(object):
+    """Keep the top books of each ranking window in memory, refreshed every
+    `POPULAR_BOOKS_CACHE_TTL_SECONDS`. While one thread refreshes an expired ranking, others keep
+    serving the previous one rather than piling onto the database.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = {}
+        self._refreshing = set()
+
+    def get(self, window: str, load: Callable[[], list]) -> list:
+        """Get the cached ranking for a window, loading it if it is missing or expired.
+
+        Args:
+            window (str): name of the ranking window
+            load (Callable[[], list]): loads the ranking from the database
+
+        Returns:
+            list: ranked books, most popular first.
+        """
+        ttl = current_app.config["POPULAR_BOOKS_CACHE_TTL_SECONDS"]
+        with self._lock:
+            entry = self._entries.get(window)
+            if entry is not None:
+                created, books = entry
+                if monotonic() - created <= ttl or window in self._refreshing:
+                    return books
+            self._refreshing.add(window)
+
+        try:
+            books = load()
+            with self._lock:
+                self._entries[window] = (monotonic(), books)
+            return books
+        finally:
+            with self._lock:
+                self._refreshing.discard(window)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+popular_books_cache = PopularBooksCache()
+
@@ -0,0 +1,110 @@
+import gzip
+from typing import Optional
+
+from flask import Flask, Response, current_app, request
+
+# Brotli is optional, without it we only offer gzip.
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+"""
+Response compression negotiated from the request's `Accept-Encoding` header.
+
+Wishlist responses repeat the same handful of book keys for every entry, so they compress very well.
+Bodies under `COMPRESSION_MIN_SIZE` bytes are sent as-is since the framing overhead outweighs the
+savings.
+"""
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def supported_encodings() -> tuple:
+    """Encodings we can produce, in order of preference."""
+    if brotli is not None:
+        return ("br", "gzip")
+    return ("gzip",)
+
+
+def negotiate_encoding(body_size: int) -> Optional[str]:
+    """Choose a content encoding for a response body of the given size for the current request.
+
+    Args:
+        body_size (int): length of the uncompressed body in bytes.
+
+    Returns:
+        None: The body should be sent uncompressed.
+        str: Name of the content encoding to apply.
+    """
+    config = current_app.config
+    if not config["COMPRESSION_ENABLED"] or body_size < config["COMPRESSION_MIN_SIZE"]:
+        return None
+
+    accepted = request.accept_encodings
+    best, best_quality = None, 0
+    for encoding in supported_encodings():
+        quality = accepted.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compress data with the given content encoding.
+
+    Args:
+        data (bytes): uncompressed body
+        encoding (str): one of `supported_encodings()`
+
+    Returns:
+        bytes: compressed body
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    if encoding == "gzip":
+        # Fixing mtime keeps the output deterministic for identical bodies.
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    raise ValueError(f"unsupported content encoding {encoding}")
+
+
+def set_encoded_body(response: Response, body: bytes, encoding: Optional[str]):
+    """Set an already compressed body on a response along with the matching headers.
+
+    Args:
+        response (Response): response to update
+        body (bytes): body, compressed with `encoding` unless it is None
+        encoding (str, optional): content encoding applied to `body`
+    """
+    response.set_data(body)
+    response.vary.add("Accept-Encoding")
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+
+
+class ResponseCompressor(object):
+    """Compress any response that a view has not already encoded itself."""
+
+    def init_app(self, app: Flask):
+        app.after_request(self._after_request)
+
+    def _after_request(self, response: Response) -> Response:
+        if (
+            response.direct_passthrough
+            or response.is_streamed
+            or not 200 <= response.status_code < 300
+            or "Content-Encoding" in response.headers
+        ):
+            return response
+
+        body = response.get_data()
+        encoding = negotiate_encoding(len(body))
+        if encoding is not None:
+            set_encoded_body(response, compress(body, encoding), encoding)
+        elif current_app.config["COMPRESSION_ENABLED"]:
+            response.vary.add("Accept-Encoding")
+        return response
+
+
+compressor = ResponseCompressor()
@@ -4,4 +4,63 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URL", "sqlite://")
     # Context for disabling Flask-SQLAlchemy's event system:
     # https://stackoverflow.com/questions/33738467/how-do-i-know-if-i-can-disable-sqlalchemy-track-modifications/33790196#33790196
-    SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Admission control, see `app/admission.py`. Limits apply per process.
+    ADMISSION_CONTROL_ENABLED = os.getenv("ADMISSION_CONTROL_ENABLED", "true").lower() == "true"
+    ADMISSION_MAX_IN_FLIGHT_READS = int(os.getenv("ADMISSION_MAX_IN_FLIGHT_READS", "64"))
+    ADMISSION_MAX_IN_FLIGHT_WRITES = int(os.getenv("ADMISSION_MAX_IN_FLIGHT_WRITES", "16"))
+    ADMISSION_MAX_POOL_WAIT_MS = float(os.getenv("ADMISSION_MAX_POOL_WAIT_MS", "250"))
+    ADMISSION_RETRY_AFTER_SECONDS = int(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", "1"))
+
+    # Response compression, see `app/compression.py`.
+    COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+    COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+
+    # In-process cache of GET `/wishlist/<wishlist_id>` responses, see `app/cache.py`. 0 disables it.
+    WISHLIST_CACHE_TTL_SECONDS = float(os.getenv("WISHLIST_CACHE_TTL_SECONDS", "0"))
+    WISHLIST_CACHE_MAX_ENTRIES = int(os.getenv("WISHLIST_CACHE_MAX_ENTRIES", "1024"))
+
+    # Wishlist change feed, see `wishlist_changes` in `app/models/__init__.py`.
+    CHANGE_FEED_MAX_PAGE_SIZE = int(os.getenv("CHANGE_FEED_MAX_PAGE_SIZE", "1000"))
+    CHANGE_LOG_RETENTION_HOURS = float(os.getenv("CHANGE_LOG_RETENTION_HOURS", "168"))
+
+    # Streaming exports, see `iter_wishlist_export` in `app/models/__init__.py`.
+    EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "1000"))
+    EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "50000"))
+
+    # Token authentication, see `app/auth.py`. The app refuses to start without a SECRET_KEY outside of
+    # development, where a fixed key is used instead.
+    SECRET_KEY = os.getenv("SECRET_KEY")
+    AUTH_TOKEN_TTL_SECONDS = int(os.getenv("AUTH_TOKEN_TTL_SECONDS", "3600"))
+    AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000"))
+
+    # Store a pre-rendered document per wishlist, see `wishlist_documents` in `app/models/__init__.py`.
+    # Run `python manage.py rebuild_documents` after enabling it on an existing database.
+    WISHLIST_MATERIALIZE = os.getenv("WISHLIST_MATERIALIZE", "false").lower() == "true"
+
+    # GET `/books/popular`, rankings are served from memory and refreshed every TTL seconds.
+    POPULAR_BOOKS_CACHE_TTL_SECONDS = float(os.getenv("POPULAR_BOOKS_CACHE_TTL_SECONDS", "60"))
+    POPULAR_BOOKS_MAX_LIMIT = int(os.getenv("POPULAR_BOOKS_MAX_LIMIT", "100"))
+
+    # Compiled statement cache and server-side prepared statements, see `app/models/prepared.py`.
+    # Prepared statements must be disabled behind PgBouncer in transaction pooling mode.
+    SQLALCHEMY_COMPILED_CACHE_SIZE = int(os.getenv("SQLALCHEMY_COMPILED_CACHE_SIZE", "500"))
+    SQLALCHEMY_PREPARED_STATEMENTS = os.getenv("SQLALCHEMY_PREPARED_STATEMENTS", "true").lower() == "true"
+
+    # Per-request statement counting for development, see `app/query_budget.py`.
+    QUERY_BUDGET_ENABLED = os.getenv("QUERY_BUDGET_ENABLED", "false").lower() == "true"
+    QUERY_BUDGET_DEFAULT = int(os.getenv("QUERY_BUDGET_DEFAULT", "10"))
+    QUERY_BUDGET_REPEAT_LIMIT = int(os.getenv("QUERY_BUDGET_REPEAT_LIMIT", "3"))
+    QUERY_BUDGET_RAISE = os.getenv("QUERY_BUDGET_RAISE", "false").lower() == "true"
+
+    # On-demand request profiling, see `app/profiling.py`. Sampled profiles are only taken with a
+    # PROFILING_DIR to save them to.
+    PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+    PROFILING_DIR = os.getenv("PROFILING_DIR", "")
+
+    # Default per-request deadline, see `app/deadlines.py`. Views can declare their own with `@deadline`.
+    REQUEST_DEADLINE_MS = int(os.getenv("REQUEST_DEADLINE_MS", "5000"))
+
+    # POST `/batch`, operations accepted in a single request.
+    BATCH_MAX_OPERATIONS = int(os.getenv("BATCH_MAX_OPERATIONS", "500"))
@@ -0,0 +1,117 @@
+from logging import getLogger
+from math import ceil
+from time import monotonic
+from typing import Callable, Optional
+
+from flask import Flask, current_app, g, has_request_context, request
+from sqlalchemy import event
+
+from app import db
+
+"""
+Per-request deadlines, enforced down to the database.
+
+Each request gets a deadline when it starts: the budget declared on its view with `@deadline(ms)`,
+`REQUEST_DEADLINE_MS` for views that don't declare one, or the client's `X-Request-Timeout-Ms` header
+if that is shorter. Every statement the request sends to Postgres is preceded by
+`SET LOCAL statement_timeout` set to the time left, so a slow query is cancelled by the database as
+soon as the client would have given up on it, freeing the worker and its connection. A statement
+issued after the deadline has passed is not sent at all. Either way the request fails with a 504.
+"""
+
+_LOGGER = getLogger(__name__)
+
+TIMEOUT_HEADER = "X-Request-Timeout-Ms"
+
+# Savepoint statements are left alone, `ROLLBACK TO SAVEPOINT` has to run in an aborted transaction
+# where any other statement fails.
+_TRANSACTION_CONTROL = ("SAVEPOINT", "RELEASE", "ROLLBACK")
+
+# SQLSTATE of a statement cancelled by `statement_timeout`.
+_QUERY_CANCELED = "57014"
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def deadline(budget_ms: Optional[int]) -> Callable:
+    """Declare the latency budget of a view.
+
+    Args:
+        budget_ms (Optional[int]): budget in milliseconds, None for views that must be allowed to run
+                                   for as long as they need, such as streaming exports.
+    """
+    def decorator(fn):
+        fn.deadline_ms = budget_ms
+        return fn
+    return decorator
+
+
+def remaining_ms() -> Optional[float]:
+    """Time left before the current request's deadline.
+
+    Returns:
+        None: The request has no deadline, or there is no request.
+        float: milliseconds left, negative once the deadline has passed.
+    """
+    if not has_request_context() or g.get("deadline") is None:
+        return None
+    return (g.deadline - monotonic()) * 1000
+
+
+class DeadlineEnforcer(object):
+    def init_app(self, app: Flask):
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        engine = db.get_engine(app)
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute, retval=True)
+        event.listen(engine, "handle_error", self._handle_error)
+
+    def _before_request(self):
+        view = current_app.view_functions.get(request.endpoint)
+        budget_ms = getattr(view, "deadline_ms", current_app.config["REQUEST_DEADLINE_MS"])
+
+        requested = request.headers.get(TIMEOUT_HEADER)
+        if requested is not None:
+            if not requested.isdigit() or int(requested) == 0:
+                return f"value for {TIMEOUT_HEADER} must be a positive integer", 400
+            # Clients can tighten the budget, not extend it.
+            budget_ms = int(requested) if budget_ms is None else min(budget_ms, int(requested))
+
+        if budget_ms is not None:
+            g.deadline = monotonic() + budget_ms / 1000
+
+    def _teardown_request(self, exc):
+        g.pop("deadline", None)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        remaining = remaining_ms()
+        if remaining is None or conn.dialect.name != "postgresql":
+            return statement, parameters
+        if statement.lstrip().upper().startswith(_TRANSACTION_CONTROL):
+            return statement, parameters
+        if remaining <= 0:
+            _LOGGER.warning(f"deadlines: {request.endpoint} ran out of time before a statement")
+            raise DeadlineExceeded("deadline exceeded before executing statement")
+
+        set_timeout = f"SET LOCAL statement_timeout = {ceil(remaining)}"
+        if executemany or getattr(cursor, "name", None):
+            # Named (server-side) cursors wrap the statement in DECLARE, so set the timeout
+            # separately rather than prefixing it.
+            with conn.connection.cursor() as timeout_cursor:
+                timeout_cursor.execute(set_timeout)
+            return statement, parameters
+        # Sent along with the statement, it costs no extra round trip.
+        return f"{set_timeout}; {statement}", parameters
+
+    def _handle_error(self, context):
+        if getattr(context.original_exception, "pgcode", None) != _QUERY_CANCELED:
+            return
+        if remaining_ms() is None:
+            return
+        _LOGGER.warning(f"deadlines: statement cancelled at the deadline of {request.endpoint}")
+        raise DeadlineExceeded("deadline exceeded while executing statement") from context.original_exception
+
+
+deadlines = DeadlineEnforcer()
@@ -0,0 +1,94 @@
+import csv
+import json
+from io import StringIO
+from typing import Iterable, Iterator, Tuple
+from uuid import UUID
+
+"""
+Serializers for exporting wishlists, as newline delimited JSON or CSV.
+
+Records come from `app.models.iter_wishlist_export` and are emitted in chunks, each paired with the
+checkpoint of its last record. Passing a checkpoint back as `after` resumes the export right after
+that record.
+"""
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+FIELDS = ("wishlist_id", "user_id", "book_id", "title", "author", "isbn", "publication_date")
+
+
+def format_checkpoint(record: dict) -> str:
+    return f"{record['wishlist_id']},{record['user_id']},{record['book_id']}"
+
+
+def parse_checkpoint(checkpoint: str) -> Tuple[UUID, UUID, UUID]:
+    """Parse a checkpoint produced by `format_checkpoint`.
+
+    Args:
+        checkpoint (str): checkpoint string
+
+    Raises:
+        ValueError: The checkpoint is malformed.
+
+    Returns:
+        Tuple[UUID, UUID, UUID]: (wishlist_id, user_id, book_id) key of the checkpointed record.
+    """
+    parts = checkpoint.split(",")
+    if len(parts) != 3:
+        raise ValueError("checkpoint must be of the form <wishlist_id>,<user_id>,<book_id>")
+    return tuple(UUID(part) for part in parts)
+
+
+def _plain(value):
+    if value is None:
+        return None
+    if isinstance(value, (str, int, float)):
+        return value
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def serialize(
+    records: Iterable[dict],
+    fmt: str,
+    header: bool = True,
+    chunk_size: int = 1000
+) -> Iterator[Tuple[str, str]]:
+    """Serialize export records, a chunk of records at a time.
+
+    Args:
+        records (Iterable[dict]): records to export
+        fmt (str): one of `FORMATS`
+        header (bool, optional): whether to start CSV output with a header row. Defaults to True.
+        chunk_size (int, optional): records per chunk. Defaults to 1000.
+
+    Yields:
+        Tuple[str, str]: serialized chunk and the checkpoint of its last record.
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if fmt == "csv" and header:
+        writer.writerow(FIELDS)
+
+    count, checkpoint = 0, None
+    for record in records:
+        values = [_plain(record[field]) for field in FIELDS]
+        if fmt == "csv":
+            writer.writerow(values)
+        else:
+            buffer.write(json.dumps(dict(zip(FIELDS, values))))
+            buffer.write("\n")
+        count += 1
+        checkpoint = format_checkpoint(record)
+
+        if count == chunk_size:
+            yield buffer.getvalue(), checkpoint
+            buffer.seek(0)
+            buffer.truncate()
+            count = 0
+
+    if buffer.tell():
+        yield buffer.getvalue(), checkpoint
@@ -1,17 +1,26 @@
 import uuid
+from datetime import timedelta
+from typing import List
 
-from sqlalchemy import UniqueConstraint
+from flask import current_app, json
+from sqlalchemy import UniqueConstraint, event, inspect
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.sql import text
+from sqlalchemy.orm import lazyload
+from sqlalchemy.sql import bindparam, func, text
 
 from app import bcrypt, db
+from app.cache import wishlist_cache
+from app.tasks import background_tasks
 from app.models.exceptions import (
     BookNotFound,
+    ChangeCursorExpired,
     UserNotFound,
     WishlistNotFound,
-    WishlistEntryAlreadyExists
+    WishlistEntryAlreadyExists,
+    WishlistEntryNotFound
 )
+from app.models.prepared import PreparedStatement, execute_prepared
 
 """
 Resource for how to use UUIDs as Primary Keys:
@@ -29,6 +38,7 @@ Columns:
     `wishlist_id`: uuid for a single wishlist instance
     `user_id`: Foreign Key to users.id
     `book_id`: Foreign Key to books.id
+    `position`: sort key of the book within its wishlist, see `move_wishlist_entry`
 
 Primary Key:
     Composite key across all three columns to ensure that, for a single user, a single wishlist, can
@@ -47,7 +57,506 @@ wishlists = db.Table(
     'wishlists',
     db.Column('wishlist_id', UUID(as_uuid=True), primary_key=True),
     db.Column('user_id', UUID(as_uuid=True), db.ForeignKey('users.id'), primary_key=True),
-    db.Column('book_id', UUID(as_uuid=True), db.ForeignKey('books.id'), primary_key=True)
+    db.Column('book_id', UUID(as_uuid=True), db.ForeignKey('books.id'), primary_key=True),
+    # Serves per-user exports in key order, see `iter_wishlist_export`.
+    db.Index('ix_wishlists_user_id_wishlist_id_book_id', 'user_id', 'wishlist_id', 'book_id'),
+    db.Column('position', db.BigInteger, nullable=False, server_default='0'),
+    # Finds the wishlists holding a book, see `refresh_book_wishlist_documents`.
+    db.Index('ix_wishlists_book_id', 'book_id'),
+    # Serves each wishlist's entries in order.
+    db.Index('ix_wishlists_wishlist_id_position', 'wishlist_id', 'position')
+)
+
+"""
+Entries are ordered by `position`, ties broken by `book_id`. Positions are spaced `POSITION_GAP`
+apart: new entries are appended one gap after the last entry, and moving an entry sets its position
+to the midpoint of its new neighbours, so a move only ever updates the moved row. Once a move leaves
+less than `_POSITION_MIN_GAP` between neighbours, the wishlist's positions are spread out again in
+the background by `rebalance_wishlist_positions`.
+"""
+POSITION_GAP = 1 << 16
+_POSITION_MIN_GAP = 64
+
+# The hot statements below, like every statement in this module, are built once at import time rather
+# than per call. Along with the engine's compiled statement cache (see `create_app`) that means each is
+# only compiled to SQL once per process.
+# Inserts nothing if the wishlist belongs to another user, a wishlist only ever has one owner.
+_INSERT_ENTRY = text(
+    """
+        INSERT INTO wishlists (wishlist_id, user_id, book_id, position)
+        SELECT :wishlist_id, :user_id, :book_id, COALESCE(max(position), 0) + :gap
+        FROM wishlists
+        WHERE wishlist_id = :wishlist_id
+        HAVING bool_and(user_id = :user_id) IS NOT FALSE
+    """
+).bindparams(
+    bindparam("wishlist_id", type_=UUID(as_uuid=True)),
+    bindparam("user_id", type_=UUID(as_uuid=True)),
+    bindparam("book_id", type_=UUID(as_uuid=True))
+)
+
+_LIST_WISHLIST = PreparedStatement(
+    "list_wishlist_entries",
+    """
+        SELECT wishlist_id, user_id, id, title, author, isbn, publication_date
+        FROM wishlists JOIN books
+        ON book_id = id
+        WHERE wishlist_id = :wishlist_id AND user_id = COALESCE(:owner_id, user_id)
+        ORDER BY position, book_id
+    """,
+    {"wishlist_id": "uuid", "owner_id": "uuid"},
+    wishlist_id=UUID(as_uuid=True),
+    owner_id=UUID(as_uuid=True)
+)
+
+# Serializes the writers of a single wishlist, the same lock as the one taken in `_LOG_CHANGES`.
+# Every writer takes it before touching any row, so that two writers never wait on each other's row
+# locks and advisory lock at once. Taken in its own statement so that the reads and writes that
+# follow see the previous writer's changes. The key is hashed from the canonical form of the id, so
+# that every spelling of an id takes the same lock.
+_LOCK_WISHLIST = text(
+    "SELECT pg_advisory_xact_lock(hashtext(CAST(CAST(:lock_id AS uuid) AS text)))"
+).bindparams(bindparam("lock_id", type_=UUID(as_uuid=True)))
+
+# Locks several wishlists at once, the same locks as `_LOCK_WISHLIST`, in a consistent order so that
+# writers of more than one wishlist cannot deadlock.
+_LOCK_WISHLISTS = text(
+    """
+        SELECT count(pg_advisory_xact_lock(hashtext(CAST(id AS text))))
+        FROM (SELECT unnest(CAST(:wishlist_ids AS uuid[])) AS id ORDER BY 1) AS ids
+    """
+)
+
+# Current position of the moved book, position of the book it is moved after and position of the
+# book that will follow it. Without `after_book_id` the anchor is empty and the next book is the first.
+_MOVE_BOUNDS = text(
+    """
+        WITH anchor AS (
+            SELECT position, book_id FROM wishlists
+            WHERE wishlist_id = :wishlist_id AND book_id = :after_book_id
+        )
+        SELECT
+            (
+                SELECT position FROM wishlists
+                WHERE wishlist_id = :wishlist_id AND book_id = :book_id
+                AND user_id = COALESCE(:owner_id, user_id)
+            ),
+            (SELECT position FROM anchor),
+            (
+                SELECT position FROM wishlists
+                WHERE wishlist_id = :wishlist_id AND book_id <> :book_id
+                AND (position, book_id) > ALL (SELECT position, book_id FROM anchor)
+                ORDER BY position, book_id
+                LIMIT 1
+            )
+    """
+).bindparams(
+    bindparam("wishlist_id", type_=UUID(as_uuid=True)),
+    bindparam("book_id", type_=UUID(as_uuid=True)),
+    bindparam("after_book_id", type_=UUID(as_uuid=True)),
+    bindparam("owner_id", type_=UUID(as_uuid=True))
+)
+
+_SET_POSITION = text(
+    """
+        UPDATE wishlists SET position = :position
+        WHERE wishlist_id = :wishlist_id AND book_id = :book_id
+    """
+).bindparams(
+    bindparam("wishlist_id", type_=UUID(as_uuid=True)),
+    bindparam("book_id", type_=UUID(as_uuid=True))
+)
+
+# Only rows whose position actually changes are rewritten.
+_REBALANCE_POSITIONS = text(
+    """
+        UPDATE wishlists SET position = ranked.rank * :gap
+        FROM (
+            SELECT book_id, row_number() OVER (ORDER BY position, book_id) AS rank
+            FROM wishlists
+            WHERE wishlist_id = :wishlist_id
+        ) AS ranked
+        WHERE wishlists.wishlist_id = :wishlist_id
+        AND wishlists.book_id = ranked.book_id
+        AND wishlists.position <> ranked.rank * :gap
+    """
+).bindparams(bindparam("wishlist_id", type_=UUID(as_uuid=True)))
+
+
+"""
+The `wishlist_documents` table holds the pre-rendered GET `/wishlist/<wishlist_id>` response body of
+every wishlist, when `WISHLIST_MATERIALIZE` is enabled. Documents are rebuilt in the same transaction
+as every write to their wishlist, so a read is a single primary key lookup that returns stored bytes.
+When a book's metadata changes, the documents of the wishlists holding it are rebuilt in the
+background.
+Columns:
+    `wishlist_id`: uuid of the wishlist
+    `document`: rendered JSON body
+    `updated_at`: when the document was last rebuilt
+"""
+wishlist_documents = db.Table(
+    'wishlist_documents',
+    db.Column('wishlist_id', UUID(as_uuid=True), primary_key=True),
+    db.Column('document', db.LargeBinary, nullable=False),
+    db.Column('updated_at', db.DateTime(timezone=True), nullable=False, server_default=func.now())
+)
+
+_DOCUMENT_ROWS = text(
+    """
+        SELECT wishlist_id, user_id, id, title, author, isbn, publication_date
+        FROM wishlists JOIN books
+        ON book_id = id
+        WHERE wishlist_id = ANY(CAST(:wishlist_ids AS uuid[]))
+        ORDER BY wishlist_id, position, book_id
+    """
+)
+
+_UPSERT_DOCUMENT = text(
+    """
+        INSERT INTO wishlist_documents (wishlist_id, document)
+        VALUES (:wishlist_id, :document)
+        ON CONFLICT (wishlist_id) DO UPDATE
+        SET document = excluded.document, updated_at = now()
+    """
+).bindparams(bindparam("wishlist_id", type_=UUID(as_uuid=True)))
+
+_DELETE_DOCUMENTS = text(
+    """
+        DELETE FROM wishlist_documents WHERE wishlist_id = ANY(CAST(:wishlist_ids AS uuid[]))
+    """
+)
+
+_GET_DOCUMENT = PreparedStatement(
+    "get_wishlist_document",
+    """
+        SELECT document FROM wishlist_documents
+        WHERE wishlist_id = :wishlist_id
+        AND (
+            CAST(:owner_id AS uuid) IS NULL
+            OR EXISTS (SELECT 1 FROM wishlists WHERE wishlist_id = :wishlist_id AND user_id = :owner_id)
+        )
+    """,
+    {"wishlist_id": "uuid", "owner_id": "uuid"},
+    wishlist_id=UUID(as_uuid=True),
+    owner_id=UUID(as_uuid=True)
+)
+
+_BOOK_WISHLISTS = text(
+    """
+        SELECT DISTINCT wishlist_id FROM wishlists WHERE book_id = ANY(CAST(:book_ids AS uuid[]))
+    """
+)
+
+_WISHLIST_IDS_PAGE = text(
+    """
+        SELECT DISTINCT wishlist_id FROM wishlists
+        WHERE wishlist_id > :after
+        ORDER BY wishlist_id
+        LIMIT :page_size
+    """
+).bindparams(bindparam("after", type_=UUID(as_uuid=True)))
+
+
+"""
+The `wishlist_changes` table is an append-only log of the additions to and removals from each
+wishlist, used to serve incremental syncs via GET `/wishlist/<wishlist_id>/changes`.
+Columns:
+    `id`: monotonically increasing change id, handed to clients as their sync cursor
+    `wishlist_id`: uuid of the wishlist that changed
+    `user_id`: uuid of the user the wishlist belonged to, its changes are only served to them
+    `book_id`: uuid of the book that was added or removed
+    `op`: one of `CHANGE_ADD`, `CHANGE_REMOVE`
+    `changed_at`: when the change was made, used to compact old entries
+
+Entries older than the retention period are deleted by `compact_wishlist_changes`. For every wishlist
+it compacts, the highest deleted id is kept in `wishlist_change_horizons`: a client whose cursor is
+below that horizon has missed changes and must do a full resync. The owner is kept along with it, so
+that a wishlist whose log has been compacted away still has an owner to check against.
+"""
+CHANGE_ADD = "add"
+CHANGE_REMOVE = "remove"
+
+wishlist_changes = db.Table(
+    'wishlist_changes',
+    db.Column('id', db.BigInteger, primary_key=True),
+    db.Column('wishlist_id', UUID(as_uuid=True), nullable=False),
+    db.Column('user_id', UUID(as_uuid=True), nullable=False),
+    db.Column('book_id', UUID(as_uuid=True), nullable=False),
+    db.Column('op', db.String(10), nullable=False),
+    db.Column('changed_at', db.DateTime(timezone=True), nullable=False, server_default=func.now()),
+    db.Index('ix_wishlist_changes_wishlist_id_id', 'wishlist_id', 'id')
+)
+
+wishlist_change_horizons = db.Table(
+    'wishlist_change_horizons',
+    db.Column('wishlist_id', UUID(as_uuid=True), primary_key=True),
+    db.Column('horizon', db.BigInteger, nullable=False),
+    db.Column('user_id', UUID(as_uuid=True), nullable=False)
+)
+
+_LIST_CHANGES = PreparedStatement(
+    "list_wishlist_changes",
+    """
+        SELECT id, op, book_id
+        FROM wishlist_changes
+        WHERE wishlist_id = :wishlist_id AND id > :since
+        ORDER BY id
+        LIMIT :limit
+    """,
+    {"wishlist_id": "uuid", "since": "bigint", "limit": "integer"},
+    wishlist_id=UUID(as_uuid=True)
+)
+
+# Ownership is checked against the log rather than `wishlists`, so that the removals that emptied a
+# wishlist can still be synced.
+_LATEST_CHANGE = PreparedStatement(
+    "latest_wishlist_change",
+    """
+        WITH latest AS (
+            SELECT id, user_id FROM wishlist_changes
+            WHERE wishlist_id = :wishlist_id
+            ORDER BY id DESC
+            LIMIT 1
+        ), horizon AS (
+            SELECT horizon, user_id FROM wishlist_change_horizons WHERE wishlist_id = :wishlist_id
+        )
+        SELECT
+            (SELECT id FROM latest),
+            (SELECT horizon FROM horizon),
+            CAST(:owner_id AS uuid) IS NULL
+            OR COALESCE((SELECT user_id FROM latest), (SELECT user_id FROM horizon)) = :owner_id
+    """,
+    {"wishlist_id": "uuid", "owner_id": "uuid"},
+    wishlist_id=UUID(as_uuid=True),
+    owner_id=UUID(as_uuid=True)
+)
+
+# Delete the oldest expired changes a batch at a time so that compaction never holds locks on a large
+# part of the log, advancing the horizon of every wishlist that lost entries.
+_COMPACT_CHANGES = text(
+    """
+        WITH expired AS (
+            DELETE FROM wishlist_changes
+            WHERE id IN (
+                SELECT id FROM wishlist_changes
+                WHERE changed_at < now() - :retention
+                ORDER BY id
+                LIMIT :batch_size
+            )
+            RETURNING wishlist_id, id, user_id
+        ), horizons AS (
+            INSERT INTO wishlist_change_horizons (wishlist_id, horizon, user_id)
+            SELECT DISTINCT ON (wishlist_id) wishlist_id, id, user_id
+            FROM expired
+            ORDER BY wishlist_id, id DESC
+            ON CONFLICT (wishlist_id) DO UPDATE
+            -- Changes are compacted in id order, so the owner of the new horizon is the latest one.
+            SET horizon = GREATEST(wishlist_change_horizons.horizon, excluded.horizon),
+                user_id = excluded.user_id
+        )
+        SELECT count(*) FROM expired
+    """
+)
+
+"""
+The `book_popularity` table counts how many wishlists each book is on, and
+`book_popularity_buckets` counts the net number of times each book was added to wishlists per hour.
+Both are kept up to date by every write to `wishlists`, so the most wishlisted books, overall or for
+a recent window, can be ranked without aggregating the `wishlists` table.
+"""
+POPULARITY_BUCKET = "hour"
+POPULARITY_WINDOWS = {
+    "all": None,
+    "24h": timedelta(hours=24),
+    "7d": timedelta(days=7),
+    "30d": timedelta(days=30),
+}
+
+book_popularity = db.Table(
+    'book_popularity',
+    db.Column('book_id', UUID(as_uuid=True), db.ForeignKey('books.id'), primary_key=True),
+    db.Column('wishlist_count', db.BigInteger, nullable=False),
+    db.Index('ix_book_popularity_wishlist_count', 'wishlist_count')
+)
+
+book_popularity_buckets = db.Table(
+    'book_popularity_buckets',
+    db.Column('book_id', UUID(as_uuid=True), db.ForeignKey('books.id'), primary_key=True),
+    db.Column('bucket_start', db.DateTime(timezone=True), primary_key=True),
+    db.Column('count', db.BigInteger, nullable=False),
+    db.Index('ix_book_popularity_buckets_bucket_start', 'bucket_start')
+)
+
+_CHANGE_DELTAS = {CHANGE_ADD: 1, CHANGE_REMOVE: -1}
+
+# Every write to `wishlists` returns the entries it changed as a `{source}` CTE, and these CTEs log
+# and count the changes in the same statement.
+#
+# Change ids come from a sequence, so two transactions writing to the same wishlist could commit their
+# changes out of id order and a client could sync past a change that was not yet visible. Taking a
+# per-wishlist advisory lock before the id is drawn serializes the writers of a single wishlist.
+_LOG_CHANGES = """
+    logged AS (
+        INSERT INTO wishlist_changes (wishlist_id, user_id, book_id, op)
+        SELECT wishlist_id, user_id, book_id, :op
+        FROM {source},
+        (SELECT pg_advisory_xact_lock(hashtext(CAST(CAST(:lock_id AS uuid) AS text)))) AS wishlist_lock
+    )
+"""
+
+# Counters are upserted in book order so concurrent writers lock their rows in the same order. That
+# only holds for a transaction that updates counters in a single statement, writers that run several
+# statements count all of their changes at once at the end, see `_count_changes`.
+_COUNT_CHANGES = """
+    popularity AS (
+        INSERT INTO book_popularity (book_id, wishlist_count)
+        SELECT book_id, {delta} FROM {source} GROUP BY book_id ORDER BY book_id
+        ON CONFLICT (book_id) DO UPDATE
+        SET wishlist_count = book_popularity.wishlist_count + excluded.wishlist_count
+    ), popularity_buckets AS (
+        INSERT INTO book_popularity_buckets (book_id, bucket_start, count)
+        SELECT book_id, date_trunc('{bucket}', now()), {delta}
+        FROM {source} GROUP BY book_id ORDER BY book_id
+        ON CONFLICT (book_id, bucket_start) DO UPDATE
+        SET count = book_popularity_buckets.count + excluded.count
+    )
+"""
+
+
+def _count_changes(source: str, delta: str) -> str:
+    return _COUNT_CHANGES.format(source=source, delta=delta, bucket=POPULARITY_BUCKET)
+
+
+def _track_changes(source: str, count: bool = True) -> str:
+    """Log, and unless `count` is False count, the changed entries returned by the `{source}` CTE."""
+    tracked = _LOG_CHANGES.format(source=source)
+    if count:
+        tracked += ", " + _count_changes(source, ":delta * count(*)")
+    return tracked
+
+
+_RECORD_CHANGE = text(
+    """
+        WITH changed AS (
+            SELECT CAST(:wishlist_id AS uuid) AS wishlist_id, CAST(:user_id AS uuid) AS user_id,
+                CAST(:book_id AS uuid) AS book_id
+        ), {track_changes}
+        SELECT count(*) FROM changed
+    """.format(track_changes=_track_changes("changed"))
+).bindparams(
+    bindparam("wishlist_id", type_=UUID(as_uuid=True)),
+    bindparam("lock_id", type_=UUID(as_uuid=True)),
+    bindparam("user_id", type_=UUID(as_uuid=True)),
+    bindparam("book_id", type_=UUID(as_uuid=True))
+)
+
+_POPULAR_BOOKS = text(
+    """
+        SELECT id, title, author, isbn, publication_date, wishlist_count
+        FROM book_popularity JOIN books
+        ON book_id = id
+        WHERE wishlist_count > 0
+        ORDER BY wishlist_count DESC, id
+        LIMIT :limit
+    """
+)
+
+_POPULAR_BOOKS_IN_WINDOW = text(
+    """
+        SELECT id, title, author, isbn, publication_date, wishlist_count
+        FROM (
+            SELECT book_id, CAST(sum(count) AS bigint) AS wishlist_count
+            FROM book_popularity_buckets
+            WHERE bucket_start >= date_trunc('{bucket}', now() - :window)
+            GROUP BY book_id
+            HAVING sum(count) > 0
+        ) AS windowed JOIN books
+        ON book_id = id
+        ORDER BY wishlist_count DESC, id
+        LIMIT :limit
+    """.format(bucket=POPULARITY_BUCKET)
+)
+
+_PRUNE_POPULARITY_BUCKETS = text(
+    """
+        DELETE FROM book_popularity_buckets WHERE bucket_start < now() - :retention
+    """
+)
+
+# Recount from scratch: totals from the `wishlists` table, buckets from whatever is left of the change
+# log. Expensive, for backfilling and repairs only.
+_REBUILD_POPULARITY = [
+    text("DELETE FROM book_popularity"),
+    text("DELETE FROM book_popularity_buckets"),
+    text(
+        """
+            INSERT INTO book_popularity (book_id, wishlist_count)
+            SELECT book_id, count(*) FROM wishlists GROUP BY book_id
+        """
+    ),
+    text(
+        """
+            INSERT INTO book_popularity_buckets (book_id, bucket_start, count)
+            SELECT book_id, date_trunc('{bucket}', changed_at),
+                sum(CASE WHEN op = :add THEN 1 ELSE -1 END)
+            FROM wishlist_changes
+            GROUP BY 1, 2
+        """.format(bucket=POPULARITY_BUCKET)
+    ),
+]
+
+# Bulk operations on a wishlist run as a single statement and report how many entries they affected.
+_CLONE_WISHLIST = text(
+    """
+        WITH copied AS (
+            INSERT INTO wishlists (wishlist_id, user_id, book_id, position)
+            SELECT :new_wishlist_id, COALESCE(:user_id, user_id), book_id, position
+            FROM wishlists
+            WHERE wishlist_id = :wishlist_id AND user_id = COALESCE(:owner_id, user_id)
+            -- Never copy into a wishlist that belongs to another user.
+            AND NOT EXISTS (
+                SELECT 1 FROM wishlists AS target
+                WHERE target.wishlist_id = :new_wishlist_id
+                AND target.user_id <> COALESCE(:user_id, wishlists.user_id)
+            )
+            RETURNING wishlist_id, user_id, book_id
+        ), {track_changes}
+        SELECT count(*) FROM copied
+    """.format(track_changes=_track_changes("copied"))
+).bindparams(
+    bindparam("new_wishlist_id", type_=UUID(as_uuid=True)),
+    bindparam("lock_id", type_=UUID(as_uuid=True)),
+    bindparam("user_id", type_=UUID(as_uuid=True)),
+    bindparam("owner_id", type_=UUID(as_uuid=True)),
+    bindparam("wishlist_id", type_=UUID(as_uuid=True))
+)
+
+_REMOVE_ENTRIES = """
+    WITH removed AS (
+        DELETE FROM wishlists
+        WHERE wishlist_id = :wishlist_id AND user_id = COALESCE(:owner_id, user_id) {book_filter}
+        RETURNING wishlist_id, user_id, book_id
+    ), {track_changes}
+    SELECT count(*) FROM removed
+"""
+
+_REMOVE_WISHLIST = text(
+    _REMOVE_ENTRIES.format(book_filter="", track_changes=_track_changes("removed"))
+).bindparams(
+    bindparam("lock_id", type_=UUID(as_uuid=True)),
+    bindparam("owner_id", type_=UUID(as_uuid=True)),
+    bindparam("wishlist_id", type_=UUID(as_uuid=True))
+)
+
+_REMOVE_BOOKS = text(
+    _REMOVE_ENTRIES.format(
+        book_filter="AND book_id = ANY(CAST(:book_ids AS uuid[]))",
+        track_changes=_track_changes("removed")
+    )
+).bindparams(
+    bindparam("lock_id", type_=UUID(as_uuid=True)),
+    bindparam("owner_id", type_=UUID(as_uuid=True)),
+    bindparam("wishlist_id", type_=UUID(as_uuid=True))
 )
 
 
@@ -128,6 +637,25 @@ class Book(db.Model):
         return f"<Book {self.title}>"
 
 
+def find_user_by_credentials(email: str, raw_password: str):
+    """Find the user with the given email address and password.
+
+    Args:
+        email (str): email address of the user.
+        raw_password (str): raw candidate password.
+
+    Returns:
+        None: No user matches the credentials.
+        User: The matching user.
+    """
+    # Email addresses aren't unique, so check the password against each user that has it. Logging in
+    # never needs the user's wishlists, so don't let `User.wishlists` eagerly load every book on them.
+    for user in User.query.options(lazyload(User.wishlists)).filter_by(email=email):
+        if user.verify_password(raw_password):
+            return user
+    return None
+
+
 def insert_wishlist_entry(user_id: str, book_id: str, wishlist_id: str = None) -> dict:
     """
     Insert a new entry for a wishlist. If `wishlist_id` is not specified, a new wishlist will be
@@ -138,6 +666,9 @@ def insert_wishlist_entry(user_id: str, book_id: str, wishlist_id: str = None) -
         book_id (str): uuid for a book.
         wishlist_id (str, optional): uuid for a wishlist, if not provided will be created.
                                      Defaults to None.
+
+    Raises:
+        WishlistNotFound: The wishlist belongs to another user.
     """
     if not wishlist_id:
         wishlist_id = get_uuid()
@@ -147,48 +678,126 @@ def insert_wishlist_entry(user_id: str, book_id: str, wishlist_id: str = None) -
         "wishlist_id": wishlist_id
     }
     try:
-        db.session.execute(
-            wishlists.insert().values(**values)
-        )
+        # Lock before inserting, like every other writer, so that concurrent writers cannot deadlock
+        # and each insert sees the last position the previous one appended.
+        db.session.execute(_LOCK_WISHLIST, {"lock_id": wishlist_id})
+        inserted = db.session.execute(_INSERT_ENTRY, {**values, "gap": POSITION_GAP}).rowcount
+        if not inserted:
+            db.session.rollback()
+            raise WishlistNotFound("Wishlist belongs to another user.")
+        _record_change(wishlist_id, user_id, book_id, CHANGE_ADD)
+        _refresh_wishlist_documents([wishlist_id])
         db.session.commit()
+        wishlist_cache.invalidate(wishlist_id)
     except IntegrityError as e:
-        err_msg = str(e)
-        if "ForeignKeyViolation" in err_msg:
-            if "wishlists_book_id_fkey" in err_msg:
-                raise BookNotFound("Given book does not exist.")
-            if "wishlists_user_id_fkey" in err_msg:
-                raise UserNotFound("Given user does not exist.")
-        
-        if "UniqueViolation" in err_msg:
-            # Cannot re-insert an existing wishlist entry
-            raise WishlistEntryAlreadyExists("Wishlist entry already exists.")
-        
-        # Fallback: we can't handle this error, so raise.
-        raise e
+        _raise_for_integrity_error(e)
 
     return values
 
 
-def list_wishlist_entries(wishlist_id: str) -> dict:
+def _raise_for_integrity_error(e: IntegrityError):
+    """Roll back the failed transaction and raise the matching model exception for an integrity
+    error from writing to the `wishlists` table.
+
+    Args:
+        e (IntegrityError): error raised by the write.
+    """
+    db.session.rollback()
+    raise _model_error(e)
+
+
+def _model_error(e: IntegrityError) -> Exception:
+    """Translate an integrity error from writing to the `wishlists` table into a model exception.
+
+    Args:
+        e (IntegrityError): error raised by the write.
+
+    Returns:
+        Exception: the matching model exception, or `e` itself if there is none.
+    """
+    err_msg = str(e)
+    if "ForeignKeyViolation" in err_msg:
+        if "wishlists_book_id_fkey" in err_msg:
+            return BookNotFound("Given book does not exist.")
+        if "wishlists_user_id_fkey" in err_msg:
+            return UserNotFound("Given user does not exist.")
+
+    if "UniqueViolation" in err_msg:
+        # Cannot re-insert an existing wishlist entry
+        return WishlistEntryAlreadyExists("Wishlist entry already exists.")
+
+    # Fallback: we can't handle this error.
+    return e
+
+
+def clone_wishlist(
+    wishlist_id: str,
+    user_id: str = None,
+    new_wishlist_id: str = None,
+    owner_id: str = None
+) -> dict:
+    """Copy every entry of a wishlist into a new wishlist with a single statement.
+
+    Args:
+        wishlist_id (str): uuid of the wishlist to copy.
+        user_id (str, optional): uuid of the user to own the copy. Defaults to the owner of the
+                                 copied wishlist.
+        new_wishlist_id (str, optional): uuid for the copy, if not provided will be created.
+                                         Defaults to None.
+        owner_id (str, optional): only copy the wishlist if it belongs to this user. Defaults to None.
+
+    Raises:
+        WishlistNotFound: There are no entries for `wishlist_id` that belong to `owner_id`, or
+                          `new_wishlist_id` belongs to another user.
+
+    Returns:
+        (dict): Dictionary composed of the new wishlist_id, the source_wishlist_id and the number of
+                entries copied.
+    """
+    if not new_wishlist_id:
+        new_wishlist_id = get_uuid()
+    params = {
+        "wishlist_id": wishlist_id,
+        "new_wishlist_id": new_wishlist_id,
+        "user_id": user_id,
+        "owner_id": owner_id,
+        "lock_id": new_wishlist_id,
+        "op": CHANGE_ADD,
+        "delta": _CHANGE_DELTAS[CHANGE_ADD]
+    }
+    try:
+        db.session.execute(_LOCK_WISHLIST, {"lock_id": new_wishlist_id})
+        copied = db.session.execute(_CLONE_WISHLIST, params).scalar()
+    except IntegrityError as e:
+        _raise_for_integrity_error(e)
+
+    if not copied:
+        db.session.rollback()
+        raise WishlistNotFound("No wishlist entries for given `wishlist_id`")
+    _refresh_wishlist_documents([new_wishlist_id])
+    db.session.commit()
+    wishlist_cache.invalidate(new_wishlist_id)
+
+    return {
+        "wishlist_id": new_wishlist_id,
+        "source_wishlist_id": wishlist_id,
+        "copied": copied
+    }
+
+
+def list_wishlist_entries(wishlist_id: str, owner_id: str = None) -> dict:
     """Get the wishlist and entries for the given wishlist_id.
 
     Args:
         wishlist_id (str): uuid for a wishlist
+        owner_id (str, optional): only find the wishlist if it belongs to this user. Defaults to None.
 
     Returns:
         None:   No wishlist was found for given wishlist_id
         (dict): Dictionary composed of wishlist_id, user_id, and the complete book models.
     """
-    query = text(
-        """
-            SELECT wishlist_id, user_id, id, title, author, isbn, publication_date
-            FROM wishlists JOIN books
-            ON book_id = id
-            WHERE wishlist_id = :wishlist_id
-        """
-    )
-    res = db.session.execute(
-        query, {"wishlist_id": wishlist_id}
+    res = execute_prepared(
+        db.session, _LIST_WISHLIST, {"wishlist_id": wishlist_id, "owner_id": owner_id}
     )
     keys = res.keys()
     rows = res.fetchall()
@@ -197,6 +806,19 @@ def list_wishlist_entries(wishlist_id: str) -> dict:
         # No wishlist for given wishlist_id, shortcut out.
         raise WishlistNotFound("No wishlist entries for given `wishlist_id`")
 
+    return _wishlist_from_rows(keys, rows)
+
+
+def _wishlist_from_rows(keys: list, rows: list) -> dict:
+    """Build a wishlist from its joined wishlist and book rows.
+
+    Args:
+        keys (list): column names, starting with `wishlist_id` and `user_id` then the book's columns.
+        rows (list): every row of a single wishlist.
+
+    Returns:
+        (dict): Dictionary composed of wishlist_id, user_id, and the complete book models.
+    """
     def _serialize_row(keys, row):
         formatted_row = {}
         for i in range(len(keys)):
@@ -213,17 +835,509 @@ def list_wishlist_entries(wishlist_id: str) -> dict:
     return results
 
 
-def remove_wishlist_entry(wishlist_id: str, book_id: str):
+def render_wishlist(wishlist: dict) -> bytes:
+    """Render a wishlist as the JSON body of a GET `/wishlist/<wishlist_id>` response.
+
+    Args:
+        wishlist (dict): wishlist as returned by `list_wishlist_entries`
+
+    Returns:
+        bytes: JSON body
+    """
+    return json.dumps(wishlist, separators=(",", ":")).encode()
+
+
+def get_wishlist_document(wishlist_id: str, owner_id: str = None) -> bytes:
+    """Get the materialized document of a wishlist.
+
+    Args:
+        wishlist_id (str): uuid for a wishlist
+        owner_id (str, optional): only find the wishlist if it belongs to this user. Defaults to None.
+
+    Raises:
+        WishlistNotFound: There is no document for the given wishlist_id, or it belongs to another
+                          user.
+
+    Returns:
+        bytes: the rendered wishlist, see `render_wishlist`.
+    """
+    document = execute_prepared(
+        db.session, _GET_DOCUMENT, {"wishlist_id": wishlist_id, "owner_id": owner_id}
+    ).scalar()
+    if document is None:
+        raise WishlistNotFound("No wishlist entries for given `wishlist_id`")
+    return bytes(document)
+
+
+def _lock_wishlists(wishlist_ids: list):
+    """Take the lock of every given wishlist, so that a document rebuilt outside of a write reads the
+    rows of the last committed write and never overwrites a concurrent writer's newer document.
+
+    Args:
+        wishlist_ids (list): uuids of wishlists
+    """
+    if current_app.config["WISHLIST_MATERIALIZE"] and wishlist_ids:
+        db.session.execute(
+            _LOCK_WISHLISTS, {"wishlist_ids": [str(wishlist_id) for wishlist_id in wishlist_ids]}
+        )
+
+
+def _refresh_wishlist_documents(wishlist_ids: list):
+    """Rebuild the materialized documents of the given wishlists, within the caller's transaction.
+    Documents of wishlists that no longer have any entries are deleted. Does nothing unless
+    `WISHLIST_MATERIALIZE` is enabled.
+
+    Args:
+        wishlist_ids (list): uuids of wishlists
+    """
+    if not current_app.config["WISHLIST_MATERIALIZE"] or not wishlist_ids:
+        return
+
+    # Normalized like the ids read back below, so that e.g. an upper-case spelling of an id is not
+    # mistaken for an emptied wishlist.
+    ids = [str(uuid.UUID(str(wishlist_id))) for wishlist_id in wishlist_ids]
+    res = db.session.execute(_DOCUMENT_ROWS, {"wishlist_ids": ids})
+    keys = res.keys()
+    rows_by_wishlist = {}
+    for row in res:
+        rows_by_wishlist.setdefault(str(row[0]), []).append(row)
+
+    if rows_by_wishlist:
+        db.session.execute(
+            _UPSERT_DOCUMENT,
+            [
+                {"wishlist_id": wishlist_id, "document": render_wishlist(_wishlist_from_rows(keys, rows))}
+                for wishlist_id, rows in rows_by_wishlist.items()
+            ]
+        )
+    emptied = [wishlist_id for wishlist_id in ids if wishlist_id not in rows_by_wishlist]
+    if emptied:
+        db.session.execute(_DELETE_DOCUMENTS, {"wishlist_ids": emptied})
+
+
+def refresh_book_wishlist_documents(book_ids: list, batch_size: int = 500):
+    """Rebuild the materialized documents of every wishlist holding one of the given books, a batch
+    of wishlists per transaction.
+
+    Args:
+        book_ids (list): uuids of books whose metadata changed.
+        batch_size (int, optional): wishlists rebuilt per transaction. Defaults to 500.
+    """
+    wishlist_ids = [
+        row[0] for row in db.session.execute(
+            _BOOK_WISHLISTS, {"book_ids": [str(book_id) for book_id in book_ids]}
+        )
+    ]
+    db.session.commit()
+    for i in range(0, len(wishlist_ids), batch_size):
+        batch = wishlist_ids[i:i + batch_size]
+        _lock_wishlists(batch)
+        _refresh_wishlist_documents(batch)
+        db.session.commit()
+        for wishlist_id in batch:
+            wishlist_cache.invalidate(wishlist_id)
+
+
+def rebuild_wishlist_documents(batch_size: int = 500) -> int:
+    """Rebuild the materialized document of every wishlist, a batch per transaction. Used to
+    populate documents when `WISHLIST_MATERIALIZE` is first enabled.
+
+    Args:
+        batch_size (int, optional): wishlists rebuilt per transaction. Defaults to 500.
+
+    Returns:
+        int: number of documents rebuilt.
+    """
+    total, after = 0, uuid.UUID(int=0)
+    while True:
+        batch = [
+            row[0] for row in db.session.execute(
+                _WISHLIST_IDS_PAGE, {"after": after, "page_size": batch_size}
+            )
+        ]
+        _lock_wishlists(batch)
+        _refresh_wishlist_documents(batch)
+        db.session.commit()
+        total += len(batch)
+        if len(batch) < batch_size:
+            return total
+        after = batch[-1]
+
+
+_MATERIALIZED_BOOK_FIELDS = ("title", "author", "isbn", "publication_date")
+
+
+@event.listens_for(Book, "after_update")
+def _book_updated(mapper, connection, book):
+    """Note books whose metadata changed, their wishlists' documents are rebuilt after commit."""
+    if not current_app.config["WISHLIST_MATERIALIZE"]:
+        return
+    state = inspect(book)
+    if any(state.attrs[field].history.has_changes() for field in _MATERIALIZED_BOOK_FIELDS):
+        state.session.info.setdefault("updated_book_ids", set()).add(book.id)
+
+
+@event.listens_for(db.session, "after_commit")
+def _schedule_document_refresh(session):
+    book_ids = session.info.pop("updated_book_ids", None)
+    if book_ids:
+        background_tasks.submit(refresh_book_wishlist_documents, list(book_ids))
+
+
+@event.listens_for(db.session, "after_rollback")
+def _discard_document_refresh(session):
+    session.info.pop("updated_book_ids", None)
+
+
+def move_wishlist_entry(
+    wishlist_id: str,
+    book_id: str,
+    after_book_id: str = None,
+    owner_id: str = None
+) -> int:
+    """Move a book within its wishlist, updating only the moved entry.
+
+    Args:
+        wishlist_id (str): uuid of a wishlist
+        book_id (str): uuid of the book to move
+        after_book_id (str, optional): uuid of the book it should follow, the book is moved to the
+                                       front of the wishlist if not provided. Defaults to None.
+        owner_id (str, optional): only move the book if the wishlist belongs to this user.
+                                  Defaults to None.
+
+    Raises:
+        WishlistEntryNotFound: Either book is not on the wishlist, or it belongs to another user.
+
+    Returns:
+        int: the book's new position.
+    """
+    params = {
+        "wishlist_id": wishlist_id,
+        "book_id": book_id,
+        "after_book_id": after_book_id,
+        "owner_id": owner_id
+    }
+    db.session.execute(_LOCK_WISHLIST, {"lock_id": wishlist_id})
+    current, previous, following = db.session.execute(_MOVE_BOUNDS, params).fetchone()
+    if current is None or (after_book_id is not None and previous is None):
+        db.session.rollback()
+        raise WishlistEntryNotFound("Book is not on the given wishlist.")
+
+    if previous is not None and following is not None and following - previous < 2:
+        # Out of room between the neighbours, respace the wishlist now rather than in the background.
+        db.session.execute(_REBALANCE_POSITIONS, {"wishlist_id": wishlist_id, "gap": POSITION_GAP})
+        current, previous, following = db.session.execute(_MOVE_BOUNDS, params).fetchone()
+
+    if previous is None and following is None:
+        # The only entry on the wishlist, there is nowhere to move it.
+        db.session.rollback()
+        return current
+    if previous is None:
+        position = following - POSITION_GAP
+    elif following is None:
+        position = previous + POSITION_GAP
+    else:
+        position = (previous + following) // 2
+
+    db.session.execute(_SET_POSITION, {**params, "position": position})
+    _refresh_wishlist_documents([wishlist_id])
+    db.session.commit()
+    wishlist_cache.invalidate(wishlist_id)
+
+    if previous is not None and following is not None and following - position < _POSITION_MIN_GAP:
+        background_tasks.submit(rebalance_wishlist_positions, wishlist_id)
+    return position
+
+
+def rebalance_wishlist_positions(wishlist_id: str) -> int:
+    """Spread the positions of a wishlist's entries `POSITION_GAP` apart again, keeping their order.
+
+    Args:
+        wishlist_id (str): uuid of a wishlist
+
+    Returns:
+        int: number of entries whose position changed.
+    """
+    db.session.execute(_LOCK_WISHLIST, {"lock_id": wishlist_id})
+    updated = db.session.execute(
+        _REBALANCE_POSITIONS, {"wishlist_id": wishlist_id, "gap": POSITION_GAP}
+    ).rowcount
+    db.session.commit()
+    return updated
+
+
+def remove_wishlist_entry(wishlist_id: str, book_id: str, owner_id: str = None) -> bool:
     """Remove a wishlist entry for a given wishlist_id and book_id. Will not raise if there is no
     entry to delete.
 
     Args:
         wishlist_id (str): uuid of a wishlist
         book_id (str): uuid of a book
+        owner_id (str, optional): only remove the entry if the wishlist belongs to this user.
+                                  Defaults to None.
+
+    Returns:
+        bool: Whether an entry was removed.
+    """
+    return remove_wishlist_entries(wishlist_id, book_ids=[book_id], owner_id=owner_id) > 0
+
+
+def remove_wishlist_entries(
+    wishlist_id: str,
+    book_ids: List[str] = None,
+    owner_id: str = None
+) -> int:
+    """Remove the given books from a wishlist, or the whole wishlist, with a single statement.
+
+    Args:
+        wishlist_id (str): uuid of a wishlist
+        book_ids (List[str], optional): uuids of the books to remove. If not provided, every entry of
+                                        the wishlist is removed. Defaults to None.
+        owner_id (str, optional): only remove entries if the wishlist belongs to this user.
+                                  Defaults to None.
+
+    Returns:
+        int: number of entries removed.
+    """
+    params = {
+        "wishlist_id": wishlist_id,
+        "owner_id": owner_id,
+        "lock_id": wishlist_id,
+        "op": CHANGE_REMOVE,
+        "delta": _CHANGE_DELTAS[CHANGE_REMOVE]
+    }
+    if book_ids is None:
+        statement = _REMOVE_WISHLIST
+    else:
+        statement = _REMOVE_BOOKS
+        params["book_ids"] = [str(book_id) for book_id in book_ids]
+
+    db.session.execute(_LOCK_WISHLIST, {"lock_id": wishlist_id})
+    removed = db.session.execute(statement, params).scalar()
+    if removed:
+        _refresh_wishlist_documents([wishlist_id])
+    db.session.commit()
+    if removed:
+        wishlist_cache.invalidate(wishlist_id)
+    return removed
+
+
+_EXPORT_COLUMNS = """
+    SELECT wishlist_id, user_id, book_id, title, author, isbn, publication_date
+    FROM wishlists JOIN books
+    ON book_id = id
+"""
+
+# Both exports page through wishlists in primary key order, resuming after the last key exported.
+_EXPORT_ALL = text(
+    _EXPORT_COLUMNS + """
+        WHERE (wishlist_id, user_id, book_id) > (:wishlist_id, :user_id, :book_id)
+        ORDER BY wishlist_id, user_id, book_id
+        LIMIT :page_size
+    """
+).bindparams(
+    bindparam("wishlist_id", type_=UUID(as_uuid=True)),
+    bindparam("user_id", type_=UUID(as_uuid=True)),
+    bindparam("book_id", type_=UUID(as_uuid=True))
+)
+
+_EXPORT_USER = text(
+    _EXPORT_COLUMNS + """
+        WHERE user_id = :user_id AND (wishlist_id, book_id) > (:wishlist_id, :book_id)
+        ORDER BY wishlist_id, book_id
+        LIMIT :page_size
+    """
+).bindparams(
+    bindparam("wishlist_id", type_=UUID(as_uuid=True)),
+    bindparam("user_id", type_=UUID(as_uuid=True)),
+    bindparam("book_id", type_=UUID(as_uuid=True))
+)
+
+EXPORT_START = (uuid.UUID(int=0), uuid.UUID(int=0), uuid.UUID(int=0))
+
+
+def iter_wishlist_export(
+    user_id: str = None,
+    after: tuple = EXPORT_START,
+    fetch_size: int = 1000,
+    page_size: int = 50000
+):
+    """Iterate over every wishlist entry and its book, for one user or for all users, in key order.
+
+    Rows are read through a server-side cursor `fetch_size` at a time, so memory use does not depend
+    on how much is exported. Each page of `page_size` rows is read in its own transaction, so no
+    snapshot or lock is held for the whole export.
+
+    Args:
+        user_id (str, optional): uuid of a user to export, exports all users if not provided.
+        after (tuple, optional): (wishlist_id, user_id, book_id) key of the last row already
+                                 exported. Defaults to the start of the table.
+        fetch_size (int, optional): rows fetched from the server at a time. Defaults to 1000.
+        page_size (int, optional): rows read per transaction. Defaults to 50000.
+
+    Yields:
+        (dict): wishlist_id, user_id, book_id and the book's fields for one wishlist entry.
+    """
+    query = _EXPORT_ALL if user_id is None else _EXPORT_USER
+    wishlist_id, after_user_id, book_id = after
+    while True:
+        params = {
+            "wishlist_id": wishlist_id,
+            "user_id": after_user_id if user_id is None else user_id,
+            "book_id": book_id,
+            "page_size": page_size
+        }
+        res = db.session.connection().\
+            execution_options(stream_results=True).\
+            execute(query, params)
+        keys = res.keys()
+        page_rows = 0
+        try:
+            while rows := res.fetchmany(fetch_size):
+                page_rows += len(rows)
+                for row in rows:
+                    yield dict(zip(keys, row))
+                wishlist_id, after_user_id, book_id = rows[-1][:3]
+        finally:
+            res.close()
+            # End the page's transaction so the export doesn't pin a snapshot between pages.
+            db.session.commit()
+
+        if page_rows < page_size:
+            return
+
+
+def _record_change(wishlist_id: str, user_id: str, book_id: str, op: str):
+    """Append an entry to the wishlist change log and count it towards the book's popularity, within
+    the caller's transaction.
+
+    Args:
+        wishlist_id (str): uuid of a wishlist
+        user_id (str): uuid of the user the wishlist belongs to
+        book_id (str): uuid of a book
+        op (str): one of `CHANGE_ADD`, `CHANGE_REMOVE`
     """
-    res = db.session.execute(
-        wishlists.\
-            delete().\
-                where(wishlists.c.wishlist_id == wishlist_id).\
-                where(wishlists.c.book_id == book_id)
+    db.session.execute(
+        _RECORD_CHANGE,
+        {
+            "wishlist_id": wishlist_id,
+            "lock_id": wishlist_id,
+            "user_id": user_id,
+            "book_id": book_id,
+            "op": op,
+            "delta": _CHANGE_DELTAS[op]
+        }
     )
+
+
+def list_wishlist_changes(
+    wishlist_id: str,
+    since: int = 0,
+    limit: int = 1000,
+    owner_id: str = None
+) -> dict:
+    """Get the changes made to a wishlist after the given cursor, oldest first.
+
+    Args:
+        wishlist_id (str): uuid of a wishlist
+        since (int, optional): cursor of the last change the client has applied. Defaults to 0.
+        limit (int, optional): maximum number of changes to return. Defaults to 1000.
+        owner_id (str, optional): only list the changes if the wishlist belongs to this user, as
+                                  recorded in its log, so that a wishlist that has since been emptied
+                                  is still found. Defaults to None.
+
+    Raises:
+        WishlistNotFound: The wishlist does not belong to `owner_id`.
+        ChangeCursorExpired: Changes after `since` have been compacted, the client must resync.
+
+    Returns:
+        (dict): Dictionary composed of wishlist_id, the cursor to resume from, whether more changes
+                are waiting and the changes themselves.
+    """
+    latest, horizon, owned = execute_prepared(
+        db.session, _LATEST_CHANGE, {"wishlist_id": wishlist_id, "owner_id": owner_id}
+    ).fetchone()
+    if not owned:
+        raise WishlistNotFound("No wishlist entries for given `wishlist_id`")
+    if horizon is not None and since < horizon:
+        raise ChangeCursorExpired(
+            "Changes after the given cursor have been compacted.",
+            cursor=latest if latest is not None else horizon
+        )
+
+    rows = execute_prepared(
+        db.session, _LIST_CHANGES, {"wishlist_id": wishlist_id, "since": since, "limit": limit}
+    ).fetchall()
+
+    return {
+        "wishlist_id": wishlist_id,
+        "cursor": rows[-1][0] if rows else since,
+        "has_more": len(rows) == limit,
+        "changes": [
+            {"cursor": change_id, "op": op, "book_id": book_id}
+            for change_id, op, book_id in rows
+        ]
+    }
+
+
+def compact_wishlist_changes(retention: timedelta, batch_size: int = 10000) -> int:
+    """Delete change log entries older than the retention period, committing after each batch.
+
+    Args:
+        retention (timedelta): how long to keep change log entries for.
+        batch_size (int, optional): entries deleted per transaction. Defaults to 10000.
+
+    Returns:
+        int: number of entries deleted.
+    """
+    total = 0
+    while True:
+        deleted = db.session.execute(
+            _COMPACT_CHANGES, {"retention": retention, "batch_size": batch_size}
+        ).scalar()
+        db.session.commit()
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+
+def list_popular_books(window: timedelta = None, limit: int = 100) -> list:
+    """Rank books by how many wishlists they are on, or by how many times they were added to
+    wishlists, net of removals, within a recent window.
+
+    Args:
+        window (timedelta, optional): rank by activity within this window, rounded out to whole
+                                      buckets. If not provided, rank by current wishlist count.
+        limit (int, optional): number of books to return. Defaults to 100.
+
+    Returns:
+        (list): books, most wishlisted first, each with its `wishlist_count`.
+    """
+    if window is None:
+        res = db.session.execute(_POPULAR_BOOKS, {"limit": limit})
+    else:
+        res = db.session.execute(_POPULAR_BOOKS_IN_WINDOW, {"window": window, "limit": limit})
+    keys = res.keys()
+    return [dict(zip(keys, row)) for row in res]
+
+
+def prune_popularity_buckets(retention: timedelta) -> int:
+    """Delete popularity buckets older than the retention period.
+
+    Args:
+        retention (timedelta): how long to keep buckets for, at least the longest ranking window.
+
+    Returns:
+        int: number of buckets deleted.
+    """
+    deleted = db.session.execute(_PRUNE_POPULARITY_BUCKETS, {"retention": retention}).rowcount
+    db.session.commit()
+    return deleted
+
+
+def rebuild_popularity():
+    """Recount book popularity from the `wishlists` table and the change log, in one transaction."""
+    for statement in _REBUILD_POPULARITY:
+        db.session.execute(statement, {"add": CHANGE_ADD})
+    db.session.commit()
+
@@ -0,0 +1,248 @@
+import uuid
+from itertools import groupby
+from typing import List
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import text
+
+from app import db
+from app.cache import wishlist_cache
+from app.models import (
+    _CHANGE_DELTAS,
+    _count_changes,
+    _DOCUMENT_ROWS,
+    _LOCK_WISHLISTS,
+    _model_error,
+    _refresh_wishlist_documents,
+    _track_changes,
+    _wishlist_from_rows,
+    CHANGE_ADD,
+    CHANGE_REMOVE,
+    get_uuid,
+    POSITION_GAP
+)
+from app.models.exceptions import WishlistEntryNotFound, WishlistNotFound
+
+"""
+Batches of wishlist operations, run in a single transaction.
+
+Operations are run in the order given, but consecutive operations of the same kind are grouped into
+a single statement: a run of adds is one multi-row insert, a run of removes one delete and a run of
+gets one select. Each operation gets its own result, either its outcome or the model exception that
+made it fail. If a grouped insert fails, its adds are retried one at a time, each in a savepoint, to
+find out which of them failed.
+
+An atomic batch stops at the first failed operation and rolls back everything. Otherwise the failed
+operations are skipped and the rest are committed.
+
+The grouped statements only log their changes. Book popularity is counted once for the whole batch at
+the end, in book order, so that two batches never lock counter rows in opposite orders.
+"""
+
+BATCH_ADD = "add"
+BATCH_REMOVE = "remove"
+BATCH_GET = "get"
+
+_BATCH_DELTAS = {
+    BATCH_ADD: _CHANGE_DELTAS[CHANGE_ADD],
+    BATCH_REMOVE: _CHANGE_DELTAS[CHANGE_REMOVE],
+}
+
+_BATCH_ADD = text(
+    """
+        WITH batch AS (
+            SELECT * FROM unnest(
+                CAST(:wishlist_ids AS uuid[]), CAST(:user_ids AS uuid[]), CAST(:book_ids AS uuid[])
+            ) WITH ORDINALITY AS batch (wishlist_id, user_id, book_id, ord)
+        ), added AS (
+            INSERT INTO wishlists (wishlist_id, user_id, book_id, position)
+            SELECT wishlist_id, user_id, book_id,
+                COALESCE(
+                    (SELECT max(position) FROM wishlists WHERE wishlists.wishlist_id = batch.wishlist_id),
+                    0
+                ) + :gap * row_number() OVER (PARTITION BY wishlist_id ORDER BY ord)
+            FROM batch
+            -- Never add to a wishlist that belongs to another user.
+            WHERE NOT EXISTS (
+                SELECT 1 FROM wishlists AS owned
+                WHERE owned.wishlist_id = batch.wishlist_id AND owned.user_id <> batch.user_id
+            )
+            RETURNING wishlist_id, user_id, book_id
+        ), {track_changes}
+        SELECT wishlist_id, book_id FROM added
+    """.format(track_changes=_track_changes("added", count=False))
+)
+
+_BATCH_REMOVE = text(
+    """
+        WITH batch AS (
+            SELECT * FROM unnest(CAST(:wishlist_ids AS uuid[]), CAST(:book_ids AS uuid[]))
+            AS batch (wishlist_id, book_id)
+        ), removed AS (
+            DELETE FROM wishlists USING batch
+            WHERE wishlists.wishlist_id = batch.wishlist_id AND wishlists.book_id = batch.book_id
+            AND wishlists.user_id = COALESCE(CAST(:owner_id AS uuid), wishlists.user_id)
+            RETURNING wishlists.wishlist_id, wishlists.user_id, wishlists.book_id
+        ), {track_changes}
+        SELECT wishlist_id, book_id FROM removed
+    """.format(track_changes=_track_changes("removed", count=False))
+)
+
+_COUNT_BATCH = text(
+    """
+        WITH deltas AS (
+            SELECT * FROM unnest(CAST(:book_ids AS uuid[]), CAST(:deltas AS bigint[]))
+            AS deltas (book_id, delta)
+        ), {count_changes}
+        SELECT count(*) FROM deltas
+    """.format(count_changes=_count_changes("deltas", "sum(delta)"))
+)
+
+
+def _normalize(operation: dict) -> dict:
+    """Give an add without a `wishlist_id` a new wishlist and bring every id to its canonical form,
+    so that every spelling of an id groups, locks and matches as the same id.
+    """
+    normalized = dict(operation)
+    if normalized["op"] == BATCH_ADD and not normalized.get("wishlist_id"):
+        normalized["wishlist_id"] = get_uuid()
+    for key in ("wishlist_id", "user_id", "book_id"):
+        if normalized.get(key) is not None:
+            normalized[key] = str(uuid.UUID(str(normalized[key])))
+    return normalized
+
+
+def _ids(operations: list, key: str) -> list:
+    return [operation[key] for _, operation in operations]
+
+
+def _add_entries(operations: list, results: list, owner_id: str):
+    params = {
+        "wishlist_ids": _ids(operations, "wishlist_id"),
+        "user_ids": _ids(operations, "user_id"),
+        "book_ids": _ids(operations, "book_id"),
+        "gap": POSITION_GAP,
+        # Any of the batch's wishlists will do, every one of them is already locked.
+        "lock_id": operations[0][1]["wishlist_id"],
+        "op": CHANGE_ADD
+    }
+    try:
+        with db.session.begin_nested():
+            added = {
+                (str(wishlist_id), str(book_id))
+                for wishlist_id, book_id in db.session.execute(_BATCH_ADD, params)
+            }
+    except IntegrityError as e:
+        if len(operations) == 1:
+            results[operations[0][0]] = _model_error(e)
+            return
+        for operation in operations:
+            _add_entries([operation], results, owner_id)
+        return
+
+    for i, operation in operations:
+        if (operation["wishlist_id"], operation["book_id"]) in added:
+            results[i] = {key: operation[key] for key in ("wishlist_id", "user_id", "book_id")}
+        else:
+            results[i] = WishlistNotFound("Wishlist belongs to another user.")
+
+
+def _remove_entries(operations: list, results: list, owner_id: str):
+    params = {
+        "wishlist_ids": _ids(operations, "wishlist_id"),
+        "book_ids": _ids(operations, "book_id"),
+        "owner_id": owner_id,
+        "lock_id": operations[0][1]["wishlist_id"],
+        "op": CHANGE_REMOVE
+    }
+    removed = {
+        (str(wishlist_id), str(book_id))
+        for wishlist_id, book_id in db.session.execute(_BATCH_REMOVE, params)
+    }
+    for i, operation in operations:
+        entry = (operation["wishlist_id"], operation["book_id"])
+        if entry in removed:
+            # Repeats of a remove within the batch find nothing left to remove.
+            removed.discard(entry)
+            results[i] = {"wishlist_id": entry[0], "book_id": entry[1]}
+        else:
+            results[i] = WishlistEntryNotFound("Book is not on the given wishlist.")
+
+
+def _get_wishlists(operations: list, results: list, owner_id: str):
+    res = db.session.execute(_DOCUMENT_ROWS, {"wishlist_ids": _ids(operations, "wishlist_id")})
+    keys = res.keys()
+    rows_by_wishlist = {}
+    for row in res:
+        rows_by_wishlist.setdefault(str(row[0]), []).append(row)
+
+    for i, operation in operations:
+        rows = rows_by_wishlist.get(operation["wishlist_id"])
+        if rows is None or (owner_id is not None and str(rows[0][1]) != owner_id):
+            results[i] = WishlistNotFound("No wishlist entries for given `wishlist_id`")
+        else:
+            results[i] = _wishlist_from_rows(keys, rows)
+
+
+_RUNNERS = {
+    BATCH_ADD: _add_entries,
+    BATCH_REMOVE: _remove_entries,
+    BATCH_GET: _get_wishlists,
+}
+
+
+def run_batch(operations: List[dict], atomic: bool = True, owner_id: str = None) -> list:
+    """Run a batch of wishlist operations in a single transaction.
+
+    Args:
+        operations (List[dict]): validated operations, each with an `op` of `BATCH_ADD`,
+                                 `BATCH_REMOVE` or `BATCH_GET` and that operation's keys. Adds
+                                 without a `wishlist_id` create a new wishlist.
+        atomic (bool, optional): roll back the whole batch if any operation fails. Defaults to True.
+        owner_id (str, optional): only remove from and get wishlists that belong to this user, others
+                                  are not found. Defaults to None.
+
+    Returns:
+        list: the result of each operation, in order, or the model exception it failed with. An
+              atomic batch that failed is rolled back and its results end at the failed operation.
+    """
+    operations = [_normalize(operation) for operation in operations]
+    if owner_id is not None:
+        owner_id = str(uuid.UUID(str(owner_id)))
+    written = sorted({
+        operation["wishlist_id"] for operation in operations if operation["op"] != BATCH_GET
+    })
+    if written:
+        # Every wishlist the batch writes to is locked up front, the locks `_LOG_CHANGES` takes
+        # again below are then already held.
+        db.session.execute(_LOCK_WISHLISTS, {"wishlist_ids": written})
+
+    results = [None] * len(operations)
+    changed = set()
+    deltas = {}
+    for op, group in groupby(enumerate(operations), key=lambda item: item[1]["op"]):
+        group = list(group)
+        _RUNNERS[op](group, results, owner_id)
+
+        failed = [i for i, _ in group if isinstance(results[i], Exception)]
+        if atomic and failed:
+            db.session.rollback()
+            return results[:failed[0] + 1]
+        if op == BATCH_GET:
+            continue
+        for i, operation in group:
+            if i not in failed:
+                changed.add(operation["wishlist_id"])
+                deltas[operation["book_id"]] = deltas.get(operation["book_id"], 0) + _BATCH_DELTAS[op]
+
+    # Books an add and a remove cancelled out for are left alone, their counters need no lock.
+    counted = sorted(book_id for book_id, delta in deltas.items() if delta)
+    if counted:
+        db.session.execute(
+            _COUNT_BATCH, {"book_ids": counted, "deltas": [deltas[book_id] for book_id in counted]}
+        )
+    _refresh_wishlist_documents(sorted(changed))
+    db.session.commit()
+    for wishlist_id in changed:
+        wishlist_cache.invalidate(wishlist_id)
+    return results
@@ -2,6 +2,13 @@ class BookNotFound(Exception):
     pass
 
 
+class ChangeCursorExpired(Exception):
+    def __init__(self, message: str, cursor: int = None):
+        super().__init__(message)
+        # Cursor a client can resume syncing from once it has re-fetched the whole wishlist.
+        self.cursor = cursor
+
+
 class UserNotFound(Exception):
     pass
 
@@ -12,3 +19,7 @@ class WishlistNotFound(Exception):
 
 class WishlistEntryAlreadyExists(Exception):
     pass
+
+
+class WishlistEntryNotFound(Exception):
+    pass
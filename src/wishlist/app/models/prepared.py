@@ -0,0 +1,72 @@
+import re
+from typing import Dict
+
+from flask import current_app
+from sqlalchemy.sql import bindparam, text
+from sqlalchemy.types import TypeEngine
+
+"""
+Server-side prepared statements for the hottest queries.
+
+psycopg2 sends every statement as plain SQL, so Postgres parses and plans it again on each request.
+A `PreparedStatement` is prepared once per database connection with `PREPARE` and then run with
+`EXECUTE`, which skips parsing and lets Postgres reuse a generic plan. Prepared statements belong to
+the database session, so this must be turned off with `SQLALCHEMY_PREPARED_STATEMENTS=false` behind a
+connection pooler that shares server connections between clients, such as PgBouncer in transaction
+mode. On other databases statements are executed as usual.
+"""
+
+_PARAM = re.compile(r"(?<!:):(\w+)")
+
+
+class PreparedStatement(object):
+    def __init__(self, name: str, sql: str, params: Dict[str, str], **bind_types: TypeEngine):
+        """
+        Args:
+            name (str): name of the prepared statement, unique across the application.
+            sql (str): statement with `:name` style parameters.
+            params (Dict[str, str]): Postgres type of each parameter, in the order they should be
+                                     declared.
+            bind_types (TypeEngine): SQLAlchemy types used to bind parameters, by name.
+        """
+        self.name = name
+        binds = [bindparam(key, type_=type_) for key, type_ in bind_types.items()]
+
+        # The plain statement, for databases without prepared statement support.
+        self.statement = text(sql).bindparams(*binds)
+
+        positions = {key: i for i, key in enumerate(params, start=1)}
+        self.prepare = text(
+            "PREPARE {name} ({types}) AS {sql}".format(
+                name=name,
+                types=", ".join(params.values()),
+                sql=_PARAM.sub(lambda match: f"${positions[match.group(1)]}", sql)
+            )
+        )
+        self.execute = text(
+            "EXECUTE {name} ({args})".format(name=name, args=", ".join(f":{key}" for key in params))
+        ).bindparams(*binds)
+
+
+def execute_prepared(session, statement: PreparedStatement, params: dict):
+    """Execute a prepared statement, preparing it first if this connection hasn't yet.
+
+    Args:
+        session: database session to execute on.
+        statement (PreparedStatement): statement to execute
+        params (dict): statement parameters
+
+    Returns:
+        ResultProxy: statement result
+    """
+    conn = session.connection()
+    if conn.dialect.name != "postgresql" or not current_app.config["SQLALCHEMY_PREPARED_STATEMENTS"]:
+        return conn.execute(statement.statement, params)
+
+    # `info` lives as long as the underlying DBAPI connection, and is reset if it is replaced.
+    # Prepared statements are not transactional, they survive a rollback.
+    prepared = conn.connection.info.setdefault("prepared_statements", set())
+    if statement.name not in prepared:
+        conn.execute(statement.prepare)
+        prepared.add(statement.name)
+    return conn.execute(statement.execute, params)
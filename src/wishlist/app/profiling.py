@@ -0,0 +1,161 @@
+import cProfile
+import hashlib
+import hmac
+import io
+import os
+import pstats
+import re
+from logging import getLogger
+from random import random
+from time import time
+from uuid import uuid4
+
+from flask import Flask, Response, current_app, g, request
+
+"""
+On-demand profiling of single requests.
+
+A request is profiled with cProfile when it is picked by `PROFILING_SAMPLE_RATE` or when it carries
+a valid `X-Profile` header, a short-lived token signed with `SECRET_KEY` and issued by
+`python manage.py profile_token`. The profile covers everything from the first `before_request`
+hook to the last `after_request` hook: validation, queries, serialization and compression. The body
+of a streamed response is produced after that and is not included.
+
+Stats are written to `PROFILING_DIR` as `<endpoint>.<request id>.prof`, readable with `pstats` or
+snakeviz, and the request id is returned in the `X-Profile-Id` header. A request profiled through
+the header can ask for `X-Profile-Output: inline` instead, which replaces the response body with a
+text report. Requests that are not profiled only pay for a header lookup and, when sampling is
+enabled, a random number.
+"""
+
+_LOGGER = getLogger(__name__)
+
+PROFILE_HEADER = "X-Profile"
+OUTPUT_HEADER = "X-Profile-Output"
+_REQUEST_ID = re.compile(r"^[\w-]{1,64}$")
+
+
+class InvalidProfileToken(Exception):
+    pass
+
+
+def _sign(expires: int) -> str:
+    # Namespaced so a profiling token can never be mistaken for a bearer token, or vice versa.
+    key = current_app.config["SECRET_KEY"].encode()
+    return hmac.new(key, f"profile:{expires}".encode(), hashlib.sha256).hexdigest()
+
+
+def issue_profile_token(ttl: int = 300) -> str:
+    """Issue a token that enables profiling of the requests that send it as `X-Profile`.
+
+    Args:
+        ttl (int): number of seconds the token is valid for
+
+    Returns:
+        str: token
+    """
+    expires = int(time() + ttl)
+    return f"{expires}.{_sign(expires)}"
+
+
+def verify_profile_token(token: str):
+    """Verify a profiling token's signature and expiry.
+
+    Args:
+        token (str): token issued by `issue_profile_token`
+
+    Raises:
+        InvalidProfileToken: The token is malformed, has been tampered with or has expired.
+    """
+    expires, _, signature = token.partition(".")
+    if not expires.isdigit() or not signature:
+        raise InvalidProfileToken("malformed token")
+    if not hmac.compare_digest(_sign(int(expires)), signature):
+        raise InvalidProfileToken("invalid token signature")
+    if int(expires) <= time():
+        raise InvalidProfileToken("token has expired")
+
+
+def _request_id() -> str:
+    request_id = request.headers.get("X-Request-ID", "")
+    # The id ends up in a file name, so only accept ids that are safe there.
+    return request_id if _REQUEST_ID.match(request_id) else uuid4().hex
+
+
+class RequestProfiler(object):
+    def init_app(self, app: Flask):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def _should_profile(self) -> tuple:
+        """Decide whether to profile the current request.
+
+        Returns:
+            tuple: whether to profile and whether the client asked for the stats inline.
+        """
+        token = request.headers.get(PROFILE_HEADER)
+        if token is not None:
+            try:
+                verify_profile_token(token)
+            except InvalidProfileToken as e:
+                _LOGGER.info(f"profiling: ignoring {PROFILE_HEADER} header, {e}")
+            else:
+                inline = (
+                    request.headers.get(OUTPUT_HEADER) == "inline"
+                    or not current_app.config["PROFILING_DIR"]
+                )
+                return True, inline
+
+        config = current_app.config
+        rate = config["PROFILING_SAMPLE_RATE"]
+        return rate > 0 and bool(config["PROFILING_DIR"]) and random() < rate, False
+
+    def _before_request(self):
+        profile, inline = self._should_profile()
+        if not profile:
+            return
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already running, e.g. for a concurrent request.
+            _LOGGER.info("profiling: skipping request, a profiler is already active")
+            return
+        g.profiler = profiler
+        g.profile_inline = inline
+
+    def _after_request(self, response: Response) -> Response:
+        profiler = g.pop("profiler", None)
+        if profiler is None:
+            return response
+        profiler.disable()
+
+        request_id = _request_id()
+        endpoint = request.endpoint or "unmatched"
+        response.headers["X-Profile-Id"] = request_id
+        if g.pop("profile_inline"):
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(50)
+            response.set_data(f"{endpoint} {request_id}\n{report.getvalue()}")
+            response.mimetype = "text/plain"
+            response.headers.pop("Content-Encoding", None)
+            return response
+
+        directory = current_app.config["PROFILING_DIR"]
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{endpoint}.{request_id}.prof")
+        profiler.dump_stats(path)
+        _LOGGER.info(f"profiling: saved profile of {endpoint} to {path}")
+        return response
+
+    def _teardown_request(self, exc):
+        # The request failed before `after_request`, don't leave the profiler running.
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            profiler.disable()
+            g.pop("profile_inline", None)
+
+
+request_profiler = RequestProfiler()
@@ -0,0 +1,161 @@
+import re
+from collections import Counter
+from contextlib import contextmanager
+from logging import getLogger
+from typing import Callable, List
+
+from flask import Flask, Response, current_app, g, has_app_context, request
+from sqlalchemy import event
+
+from app import db
+
+"""
+Development-mode query budgets for API endpoints.
+
+An endpoint that quietly starts issuing one query per row, e.g. by touching a lazy relationship such
+as `User.wishlists` in a loop, still passes its tests and only shows up as latency in production.
+When `QUERY_BUDGET_ENABLED` is set, every statement a request sends to the database is recorded. At
+the end of the request the count is checked against the endpoint's budget, declared on the view with
+`@query_budget(n)` or falling back to `QUERY_BUDGET_DEFAULT`, and statements of the same shape that
+were run more than `QUERY_BUDGET_REPEAT_LIMIT` times are reported as a likely N+1 pattern. Violations
+are logged, or raised as `QueryBudgetExceeded` with `QUERY_BUDGET_RAISE`. Streamed responses keep
+querying after the response has started, so they are checked at teardown and only ever logged.
+
+`PREPARE` statements are not counted, they are run once per connection rather than per request.
+"""
+
+_LOGGER = getLogger(__name__)
+
+# Bound parameters are already placeholders, this folds any inlined literals into the same shape.
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+_WHITESPACE = re.compile(r"\s+")
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_budget(limit: int) -> Callable:
+    """Declare the maximum number of statements a view may issue per request.
+
+    Args:
+        limit (int): statement budget for the view
+    """
+    def decorator(fn):
+        fn.query_budget = limit
+        return fn
+    return decorator
+
+
+def statement_shape(statement: str) -> str:
+    """Normalize a statement so that executions differing only in their values compare equal.
+
+    Args:
+        statement (str): SQL sent to the database
+
+    Returns:
+        str: statement with literals replaced by `?` and whitespace collapsed.
+    """
+    return _WHITESPACE.sub(" ", _LITERAL.sub("?", statement)).strip()
+
+
+class QueryReport(object):
+    def __init__(self, endpoint: str, budget: int, statements: List[str]):
+        self.endpoint = endpoint
+        self.budget = budget
+        self.statements = statements
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+    @property
+    def over_budget(self) -> bool:
+        return self.count > self.budget
+
+    def repeated(self, limit: int) -> dict:
+        """Find the statement shapes run more than `limit` times.
+
+        Args:
+            limit (int): number of executions of one shape considered normal
+
+        Returns:
+            dict: number of executions by statement shape.
+        """
+        shapes = Counter(statement_shape(statement) for statement in self.statements)
+        return {shape: count for shape, count in shapes.items() if count > limit}
+
+
+class QueryBudgetMonitor(object):
+    def __init__(self):
+        self._recorders = []
+
+    def init_app(self, app: Flask):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        event.listen(db.get_engine(app), "before_cursor_execute", self._before_cursor_execute)
+
+    @contextmanager
+    def record(self):
+        """Collect the report of every request checked while the context is open.
+
+        Yields:
+            List[QueryReport]: reports, in the order the requests finished.
+        """
+        reports = []
+        self._recorders.append(reports)
+        try:
+            yield reports
+        finally:
+            self._recorders.remove(reports)
+
+    def _budget(self) -> int:
+        view = current_app.view_functions.get(request.endpoint)
+        return getattr(view, "query_budget", current_app.config["QUERY_BUDGET_DEFAULT"])
+
+    def _before_request(self):
+        if current_app.config["QUERY_BUDGET_ENABLED"]:
+            g.query_statements = []
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # Background tasks run in their own app context, so only the request's statements are seen.
+        if not has_app_context():
+            return
+        statements = g.get("query_statements")
+        if statements is not None and not statement.lstrip().startswith("PREPARE"):
+            statements.append(statement)
+
+    def _after_request(self, response: Response) -> Response:
+        if not response.is_streamed and "query_statements" in g:
+            self._check(g.pop("query_statements"), raise_errors=True)
+        return response
+
+    def _teardown_request(self, exc):
+        statements = g.pop("query_statements", None)
+        if statements is not None:
+            self._check(statements, raise_errors=False)
+
+    def _check(self, statements: List[str], raise_errors: bool):
+        if request.endpoint is None:
+            return
+
+        config = current_app.config
+        report = QueryReport(request.endpoint, self._budget(), statements)
+        for reports in self._recorders:
+            reports.append(report)
+
+        for shape, count in report.repeated(config["QUERY_BUDGET_REPEAT_LIMIT"]).items():
+            _LOGGER.warning(f"query budget: {report.endpoint} ran the same statement {count} times: {shape}")
+
+        if report.over_budget:
+            message = (
+                f"query budget: {report.endpoint} issued {report.count} statements, "
+                f"budget is {report.budget}"
+            )
+            if config["QUERY_BUDGET_RAISE"] and raise_errors:
+                raise QueryBudgetExceeded(message)
+            _LOGGER.warning(message)
+
+
+query_monitor = QueryBudgetMonitor()
@@ -2,15 +2,94 @@ from logging import getLogger
 from typing import Dict, List
 from uuid import UUID
 
-from flask import Blueprint, jsonify, make_response, request
+from flask import (
+    Blueprint,
+    Response,
+    current_app,
+    g,
+    jsonify,
+    make_response,
+    request,
+    stream_with_context
+)
 
-from app.models import insert_wishlist_entry, list_wishlist_entries, remove_wishlist_entry
-from app.models.exceptions import BookNotFound, UserNotFound, WishlistNotFound
+from app import db
+from app.admission import admission
+from app.auth import issue_token, token_required
+from app.cache import CachedResponse, popular_books_cache, wishlist_cache
+from app.compression import negotiate_encoding, set_encoded_body
+from app.deadlines import DeadlineExceeded, deadline
+from app.export import FORMATS, parse_checkpoint, serialize
+from app.models import (
+    clone_wishlist,
+    POPULARITY_WINDOWS,
+    find_user_by_credentials,
+    get_wishlist_document,
+    EXPORT_START,
+    insert_wishlist_entry,
+    iter_wishlist_export,
+    list_popular_books,
+    list_wishlist_changes,
+    list_wishlist_entries,
+    move_wishlist_entry,
+    remove_wishlist_entries,
+    remove_wishlist_entry,
+    render_wishlist
+)
+from app.models.batch import BATCH_ADD, BATCH_GET, BATCH_REMOVE, run_batch
+from app.models.exceptions import (
+    BookNotFound,
+    ChangeCursorExpired,
+    UserNotFound,
+    WishlistEntryAlreadyExists,
+    WishlistEntryNotFound,
+    WishlistNotFound
+)
+from app.query_budget import query_budget
 
 
 bp = Blueprint("api", __name__)
 _LOGGER = getLogger(__name__)
 
+# Required and optional keys of each kind of `/batch` operation, the same as their single endpoints.
+_BATCH_KEYS = {
+    BATCH_ADD: (["book_id", "user_id"], ["wishlist_id"]),
+    BATCH_REMOVE: (["wishlist_id", "book_id"], []),
+    BATCH_GET: (["wishlist_id"], []),
+}
+_BATCH_MODES = ("atomic", "best_effort")
+
+# Response for each exception a batch operation can fail with, mirroring the single endpoints.
+_BATCH_ERRORS = {
+    BookNotFound: ("Could not find book for given `book_id`.", 400),
+    UserNotFound: ("Could not find user for given `user_id`.", 400),
+    WishlistEntryAlreadyExists: ("wishlist entry already exists", 409),
+    WishlistEntryNotFound: ("wishlist entry not found", 404),
+    WishlistNotFound: ("wishlist not found", 404),
+}
+
+# Largest values of the Postgres `bigint` and `integer` types, larger query parameters are rejected
+# rather than failing in the database.
+_BIGINT_MAX = 2 ** 63 - 1
+_INTEGER_MAX = 2 ** 31 - 1
+
+
+def _validate_int(value: str, minimum: int, maximum: int) -> str:
+    """Validate that a given value is a decimal integer within the given bounds.
+
+    Args:
+        value (str): Provided candidate string.
+        minimum (int): smallest accepted value.
+        maximum (int): largest accepted value.
+
+    Returns:
+        None: Candidate string is a valid integer.
+        str: error response
+    """
+    # `isdigit` alone also accepts e.g. superscripts, which `int` rejects.
+    if not (value.isascii() and value.isdigit()) or not minimum <= int(value) <= maximum:
+        return f"value for {{key}} must be an integer between {minimum} and {maximum}"
+
 
 def _validate_uuid(value: str) -> str:
     """Validate that a given value is valid UUID.
@@ -61,12 +140,54 @@ def _validate_payload(
                 return exc.format(key=key)
 
 
+def _is_caller(user_id: str) -> bool:
+    """Whether a valid user id taken from a request is the authenticated user's own."""
+    return UUID(user_id) == UUID(g.user_id)
+
+
+@bp.errorhandler(DeadlineExceeded)
+def handle_deadline_exceeded(e):
+    # The statement was cancelled or never sent, fail fast rather than retrying it.
+    db.session.rollback()
+    return "request deadline exceeded", 504
+
+
 @bp.route("/")
+@query_budget(0)
 def healthcheck():
-    return jsonify("OK"), 200
+    # Report saturation so the load balancer can route around an instance that is shedding load.
+    admission.probe_pool_wait()
+    saturation = admission.saturation()
+    status = "saturated" if saturation["saturated"] else "OK"
+    return jsonify(status=status, **saturation), 503 if saturation["saturated"] else 200
+
+
+@bp.route("/login", methods=["POST"])
+@query_budget(1)
+@deadline(2000)
+def login():
+    _LOGGER.debug("/login: request received")
+
+    payload = request.get_json(silent=True) or {}
+    email, password = payload.get("email"), payload.get("password")
+    if not isinstance(email, str) or not isinstance(password, str):
+        return "missing required keys: ['email', 'password']", 400
+
+    # The only place a password is checked, every other request authenticates with the token.
+    user = find_user_by_credentials(email, password)
+    if user is None:
+        return "invalid email or password", 401
+
+    return jsonify(
+        token=issue_token(user.id),
+        expires_in=current_app.config["AUTH_TOKEN_TTL_SECONDS"]
+    ), 200
 
 
 @bp.route("/wishlist_entry", methods=["POST", "DELETE"])
+@query_budget(3)
+@deadline(2000)
+@token_required
 def handle_wishlist_entry():
     _LOGGER.debug(f"/wishlist_entry: request received, method: {request.method}")
 
@@ -78,6 +199,8 @@ def handle_wishlist_entry():
             return f"missing required keys: {required_keys}", 400
         if (exc := _validate_payload(payload, required_keys, optional_keys=optional_keys)) is not None:
             return exc, 400
+        if not _is_caller(payload["user_id"]):
+            return "cannot add entries for another user", 403
 
         try:
             created_entry = insert_wishlist_entry(**payload)
@@ -85,6 +208,10 @@ def handle_wishlist_entry():
             return f"Could not find book for given `book_id`.", 400
         except UserNotFound:
             return f"Could not find user for given `user_id`.", 400
+        except WishlistNotFound:
+            return "wishlist not found", 404
+        except DeadlineExceeded:
+            raise
         except Exception:
             _LOGGER.exception("/wishlist_entry: Unhandled exception during entry creation.")
             return "internal server error", 500
@@ -104,26 +231,353 @@ def handle_wishlist_entry():
             return exc, 400
 
         try:
-            # Currently, repeated calls to DELETE will always provide a 200, even if the resource
-            # doesn't exist. We could potentially perform a check to see if the resource exists and
-            # return a 404.
-            remove_wishlist_entry(payload["wishlist_id"], payload["book_id"])
-            return "OK", 200
+            removed = remove_wishlist_entry(
+                payload["wishlist_id"], payload["book_id"], owner_id=g.user_id
+            )
+        except DeadlineExceeded:
+            raise
         except Exception:
-            _LOGGER.exception("/wishlist_entry: Unhandled exception during entry creation.")
+            _LOGGER.exception("/wishlist_entry: Unhandled exception during entry removal.")
             return "internal server error", 500
 
+        if not removed:
+            return "wishlist entry not found", 404
+        return "OK", 200
+
+
+@bp.route("/wishlist/<string:wishlist_id>", methods=["DELETE"])
+@query_budget(2)
+@deadline(5000)
+@token_required
+def delete_wishlist(wishlist_id):
+    _LOGGER.debug("/wishlist: delete request received")
+
+    if (exc := _validate_uuid(wishlist_id)) is not None:
+        return exc.format(key="wishlist_id"), 400
+
+    # Either the listed books are deleted, or the whole wishlist with `?all=true`. Deleting everything
+    # has to be asked for explicitly, a body that fails to parse must never fall back to it.
+    delete_all = request.args.get("all")
+    if delete_all not in (None, "true"):
+        return "value for all must be true", 400
+
+    payload = {}
+    if request.get_data():
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict):
+            return "request body must be a JSON object", 400
+        if unknown_keys := sorted(set(payload) - {"book_ids"}):
+            return f"unknown keys: {unknown_keys}", 400
+
+    book_ids = payload.get("book_ids")
+    if (book_ids is None) == (delete_all is None):
+        return "either book_ids or all=true is required, but not both", 400
+    if book_ids is not None:
+        if not isinstance(book_ids, list) or not book_ids:
+            return "value for book_ids must be a non-empty list", 400
+        for book_id in book_ids:
+            if (exc := _validate_uuid(book_id)) is not None:
+                return exc.format(key="book_ids"), 400
+
+    try:
+        removed = remove_wishlist_entries(wishlist_id, book_ids=book_ids, owner_id=g.user_id)
+    except DeadlineExceeded:
+        raise
+    except Exception:
+        _LOGGER.exception("/wishlist: Unhandled exception during wishlist deletion.")
+        return "internal server error", 500
+
+    if not removed:
+        return "wishlist not found", 404
+    return jsonify(wishlist_id=wishlist_id, removed=removed), 200
+
+
+@bp.route("/wishlist/<string:wishlist_id>/clone", methods=["POST"])
+@query_budget(2)
+@deadline(5000)
+@token_required
+def post_clone_wishlist(wishlist_id):
+    _LOGGER.debug("/wishlist/clone: request received")
+
+    if (exc := _validate_uuid(wishlist_id)) is not None:
+        return exc.format(key="wishlist_id"), 400
+
+    optional_keys = ["user_id", "wishlist_id"]
+    payload = request.get_json(silent=True) or {}
+    if (exc := _validate_payload(payload, [], optional_keys=optional_keys)) is not None:
+        return exc, 400
+    if payload.get("user_id") is not None and not _is_caller(payload["user_id"]):
+        return "cannot clone a wishlist for another user", 403
+
+    try:
+        clone = clone_wishlist(
+            wishlist_id,
+            user_id=payload.get("user_id"),
+            new_wishlist_id=payload.get("wishlist_id"),
+            owner_id=g.user_id
+        )
+    except WishlistNotFound:
+        return "wishlist not found", 404
+    except UserNotFound:
+        return "Could not find user for given `user_id`.", 400
+    except WishlistEntryAlreadyExists:
+        return "Wishlist for given `wishlist_id` already has entries for these books.", 409
+    except DeadlineExceeded:
+        raise
+    except Exception:
+        _LOGGER.exception("/wishlist/clone: Unhandled exception during wishlist clone.")
+        return "internal server error", 500
+
+    res = make_response(jsonify(clone), 201)
+    res.headers["Location"] = f"/wishlist/{clone['wishlist_id']}"
+    return res
+
+
+@bp.route("/wishlist/<string:wishlist_id>/move", methods=["POST"])
+@query_budget(3)
+@deadline(2000)
+@token_required
+def post_move_wishlist_entry(wishlist_id):
+    _LOGGER.debug("/wishlist/move: request received")
+
+    if (exc := _validate_uuid(wishlist_id)) is not None:
+        return exc.format(key="wishlist_id"), 400
+
+    required_keys = ["book_id"]
+    optional_keys = ["after_book_id"]
+    payload = request.get_json(silent=True) or {}
+    if (exc := _validate_payload(payload, required_keys, optional_keys=optional_keys)) is not None:
+        return exc, 400
+    if payload.get("after_book_id") == payload["book_id"]:
+        return "a book cannot be moved after itself", 400
+
+    try:
+        position = move_wishlist_entry(
+            wishlist_id,
+            payload["book_id"],
+            after_book_id=payload.get("after_book_id"),
+            owner_id=g.user_id
+        )
+    except WishlistEntryNotFound:
+        return "wishlist entry not found", 404
+    except DeadlineExceeded:
+        raise
+    except Exception:
+        _LOGGER.exception("/wishlist/move: Unhandled exception during entry move.")
+        return "internal server error", 500
+
+    return jsonify(wishlist_id=wishlist_id, book_id=payload["book_id"], position=position), 200
+
 
 @bp.route("/wishlist/<string:wishlist_id>", methods=["GET"])
+@query_budget(1)
+@deadline(1000)
+@token_required
 def get_wishlist(wishlist_id):
     _LOGGER.debug("/wishlist: request received")
     
     if (exc := _validate_uuid(wishlist_id)) is not None:
         return exc.format(key="wishlist_id"), 400
 
+    # Another user's wishlist is not found, whether or not it is cached.
+    entry = wishlist_cache.get(wishlist_id, owner_id=g.user_id)
+    if entry is None:
+        generation = wishlist_cache.generation()
+        try:
+            if current_app.config["WISHLIST_MATERIALIZE"]:
+                body = get_wishlist_document(wishlist_id, owner_id=g.user_id)
+            else:
+                body = render_wishlist(list_wishlist_entries(wishlist_id, owner_id=g.user_id))
+        except WishlistNotFound:
+            return "wishlist not found", 404
+        entry = wishlist_cache.set(wishlist_id, body, generation, owner_id=g.user_id)
+
+    return _cached_response(entry), 200
+
+
+def _cached_response(entry: CachedResponse) -> Response:
+    """Build a JSON response from a cached body, reusing its compressed form if one exists.
+
+    Args:
+        entry (CachedResponse): cached response body
+
+    Returns:
+        Response: JSON response, compressed according to the request's `Accept-Encoding`.
+    """
+    res = Response(mimetype="application/json")
+    encoding = negotiate_encoding(len(entry.body))
+    if encoding is None:
+        set_encoded_body(res, entry.body, None)
+    else:
+        set_encoded_body(res, entry.encoded(encoding), encoding)
+    return res
+
+
+@bp.route("/wishlist/<string:wishlist_id>/changes", methods=["GET"])
+@query_budget(2)
+@deadline(1000)
+@token_required
+def get_wishlist_changes(wishlist_id):
+    _LOGGER.debug("/wishlist/changes: request received")
+
+    if (exc := _validate_uuid(wishlist_id)) is not None:
+        return exc.format(key="wishlist_id"), 400
+
+    max_page_size = current_app.config["CHANGE_FEED_MAX_PAGE_SIZE"]
+    since = request.args.get("since", "0")
+    limit = request.args.get("limit", str(max_page_size))
+    if (exc := _validate_int(since, 0, _BIGINT_MAX)) is not None:
+        return exc.format(key="since"), 400
+    if (exc := _validate_int(limit, 1, min(max_page_size, _INTEGER_MAX))) is not None:
+        return exc.format(key="limit"), 400
+
     try:
-        wishlist = list_wishlist_entries(wishlist_id)
+        changes = list_wishlist_changes(
+            wishlist_id, since=int(since), limit=int(limit), owner_id=g.user_id
+        )
     except WishlistNotFound:
         return "wishlist not found", 404
+    except ChangeCursorExpired as e:
+        # The client has to re-fetch the whole wishlist, then it can resume from `cursor`.
+        return jsonify(error="cursor expired, full resync required", cursor=e.cursor), 410
+
+    return jsonify(changes), 200
+
+
+@bp.route("/export", methods=["GET"])
+# Exports stream for as long as they need to, unless the client sets a deadline.
+@deadline(None)
+@token_required
+def export_wishlists():
+    _LOGGER.debug("/export: request received")
+
+    # Only the caller's own wishlists, every user's are exported with `python manage.py export`.
+    user_id = request.args.get("user_id", g.user_id)
+    if (exc := _validate_uuid(user_id)) is not None:
+        return exc.format(key="user_id"), 400
+    if not _is_caller(user_id):
+        return "cannot export another user's wishlists", 403
+
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in FORMATS:
+        return f"value for format must be one of {list(FORMATS)}", 400
+
+    after = EXPORT_START
+    if (checkpoint := request.args.get("after")) is not None:
+        try:
+            after = parse_checkpoint(checkpoint)
+        except ValueError as e:
+            return f"invalid value for after: {e}", 400
+
+    config = current_app.config
+    records = iter_wishlist_export(
+        user_id=user_id,
+        after=after,
+        fetch_size=config["EXPORT_FETCH_SIZE"],
+        page_size=config["EXPORT_PAGE_SIZE"]
+    )
+    # A resumed CSV export is appended to what the client already has, so skip the header.
+    chunks = serialize(records, fmt, header=checkpoint is None)
+    return Response(
+        stream_with_context(chunk for chunk, _ in chunks),
+        mimetype=FORMATS[fmt]
+    )
+
+
+@bp.route("/books/popular", methods=["GET"])
+@query_budget(1)
+@deadline(1000)
+def get_popular_books():
+    _LOGGER.debug("/books/popular: request received")
+
+    window = request.args.get("window", "all")
+    if window not in POPULARITY_WINDOWS:
+        return f"value for window must be one of {list(POPULARITY_WINDOWS)}", 400
+
+    max_limit = current_app.config["POPULAR_BOOKS_MAX_LIMIT"]
+    limit = request.args.get("limit", "10")
+    if not limit.isdigit() or not 0 < int(limit) <= max_limit:
+        return f"value for limit must be an integer between 1 and {max_limit}", 400
+
+    # The top `POPULAR_BOOKS_MAX_LIMIT` books are kept in memory, every limit is a slice of them.
+    books = popular_books_cache.get(
+        window,
+        lambda: list_popular_books(window=POPULARITY_WINDOWS[window], limit=max_limit)
+    )
+    return jsonify(window=window, books=books[:int(limit)]), 200
+
+
+def _validate_batch(payload: dict) -> str:
+    """Validate a `/batch` payload and every operation in it.
+
+    Args:
+        payload (dict): payload received in request
+
+    Returns:
+        None: No errors encountered, is valid
+        str: We've encountered a validation error and should return it.
+    """
+    mode = payload.get("mode", "atomic")
+    if mode not in _BATCH_MODES:
+        return f"value for mode must be one of {list(_BATCH_MODES)}"
+
+    operations = payload.get("operations")
+    max_operations = current_app.config["BATCH_MAX_OPERATIONS"]
+    if not isinstance(operations, list) or not 0 < len(operations) <= max_operations:
+        return f"value for operations must be a list of 1 to {max_operations} operations"
+
+    for i, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get("op") not in _BATCH_KEYS:
+            return f"operations[{i}]: value for op must be one of {list(_BATCH_KEYS)}"
+        required_keys, optional_keys = _BATCH_KEYS[operation["op"]]
+        if (exc := _validate_payload(operation, required_keys, optional_keys=optional_keys)) is not None:
+            return f"operations[{i}]: {exc}"
+
+
+def _batch_result(result) -> dict:
+    if not isinstance(result, Exception):
+        return {"status": "ok", "result": result}
+    error, status = _BATCH_ERRORS.get(type(result), ("internal server error", 500))
+    return {"status": "error", "code": status, "error": error}
+
+
+@bp.route("/batch", methods=["POST"])
+@query_budget(100)
+@deadline(5000)
+@token_required
+def post_batch():
+    _LOGGER.debug("/batch: request received")
+
+    payload = request.get_json(silent=True) or {}
+    if (exc := _validate_batch(payload)) is not None:
+        return exc, 400
+    for i, operation in enumerate(payload["operations"]):
+        if operation["op"] == BATCH_ADD and not _is_caller(operation["user_id"]):
+            return f"operations[{i}]: cannot add entries for another user", 403
+
+    # Only keep the keys each operation is known to take.
+    operations = []
+    for operation in payload["operations"]:
+        required_keys, optional_keys = _BATCH_KEYS[operation["op"]]
+        keys = [*required_keys, *optional_keys]
+        operations.append({"op": operation["op"], **{key: operation.get(key) for key in keys}})
+
+    atomic = payload.get("mode", "atomic") == "atomic"
+    try:
+        results = run_batch(operations, atomic=atomic, owner_id=g.user_id)
+    except DeadlineExceeded:
+        raise
+    except Exception:
+        _LOGGER.exception("/batch: Unhandled exception during batch.")
+        return "internal server error", 500
+
+    for result in results:
+        if isinstance(result, Exception) and type(result) not in _BATCH_ERRORS:
+            _LOGGER.error(f"/batch: Unhandled exception during batch: {result!r}")
+
+    if atomic and isinstance(results[-1], Exception):
+        # Nothing was committed, the results end at the operation that failed.
+        failed = _batch_result(results[-1])
+        return jsonify(committed=False, failed_operation=len(results) - 1, **failed), failed["code"]
 
-    return jsonify(wishlist), 200
+    return jsonify(committed=True, results=[_batch_result(result) for result in results]), 200
@@ -0,0 +1,53 @@
+from logging import getLogger
+from queue import Queue
+from threading import Lock, Thread
+from typing import Callable
+
+from flask import current_app
+
+"""
+A minimal in-process background task runner.
+
+Tasks are run one at a time on a daemon thread, each inside an app context of the app that submitted
+it so they can use the database session. Tasks are not persisted: anything still queued when the
+process exits is lost, so tasks should be safe to re-run from a `manage.py` command.
+"""
+
+_LOGGER = getLogger(__name__)
+
+
+class BackgroundTasks(object):
+    def __init__(self):
+        self._queue = Queue()
+        self._lock = Lock()
+        self._worker = None
+
+    def submit(self, fn: Callable, *args):
+        """Queue a function to be run in the background.
+
+        Args:
+            fn (Callable): function to run, called with `args`.
+        """
+        self._queue.put((current_app._get_current_object(), fn, args))
+        with self._lock:
+            if self._worker is None:
+                self._worker = Thread(target=self._run, name="background-tasks", daemon=True)
+                self._worker.start()
+
+    def join(self):
+        """Block until every queued task has run."""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            app, fn, args = self._queue.get()
+            try:
+                with app.app_context():
+                    fn(*args)
+            except Exception:
+                _LOGGER.exception(f"background task {fn.__name__} failed")
+            finally:
+                self._queue.task_done()
+
+
+background_tasks = BackgroundTasks()
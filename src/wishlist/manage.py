@@ -1,7 +1,31 @@
+import os
+import timeit
+from datetime import timedelta
+
+import click
+from flask import current_app
 from flask.cli import FlaskGroup
+from sqlalchemy.sql import bindparam, select
 
 from app import create_app
-from app.models import db, User, Book
+from app import auth
+from app.auth import authenticate, issue_token
+from app.export import FORMATS, parse_checkpoint, serialize
+from app.profiling import issue_profile_token
+from app.models import (
+    compact_wishlist_changes,
+    db,
+    EXPORT_START,
+    iter_wishlist_export,
+    list_wishlist_entries,
+    POPULARITY_WINDOWS,
+    prune_popularity_buckets,
+    rebuild_popularity,
+    rebuild_wishlist_documents,
+    User,
+    Book,
+    wishlists
+)
 from tests.data import USER_1, BOOK_1, BOOK_2
 
 
@@ -25,5 +49,143 @@ def seed_db():
     db.session.commit()
 
 
+@cli.command("compact_changes")
+@click.option("--retention-hours", type=float, default=None, help="Defaults to CHANGE_LOG_RETENTION_HOURS.")
+def compact_changes(retention_hours):
+    if retention_hours is None:
+        retention_hours = current_app.config["CHANGE_LOG_RETENTION_HOURS"]
+    deleted = compact_wishlist_changes(timedelta(hours=retention_hours))
+    click.echo(f"Compacted {deleted} wishlist change log entries.")
+
+
+@cli.command("prune_popularity")
+def prune_popularity():
+    # Keep enough buckets to answer the longest ranking window.
+    retention = max(window for window in POPULARITY_WINDOWS.values() if window is not None)
+    deleted = prune_popularity_buckets(retention + timedelta(hours=1))
+    click.echo(f"Pruned {deleted} book popularity buckets.")
+
+
+@cli.command("rebuild_popularity")
+def rebuild_popularity_counts():
+    rebuild_popularity()
+    click.echo("Rebuilt book popularity counts.")
+
+
+@cli.command("rebuild_documents")
+def rebuild_documents():
+    if not current_app.config["WISHLIST_MATERIALIZE"]:
+        raise click.ClickException("WISHLIST_MATERIALIZE is not enabled.")
+    rebuilt = rebuild_wishlist_documents()
+    click.echo(f"Rebuilt {rebuilt} wishlist documents.")
+
+
+@cli.command("export")
+@click.option("--user-id", default=None, help="Export a single user's wishlists.")
+@click.option("--format", "fmt", type=click.Choice(list(FORMATS)), default="ndjson")
+@click.option("--output", type=click.Path(dir_okay=False), required=True)
+@click.option(
+    "--checkpoint-file",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Record progress here, an export with an existing checkpoint is resumed."
+)
+def export(user_id, fmt, output, checkpoint_file):
+    # The checkpoint file holds the checkpoint of the last record on disk and the size of the output
+    # up to and including that record.
+    after, offset = EXPORT_START, 0
+    if checkpoint_file and os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as f:
+            checkpoint, offset = f.read().split()
+        after, offset = parse_checkpoint(checkpoint), int(offset)
+    resuming = after != EXPORT_START
+
+    records = iter_wishlist_export(
+        user_id=user_id,
+        after=after,
+        fetch_size=current_app.config["EXPORT_FETCH_SIZE"],
+        page_size=current_app.config["EXPORT_PAGE_SIZE"]
+    )
+    # Binary, so that positions are byte offsets.
+    with open(output, "r+b" if resuming else "wb") as out:
+        # Drop whatever was written after the last checkpoint, a partial chunk or a whole one whose
+        # checkpoint was never recorded, so resuming neither duplicates nor tears records.
+        out.truncate(offset)
+        out.seek(offset)
+        for chunk, checkpoint in serialize(records, fmt, header=not resuming):
+            out.write(chunk.encode())
+            if checkpoint_file and checkpoint:
+                # Only record progress once the chunk is safely on disk, and replace the checkpoint
+                # file atomically so that a crash never leaves it half written.
+                out.flush()
+                os.fsync(out.fileno())
+                with open(f"{checkpoint_file}.tmp", "w") as f:
+                    f.write(f"{checkpoint}\n{out.tell()}\n")
+                os.replace(f"{checkpoint_file}.tmp", checkpoint_file)
+
+
+@cli.command("bench_auth")
+@click.option("--number", type=int, default=100000)
+def bench_auth(number):
+    """Report the per-request cost of authenticating a bearer token."""
+    token = issue_token(USER_1["id"])
+    header = f"Bearer {token}"
+
+    def uncached():
+        auth._claims_cache.pop(token, None)
+        authenticate(header)
+
+    for name, fn in (("uncached (HMAC)", uncached), ("cached claims", lambda: authenticate(header))):
+        fn()
+        per_call = timeit.timeit(fn, number=number) / number
+        click.echo(f"{name}: {per_call * 1e6:.2f} us/request")
+
+
+@cli.command("profile_token")
+@click.option("--ttl", type=int, default=300, help="Seconds the token stays valid.")
+def profile_token(ttl):
+    """Issue a token that profiles the requests sending it in the `X-Profile` header."""
+    click.echo(issue_profile_token(ttl))
+
+
+@cli.command("bench_queries")
+@click.option("--wishlist-id", required=True)
+@click.option("--number", type=int, default=1000)
+def bench_queries(wishlist_id, number):
+    """Report the per-call cost of loading a wishlist: with a statement built and compiled on every
+    call, as before statements were cached, with one built once and compiled once, and with and
+    without prepared statements.
+    """
+    def build():
+        books = Book.__table__
+        return select([wishlists.c.wishlist_id, wishlists.c.user_id, books]).\
+            select_from(wishlists.join(books, wishlists.c.book_id == books.c.id)).\
+            where(wishlists.c.wishlist_id == bindparam("wishlist_id")).\
+            order_by(wishlists.c.position, wishlists.c.book_id)
+
+    cached = build()
+    params = {"wishlist_id": wishlist_id}
+    statements = (
+        ("fresh statement", lambda: db.session.execute(build(), params).fetchall()),
+        ("cached statement", lambda: db.session.execute(cached, params).fetchall()),
+    )
+    for name, fn in statements:
+        fn()
+        per_call = timeit.timeit(fn, number=number) / number
+        click.echo(f"{name}: {per_call * 1e6:.2f} us/call")
+
+    config = current_app.config
+    original = config["SQLALCHEMY_PREPARED_STATEMENTS"]
+    try:
+        for name, prepared in (("plain", False), ("prepared", True)):
+            config["SQLALCHEMY_PREPARED_STATEMENTS"] = prepared
+            list_wishlist_entries(wishlist_id)
+            per_call = timeit.timeit(lambda: list_wishlist_entries(wishlist_id), number=number) / number
+            click.echo(f"{name}: {per_call * 1e6:.2f} us/call")
+    finally:
+        config["SQLALCHEMY_PREPARED_STATEMENTS"] = original
+        db.session.rollback()
+
+
 if __name__ == "__main__":
     cli()
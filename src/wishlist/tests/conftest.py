@@ -3,6 +3,7 @@ from datetime import date
 import pytest
 
 from app import create_app, db
+from app.auth import issue_token
 from app.models import get_uuid, Book, User
 from data import BOOK_1, BOOK_2, USER_1
 
@@ -11,15 +12,21 @@ Reference for structuring tests:
 https://www.patricksoftwareblog.com/testing-a-flask-application-using-pytest/
 """
 
+TEST_SECRET_KEY = "test-secret-key"
+
+
 @pytest.fixture(scope="module")
 def test_client():
-    app = create_app()
+    app = create_app({"SECRET_KEY": TEST_SECRET_KEY})
     test_client = app.test_client()
 
     # This is the app context that will be used for testing.
     ctx = app.app_context()
     ctx.push()
 
+    # Authenticate every request as the sample user unless a test sends its own `Authorization`.
+    test_client.environ_base["HTTP_AUTHORIZATION"] = f"Bearer {issue_token(USER_1['id'])}"
+
     yield test_client
     ctx.pop()
 
@@ -38,3 +45,49 @@ def test_db():
     # Have to explicitly close the database session, otherwise the tests will hang.
     db.session.close()
     db.drop_all()
+
+
+class ConfigOverrides(object):
+    """App config for a single test, every key set through it is restored when the test ends."""
+
+    def __init__(self, config):
+        self._config = config
+        self._original = {}
+
+    def __getitem__(self, key):
+        return self._config[key]
+
+    def __setitem__(self, key, value):
+        self._original.setdefault(key, self._config[key])
+        self._config[key] = value
+
+    def restore(self):
+        self._config.update(self._original)
+        self._original.clear()
+
+
+@pytest.fixture
+def app_config(test_client):
+    """Override app config for a single test: `app_config["KEY"] = value`."""
+    overrides = ConfigOverrides(test_client.application.config)
+    yield overrides
+    overrides.restore()
+
+
+@pytest.fixture
+def materialize(app_config):
+    """Enable materialized wishlist documents for a single test."""
+    app_config["WISHLIST_MATERIALIZE"] = True
+
+
+@pytest.fixture
+def query_budget(app_config):
+    """Fail any request that goes over its endpoint's query budget, yielding the per-request reports
+    so a test can also assert on the exact statements.
+    """
+    from app.query_budget import query_monitor
+
+    app_config["QUERY_BUDGET_ENABLED"] = True
+    app_config["QUERY_BUDGET_RAISE"] = True
+    with query_monitor.record() as reports:
+        yield reports
@@ -0,0 +1,97 @@
+import pytest
+
+from app import db
+from app.admission import admission, READ, TimedQueuePool, WRITE
+from app.models import get_uuid
+from data import BOOK_1, USER_1
+
+
+@pytest.fixture
+def admission_config(app_config):
+    """Reset the measured pool wait after a test has faked it, along with any limits it tightened."""
+    yield app_config
+    admission.pool_wait_ms = 0.0
+
+
+def test_healthcheck_reports_saturation(test_client, test_db):
+    res = test_client.get("/")
+    assert res.status_code == 200
+    assert res.json["status"] == "OK"
+    assert res.json["in_flight"] == {READ: 0, WRITE: 0}
+    for key in ("limits", "pool_wait_ms", "saturated"):
+        assert key in res.json
+
+
+def test_admitted_requests_are_released(test_client, test_db):
+    res = test_client.get(f"/wishlist/{get_uuid()}")
+    assert res.status_code == 404
+    assert admission.in_flight == {READ: 0, WRITE: 0}
+
+
+def test_sheds_writes_over_budget(test_client, test_db, admission_config):
+    admission_config["ADMISSION_MAX_IN_FLIGHT_WRITES"] = 0
+    admission_config["ADMISSION_RETRY_AFTER_SECONDS"] = 7
+
+    res = test_client.post(
+        "/wishlist_entry",
+        json={"book_id": BOOK_1["id"], "user_id": USER_1["id"]}
+    )
+    assert res.status_code == 503
+    assert res.headers["Retry-After"] == "7"
+
+    # Reads have their own budget and are still admitted.
+    res = test_client.get(f"/wishlist/{get_uuid()}")
+    assert res.status_code == 404
+
+    res = test_client.get("/")
+    assert res.status_code == 503
+    assert res.json["status"] == "saturated"
+
+
+def test_slow_pool_admits_single_probe(test_client, test_db, admission_config):
+    admission_config["ADMISSION_MAX_POOL_WAIT_MS"] = 10
+    admission.pool_wait_ms = 1000
+    # Requests share the tests' session, release its connection so that the probe checks out its own.
+    test_db.session.commit()
+
+    # Another read is already waiting on the pool, so this one is shed.
+    admission.in_flight[READ] += 1
+    try:
+        res = test_client.get(f"/wishlist/{get_uuid()}")
+        assert res.status_code == 503
+    finally:
+        admission.in_flight[READ] -= 1
+
+    # With nothing in flight, the request is let through as a probe and its fast pool checkout
+    # pulls the moving average back down.
+    res = test_client.get(f"/wishlist/{get_uuid()}")
+    assert res.status_code == 404
+    assert admission.pool_wait_ms < 1000
+
+
+def test_requests_without_queries_skip_the_pool(test_client, test_db, admission_config):
+    assert isinstance(db.engine.pool, TimedQueuePool)
+    admission.pool_wait_ms = 5.0
+
+    # Rejected before it queries anything, so it neither checks out a connection nor waits on one.
+    res = test_client.get("/wishlist/fred")
+    assert res.status_code == 400
+    assert admission.pool_wait_ms == 5.0
+
+
+def test_healthcheck_recovers_without_traffic(test_client, test_db, admission_config):
+    admission_config["ADMISSION_MAX_POOL_WAIT_MS"] = 1000
+    admission.pool_wait_ms = 5000
+
+    # No request is admitted, the health check's own pool checkouts bring the average back down.
+    statuses = [test_client.get("/").status_code for _ in range(20)]
+    assert statuses[0] == 503
+    assert statuses[-1] == 200
+    assert admission.pool_wait_ms <= 1000
+
+
+def test_admission_disabled(test_client, test_db, admission_config):
+    admission_config["ADMISSION_CONTROL_ENABLED"] = False
+    admission_config["ADMISSION_MAX_IN_FLIGHT_READS"] = 0
+    res = test_client.get(f"/wishlist/{get_uuid()}")
+    assert res.status_code == 404
@@ -0,0 +1,182 @@
+import json
+
+import pytest
+
+from app import auth, create_app
+from app.auth import InvalidToken, authenticate, issue_token, verify_token
+from app.cache import wishlist_cache
+from app.config import Config
+from app.models import get_uuid, insert_wishlist_entry, User
+from data import BOOK_1, BOOK_2, USER_1
+
+
+def test_login(test_client, test_db):
+    res = test_client.post(
+        "/login",
+        json={"email": USER_1["email"], "password": USER_1["raw_password"]}
+    )
+    assert res.status_code == 200
+    assert verify_token(res.json["token"])["sub"] == USER_1["id"]
+    assert res.json["expires_in"] > 0
+
+    res = test_client.get(
+        f"/wishlist/{get_uuid()}",
+        headers={"Authorization": f"Bearer {res.json['token']}"}
+    )
+    assert res.status_code == 404
+
+
+@pytest.mark.parametrize(
+    "payload,exp_status",
+    [
+        pytest.param({"email": USER_1["email"], "password": "wrong"}, 401, id="wrong password"),
+        pytest.param({"email": "nobody@example.com", "password": "secret"}, 401, id="unknown email"),
+        pytest.param({"email": USER_1["email"]}, 400, id="missing password"),
+        pytest.param({}, 400, id="missing all keys"),
+    ]
+)
+def test_login_fails(payload, exp_status, test_client, test_db):
+    res = test_client.post("/login", json=payload)
+    assert res.status_code == exp_status
+    assert "token" not in (res.json or {})
+
+
+def test_secret_key_required_outside_development(monkeypatch):
+    monkeypatch.setattr(Config, "SECRET_KEY", None)
+    monkeypatch.setenv("FLASK_ENV", "production")
+    with pytest.raises(RuntimeError, match="SECRET_KEY"):
+        create_app()
+    assert create_app({"SECRET_KEY": "s3cr3t"}).config["SECRET_KEY"] == "s3cr3t"
+
+    monkeypatch.setenv("FLASK_ENV", "dev")
+    assert create_app().config["SECRET_KEY"]
+
+
+def test_verify_token_caches_claims(test_client, monkeypatch):
+    token = issue_token(USER_1["id"])
+    assert verify_token(token)["sub"] == USER_1["id"]
+
+    def fail(token):
+        raise AssertionError("signature checked again")
+
+    monkeypatch.setattr(auth, "_verify_signature", fail)
+    assert authenticate(f"Bearer {token}")["sub"] == USER_1["id"]
+
+
+def test_expired_token(test_client, app_config):
+    app_config["AUTH_TOKEN_TTL_SECONDS"] = -1
+    token = issue_token(USER_1["id"])
+    with pytest.raises(InvalidToken, match="expired"):
+        verify_token(token)
+    # The claims are cached, expiry is still enforced on a cache hit.
+    with pytest.raises(InvalidToken, match="expired"):
+        verify_token(token)
+
+
+@pytest.mark.parametrize(
+    "authorization",
+    [
+        pytest.param("", id="missing"),
+        pytest.param("Basic Zm9vOmJhcg==", id="wrong scheme"),
+        pytest.param("Bearer fred", id="malformed"),
+        pytest.param("Bearer eyJzdWIiOiJmcmVkIn0.c2lnbmF0dXJl", id="bad signature"),
+    ]
+)
+def test_protected_routes_require_token(authorization, test_client):
+    wishlist_id = get_uuid()
+    requests = [
+        ("GET", f"/wishlist/{wishlist_id}"),
+        ("GET", f"/wishlist/{wishlist_id}/changes"),
+        ("DELETE", f"/wishlist/{wishlist_id}"),
+        ("POST", f"/wishlist/{wishlist_id}/clone"),
+        ("POST", f"/wishlist/{wishlist_id}/move"),
+        ("POST", "/batch"),
+        ("POST", "/wishlist_entry"),
+        ("DELETE", "/wishlist_entry"),
+        ("GET", "/export"),
+    ]
+    for method, path in requests:
+        res = test_client.open(path, method=method, headers={"Authorization": authorization})
+        assert res.status_code == 401
+        assert res.headers["WWW-Authenticate"].startswith("Bearer")
+
+
+def test_tampered_token_rejected(test_client):
+    signature = issue_token(USER_1["id"]).partition(".")[2]
+    other_payload = issue_token(get_uuid()).partition(".")[0]
+    with pytest.raises(InvalidToken, match="signature"):
+        verify_token(f"{other_payload}.{signature}")
+
+
+@pytest.fixture
+def other_user(test_db) -> User:
+    user = User(email="other@example.com", raw_password="0therS3cr3t")
+    test_db.session.add(user)
+    test_db.session.commit()
+    return user
+
+
+def test_wishlists_belong_to_their_owner(test_client, test_db, other_user, app_config):
+    app_config["WISHLIST_CACHE_TTL_SECONDS"] = 60
+    wishlist_id = get_uuid()
+    for book in [BOOK_1, BOOK_2]:
+        insert_wishlist_entry(USER_1["id"], book["id"], wishlist_id=wishlist_id)
+    other_wishlist_id = get_uuid()
+    insert_wishlist_entry(other_user.id, BOOK_1["id"], wishlist_id=other_wishlist_id)
+    # Cached for its owner, which must not make it visible to anyone else.
+    assert test_client.get(f"/wishlist/{wishlist_id}").status_code == 200
+
+    other_id = str(other_user.id)
+    requests = [
+        ("GET", f"/wishlist/{wishlist_id}", None, 404),
+        ("GET", f"/wishlist/{wishlist_id}/changes", None, 404),
+        ("POST", f"/wishlist/{wishlist_id}/move", {"book_id": BOOK_2["id"]}, 404),
+        ("POST", f"/wishlist/{wishlist_id}/clone", None, 404),
+        ("POST", f"/wishlist/{other_wishlist_id}/clone", {"wishlist_id": wishlist_id}, 404),
+        ("POST", f"/wishlist/{other_wishlist_id}/clone", {"user_id": USER_1["id"]}, 403),
+        ("DELETE", "/wishlist_entry", {"wishlist_id": wishlist_id, "book_id": BOOK_1["id"]}, 404),
+        ("DELETE", f"/wishlist/{wishlist_id}?all=true", None, 404),
+        (
+            "POST",
+            "/wishlist_entry",
+            {"wishlist_id": wishlist_id, "user_id": other_id, "book_id": BOOK_1["id"]},
+            404
+        ),
+        ("POST", "/wishlist_entry", {"user_id": USER_1["id"], "book_id": BOOK_1["id"]}, 403),
+        (
+            "POST",
+            "/batch",
+            {"operations": [{"op": "add", "user_id": USER_1["id"], "book_id": BOOK_1["id"]}]},
+            403
+        ),
+        ("GET", f"/export?user_id={USER_1['id']}", None, 403),
+    ]
+    headers = {"Authorization": f"Bearer {issue_token(other_id)}"}
+    try:
+        for method, path, payload, exp_status in requests:
+            res = test_client.open(path, method=method, json=payload, headers=headers)
+            assert res.status_code == exp_status, (method, path, payload)
+
+        res = test_client.post(
+            "/batch",
+            json={
+                "mode": "best_effort",
+                "operations": [
+                    {"op": "add", "wishlist_id": wishlist_id, "user_id": other_id, "book_id": BOOK_1["id"]},
+                    {"op": "remove", "wishlist_id": wishlist_id, "book_id": BOOK_1["id"]},
+                    {"op": "get", "wishlist_id": wishlist_id},
+                ]
+            },
+            headers=headers
+        )
+        assert [result.get("code") for result in res.json["results"]] == [404, 404, 404]
+
+        # The export is scoped to the caller.
+        res = test_client.get("/export", headers=headers)
+        assert {record["user_id"] for record in map(json.loads, res.data.decode().splitlines())} == {other_id}
+
+        res = test_client.get(f"/wishlist/{wishlist_id}")
+        assert [book["id"] for book in res.json["books"]] == [BOOK_1["id"], BOOK_2["id"]]
+        assert res.json["user_id"] == USER_1["id"]
+    finally:
+        wishlist_cache.clear()
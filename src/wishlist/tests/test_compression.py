@@ -0,0 +1,91 @@
+import gzip
+
+import brotli
+import pytest
+
+import app.cache
+from app.cache import wishlist_cache
+from app.models import get_uuid, insert_wishlist_entry
+from data import BOOK_1, BOOK_2, USER_1
+
+
+@pytest.fixture
+def compression_config(app_config):
+    """Compress responses of any size, and drop the bodies a test has cached."""
+    app_config["COMPRESSION_MIN_SIZE"] = 1
+    yield app_config
+    wishlist_cache.clear()
+
+
+@pytest.fixture
+def wishlist_id(test_client, test_db):
+    wishlist_id = get_uuid()
+    for book in [BOOK_1, BOOK_2]:
+        insert_wishlist_entry(USER_1["id"], book["id"], wishlist_id=wishlist_id)
+    return wishlist_id
+
+
+@pytest.mark.parametrize(
+    "accept_encoding,exp_encoding",
+    [
+        pytest.param("gzip", "gzip", id="gzip"),
+        pytest.param("gzip, br", "br", id="prefer brotli"),
+        pytest.param("br;q=0.5, gzip", "gzip", id="quality values"),
+        pytest.param("identity", None, id="identity"),
+        pytest.param("", None, id="no header"),
+    ]
+)
+def test_get_wishlist_negotiates_encoding(
+    accept_encoding, exp_encoding, wishlist_id, compression_config, test_client
+):
+    res = test_client.get(f"/wishlist/{wishlist_id}", headers={"Accept-Encoding": accept_encoding})
+    assert res.status_code == 200
+    assert res.headers.get("Content-Encoding") == exp_encoding
+    assert "Accept-Encoding" in res.headers["Vary"]
+
+    body = res.data
+    if exp_encoding == "gzip":
+        body = gzip.decompress(body)
+    elif exp_encoding == "br":
+        body = brotli.decompress(body)
+    assert wishlist_id.encode() in body
+
+
+def test_small_responses_not_compressed(wishlist_id, compression_config, test_client):
+    compression_config["COMPRESSION_MIN_SIZE"] = 1024 * 1024
+    res = test_client.get(f"/wishlist/{wishlist_id}", headers={"Accept-Encoding": "gzip"})
+    assert res.status_code == 200
+    assert "Content-Encoding" not in res.headers
+
+
+def test_compressed_body_cached(wishlist_id, compression_config, test_client, monkeypatch):
+    compression_config["WISHLIST_CACHE_TTL_SECONDS"] = 60
+    calls = []
+
+    def counting_compress(data, encoding):
+        calls.append(encoding)
+        return gzip.compress(data)
+
+    monkeypatch.setattr(app.cache, "compress", counting_compress)
+
+    for _ in range(3):
+        res = test_client.get(f"/wishlist/{wishlist_id}", headers={"Accept-Encoding": "gzip"})
+        assert res.status_code == 200
+        assert res.headers["Content-Encoding"] == "gzip"
+    assert calls == ["gzip"]
+
+    # A write to the wishlist invalidates the cached bodies.
+    insert_wishlist_entry(USER_1["id"], BOOK_1["id"], wishlist_id=get_uuid())
+    assert wishlist_cache.get(wishlist_id, owner_id=USER_1["id"]) is not None
+    test_client.delete("/wishlist_entry", json={"wishlist_id": wishlist_id, "book_id": BOOK_1["id"]})
+    assert wishlist_cache.get(wishlist_id, owner_id=USER_1["id"]) is None
+
+    res = test_client.get(f"/wishlist/{wishlist_id}", headers={"Accept-Encoding": "gzip"})
+    assert len(gzip.decompress(res.data)) > 0
+    assert calls == ["gzip", "gzip"]
+
+
+def test_compression_disabled(wishlist_id, compression_config, test_client):
+    compression_config["COMPRESSION_ENABLED"] = False
+    res = test_client.get(f"/wishlist/{wishlist_id}", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in res.headers
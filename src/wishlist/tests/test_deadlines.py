@@ -0,0 +1,55 @@
+from time import monotonic, sleep
+
+import pytest
+
+import app.routes
+from app import db
+from app.deadlines import remaining_ms
+from app.models import get_uuid
+
+
+def _slow_query(wishlist_id, owner_id=None):
+    db.session.execute("SELECT pg_sleep(2)")
+
+
+def test_slow_query_cancelled_at_deadline(test_client, test_db, monkeypatch):
+    monkeypatch.setattr(app.routes, "list_wishlist_entries", _slow_query)
+
+    start = monotonic()
+    res = test_client.get(f"/wishlist/{get_uuid()}", headers={"X-Request-Timeout-Ms": "100"})
+    assert res.status_code == 504
+    assert b"deadline exceeded" in res.data
+    assert monotonic() - start < 1
+
+    # The timeout only applied to the request's transaction.
+    assert db.session.execute("SHOW statement_timeout").scalar() == "0"
+
+
+def test_no_statement_after_deadline(test_client, test_db, monkeypatch):
+    def slow_view(wishlist_id, owner_id=None):
+        sleep(0.1)
+        return _slow_query(wishlist_id)
+
+    monkeypatch.setattr(app.routes, "list_wishlist_entries", slow_view)
+    res = test_client.get(f"/wishlist/{get_uuid()}", headers={"X-Request-Timeout-Ms": "50"})
+    assert res.status_code == 504
+
+
+def test_client_cannot_extend_deadline(test_client, test_db, monkeypatch):
+    remaining = []
+
+    def view(wishlist_id, owner_id=None):
+        remaining.append(remaining_ms())
+        return {"wishlist_id": wishlist_id, "user_id": get_uuid(), "books": []}
+
+    monkeypatch.setattr(app.routes, "list_wishlist_entries", view)
+    res = test_client.get(f"/wishlist/{get_uuid()}", headers={"X-Request-Timeout-Ms": "600000"})
+    assert res.status_code == 200
+    assert 0 < remaining[0] <= 1000
+
+
+@pytest.mark.parametrize("timeout", ["0", "-1", "fred"])
+def test_invalid_timeout_header(timeout, test_client):
+    res = test_client.get(f"/wishlist/{get_uuid()}", headers={"X-Request-Timeout-Ms": timeout})
+    assert res.status_code == 400
+    assert b"X-Request-Timeout-Ms" in res.data
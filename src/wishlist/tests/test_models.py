@@ -1,22 +1,46 @@
 import datetime
+import uuid
 
 import pytest
+from sqlalchemy.exc import OperationalError
 
 
 from data import BOOK_1, BOOK_2, USER_1
 from app.models import (
+    _LOCK_WISHLIST,
     Book,
+    CHANGE_ADD,
+    CHANGE_REMOVE,
+    clone_wishlist,
+    compact_wishlist_changes,
     get_uuid,
+    get_wishlist_document,
     insert_wishlist_entry,
+    iter_wishlist_export,
+    list_popular_books,
+    list_wishlist_changes,
     list_wishlist_entries,
+    move_wishlist_entry,
+    POSITION_GAP,
+    rebalance_wishlist_positions,
+    remove_wishlist_entries,
     remove_wishlist_entry,
+    POPULARITY_WINDOWS,
+    prune_popularity_buckets,
+    rebuild_popularity,
+    rebuild_wishlist_documents,
+    render_wishlist,
     User,
     wishlists
 )
+from app.models.batch import BATCH_ADD, BATCH_REMOVE, run_batch
+from app.tasks import background_tasks
 from app.models.exceptions import (
     BookNotFound,
+    ChangeCursorExpired,
     UserNotFound,
     WishlistEntryAlreadyExists,
+    WishlistEntryNotFound,
     WishlistNotFound
 )
 
@@ -291,3 +315,404 @@ def test_remove_nonexistent_wishlist_entry(test_client, test_db):
     new_book_id = get_uuid()
     remove_wishlist_entry(new_wishlist_id, new_book_id)
     assert True
+
+
+def test_list_wishlist_changes(test_client, test_db):
+    wishlist_id = get_uuid()
+    for book in [BOOK_1, BOOK_2]:
+        insert_wishlist_entry(USER_1["id"], book["id"], wishlist_id=wishlist_id)
+    remove_wishlist_entry(wishlist_id, BOOK_1["id"])
+    # Removing an entry that doesn't exist is not a change.
+    remove_wishlist_entry(wishlist_id, BOOK_1["id"])
+    test_db.session.commit()
+
+    res = list_wishlist_changes(wishlist_id)
+    assert [(c["op"], str(c["book_id"])) for c in res["changes"]] == [
+        (CHANGE_ADD, BOOK_1["id"]),
+        (CHANGE_ADD, BOOK_2["id"]),
+        (CHANGE_REMOVE, BOOK_1["id"]),
+    ]
+    assert res["cursor"] == res["changes"][-1]["cursor"]
+    assert res["has_more"] is False
+
+    # Resuming from a cursor only returns what changed after it.
+    first_page = list_wishlist_changes(wishlist_id, limit=1)
+    assert first_page["has_more"] is True
+    rest = list_wishlist_changes(wishlist_id, since=first_page["cursor"])
+    assert [c["op"] for c in rest["changes"]] == [CHANGE_ADD, CHANGE_REMOVE]
+
+    up_to_date = list_wishlist_changes(wishlist_id, since=res["cursor"])
+    assert up_to_date["changes"] == []
+    assert up_to_date["cursor"] == res["cursor"]
+
+
+def test_compacted_wishlist_changes_require_resync(test_client, test_db):
+    wishlist_id = get_uuid()
+    insert_wishlist_entry(USER_1["id"], BOOK_1["id"], wishlist_id=wishlist_id)
+    cursor = list_wishlist_changes(wishlist_id)["cursor"]
+
+    assert compact_wishlist_changes(datetime.timedelta(0), batch_size=1) >= 1
+
+    # A client that had already synced everything that was compacted can carry on.
+    assert list_wishlist_changes(wishlist_id, since=cursor)["changes"] == []
+
+    with pytest.raises(ChangeCursorExpired) as exc_info:
+        list_wishlist_changes(wishlist_id, since=0)
+    assert exc_info.value.cursor == cursor
+
+
+def test_iter_wishlist_export(test_client, test_db):
+    user = User(email="exporter@example.com", raw_password="supers3cr3t")
+    test_db.session.add(user)
+    test_db.session.commit()
+    for _ in range(3):
+        wishlist_id = get_uuid()
+        for book in [BOOK_1, BOOK_2]:
+            insert_wishlist_entry(user.id, book["id"], wishlist_id=wishlist_id)
+
+    # Small pages and fetches so the export crosses several of each.
+    records = list(iter_wishlist_export(user_id=user.id, fetch_size=2, page_size=3))
+    assert len(records) == 6
+    assert {record["user_id"] for record in records} == {user.id}
+    keys = [(record["wishlist_id"], record["book_id"]) for record in records]
+    assert keys == sorted(keys)
+    for key in ("title", "author", "isbn", "publication_date"):
+        assert key in records[0]
+
+    # Resuming after a record picks up with the record that follows it.
+    last = records[3]
+    after = (last["wishlist_id"], last["user_id"], last["book_id"])
+    assert list(iter_wishlist_export(user_id=user.id, after=after)) == records[4:]
+
+    # Without a user, every user's wishlists are exported.
+    all_records = list(iter_wishlist_export(fetch_size=2, page_size=3))
+    assert len(all_records) > len(records)
+    all_keys = [(r["wishlist_id"], r["user_id"], r["book_id"]) for r in all_records]
+    assert all_keys == sorted(all_keys)
+
+
+def _create_wishlist(books=(BOOK_1, BOOK_2)) -> str:
+    wishlist_id = get_uuid()
+    for book in books:
+        insert_wishlist_entry(USER_1["id"], book["id"], wishlist_id=wishlist_id)
+    return wishlist_id
+
+
+def test_remove_wishlist_entry_reports_removal(test_client, test_db):
+    wishlist_id = _create_wishlist()
+    assert remove_wishlist_entry(wishlist_id, BOOK_1["id"]) is True
+    assert remove_wishlist_entry(wishlist_id, BOOK_1["id"]) is False
+
+
+def test_remove_wishlist_entries(test_client, test_db):
+    wishlist_id = _create_wishlist()
+    assert remove_wishlist_entries(wishlist_id, book_ids=[BOOK_1["id"], get_uuid()]) == 1
+    assert len(list_wishlist_entries(wishlist_id)["books"]) == 1
+
+    assert remove_wishlist_entries(wishlist_id) == 1
+    with pytest.raises(WishlistNotFound):
+        list_wishlist_entries(wishlist_id)
+    assert remove_wishlist_entries(wishlist_id) == 0
+
+    ops = [c["op"] for c in list_wishlist_changes(wishlist_id)["changes"]]
+    assert ops == [CHANGE_ADD, CHANGE_ADD, CHANGE_REMOVE, CHANGE_REMOVE]
+
+
+def test_clone_wishlist(test_client, test_db):
+    wishlist_id = _create_wishlist()
+    user = User(email="cloner@example.com", raw_password="supers3cr3t")
+    test_db.session.add(user)
+    test_db.session.commit()
+
+    clone = clone_wishlist(wishlist_id)
+    assert clone["copied"] == 2
+    assert clone["source_wishlist_id"] == wishlist_id
+    cloned = list_wishlist_entries(clone["wishlist_id"])
+    assert str(cloned["user_id"]) == USER_1["id"]
+    assert {str(book["id"]) for book in cloned["books"]} == {BOOK_1["id"], BOOK_2["id"]}
+    assert len(list_wishlist_changes(clone["wishlist_id"])["changes"]) == 2
+
+    other_user_clone = clone_wishlist(wishlist_id, user_id=user.id)
+    assert list_wishlist_entries(other_user_clone["wishlist_id"])["user_id"] == user.id
+
+    # The source wishlist is left untouched.
+    assert len(list_wishlist_entries(wishlist_id)["books"]) == 2
+
+
+def test_clone_wishlist_errors(test_client, test_db):
+    wishlist_id = _create_wishlist()
+    with pytest.raises(WishlistNotFound):
+        clone_wishlist(get_uuid())
+    with pytest.raises(UserNotFound):
+        clone_wishlist(wishlist_id, user_id=get_uuid())
+    with pytest.raises(WishlistEntryAlreadyExists):
+        clone_wishlist(wishlist_id, new_wishlist_id=wishlist_id)
+
+
+def test_wishlist_documents_follow_writes(test_client, test_db, materialize):
+    wishlist_id = _create_wishlist()
+    assert get_wishlist_document(wishlist_id) == render_wishlist(list_wishlist_entries(wishlist_id))
+
+    remove_wishlist_entry(wishlist_id, BOOK_1["id"])
+    document = get_wishlist_document(wishlist_id)
+    assert document == render_wishlist(list_wishlist_entries(wishlist_id))
+    assert BOOK_1["id"].encode() not in document
+
+    clone = clone_wishlist(wishlist_id)
+    assert get_wishlist_document(clone["wishlist_id"]) == render_wishlist(
+        list_wishlist_entries(clone["wishlist_id"])
+    )
+
+    remove_wishlist_entries(wishlist_id)
+    with pytest.raises(WishlistNotFound):
+        get_wishlist_document(wishlist_id)
+
+
+def test_wishlist_documents_non_canonical_id(test_client, test_db, materialize):
+    wishlist_id = get_uuid()
+    insert_wishlist_entry(USER_1["id"], BOOK_1["id"], wishlist_id=wishlist_id.upper())
+    insert_wishlist_entry(USER_1["id"], BOOK_2["id"], wishlist_id=wishlist_id.replace("-", ""))
+
+    expected = render_wishlist(list_wishlist_entries(wishlist_id))
+    for spelling in (wishlist_id, wishlist_id.upper()):
+        assert get_wishlist_document(spelling) == expected
+
+
+def test_wishlist_documents_rebuilt_on_book_change(test_client, test_db, materialize):
+    book = Book(
+        title="Dune",
+        isbn="978-0441013593",
+        publication_date=datetime.date(1965, 8, 1),
+        author="Frank Herbert"
+    )
+    test_db.session.add(book)
+    test_db.session.commit()
+    wishlist_id = get_uuid()
+    insert_wishlist_entry(USER_1["id"], book.id, wishlist_id=wishlist_id)
+
+    book.title = "Dune Messiah"
+    test_db.session.commit()
+    background_tasks.join()
+
+    # The document was rebuilt on the background thread, start a new transaction to see it.
+    test_db.session.commit()
+    assert b"Dune Messiah" in get_wishlist_document(wishlist_id)
+
+
+def test_rebuild_wishlist_documents(test_client, test_db, app_config):
+    wishlist_id = _create_wishlist()
+    app_config["WISHLIST_MATERIALIZE"] = True
+    assert rebuild_wishlist_documents(batch_size=2) >= 1
+    assert get_wishlist_document(wishlist_id) == render_wishlist(list_wishlist_entries(wishlist_id))
+
+
+def test_rebuild_wishlist_documents_waits_for_writers(test_client, test_db, app_config):
+    wishlist_id = _create_wishlist()
+    app_config["WISHLIST_MATERIALIZE"] = True
+    # Hold the wishlist's lock like a writer that has not committed yet.
+    with test_db.engine.connect() as conn:
+        transaction = conn.begin()
+        conn.execute(_LOCK_WISHLIST, {"lock_id": wishlist_id})
+        try:
+            test_db.session.execute("SET LOCAL lock_timeout = 200")
+            with pytest.raises(OperationalError, match="lock timeout"):
+                rebuild_wishlist_documents()
+        finally:
+            test_db.session.rollback()
+            transaction.rollback()
+    with pytest.raises(WishlistNotFound):
+        get_wishlist_document(wishlist_id)
+
+
+def _wishlist_counts(test_db) -> dict:
+    """Count wishlists per book the slow way."""
+    res = test_db.session.execute(
+        "SELECT book_id, count(*) FROM wishlists GROUP BY book_id HAVING count(*) > 0"
+    )
+    return {book_id: count for book_id, count in res}
+
+
+def test_popularity_counters_follow_writes(test_client, test_db):
+    wishlist_id = _create_wishlist()
+    clone = clone_wishlist(wishlist_id)
+    remove_wishlist_entry(wishlist_id, BOOK_1["id"])
+    remove_wishlist_entries(clone["wishlist_id"])
+
+    ranked = list_popular_books()
+    assert {book["id"]: book["wishlist_count"] for book in ranked} == _wishlist_counts(test_db)
+    counts = [book["wishlist_count"] for book in ranked]
+    assert counts == sorted(counts, reverse=True)
+    assert list_popular_books(limit=1) == ranked[:1]
+    for key in ("title", "author", "isbn", "publication_date"):
+        assert key in ranked[0]
+
+
+def test_popularity_counters_follow_batches(test_client, test_db):
+    wishlist_id = _create_wishlist(books=(BOOK_1,))
+    results = run_batch([
+        {"op": BATCH_ADD, "wishlist_id": wishlist_id, "user_id": USER_1["id"], "book_id": BOOK_2["id"]},
+        {"op": BATCH_REMOVE, "wishlist_id": wishlist_id, "book_id": BOOK_1["id"]},
+        {"op": BATCH_ADD, "wishlist_id": wishlist_id, "user_id": USER_1["id"], "book_id": BOOK_1["id"]},
+        {"op": BATCH_REMOVE, "wishlist_id": wishlist_id, "book_id": BOOK_2["id"]},
+        {"op": BATCH_ADD, "user_id": USER_1["id"], "book_id": BOOK_2["id"]},
+    ])
+    assert not any(isinstance(result, Exception) for result in results)
+
+    ranked = list_popular_books()
+    assert {book["id"]: book["wishlist_count"] for book in ranked} == _wishlist_counts(test_db)
+
+
+def test_popularity_windows(test_client, test_db):
+    before = {
+        book["id"]: book["wishlist_count"]
+        for book in list_popular_books(window=POPULARITY_WINDOWS["24h"])
+    }
+    _create_wishlist(books=[BOOK_2])
+    after = {
+        book["id"]: book["wishlist_count"]
+        for book in list_popular_books(window=POPULARITY_WINDOWS["24h"])
+    }
+    assert after[uuid.UUID(BOOK_2["id"])] == before.get(uuid.UUID(BOOK_2["id"]), 0) + 1
+
+    # Once buckets age out, nothing is left in the window.
+    prune_popularity_buckets(datetime.timedelta(hours=-1))
+    assert list_popular_books(window=POPULARITY_WINDOWS["24h"]) == []
+
+
+def test_rebuild_popularity(test_client, test_db):
+    _create_wishlist()
+    expected = list_popular_books()
+    test_db.session.execute("UPDATE book_popularity SET wishlist_count = 0")
+    test_db.session.commit()
+    assert list_popular_books() == []
+
+    rebuild_popularity()
+    assert list_popular_books() == expected
+    assert list_popular_books(window=POPULARITY_WINDOWS["7d"])
+
+
+def test_prepared_statements_reused(test_client, test_db, app_config):
+    wishlist_id = _create_wishlist()
+    expected = list_wishlist_entries(wishlist_id)
+    changes = list_wishlist_changes(wishlist_id)
+
+    prepared = test_db.session.connection().connection.info["prepared_statements"]
+    assert "list_wishlist_entries" in prepared
+    # Prepared statements outlive the transaction they were prepared in.
+    test_db.session.rollback()
+    assert list_wishlist_entries(wishlist_id) == expected
+
+    app_config["SQLALCHEMY_PREPARED_STATEMENTS"] = False
+    assert list_wishlist_entries(wishlist_id) == expected
+    assert list_wishlist_changes(wishlist_id) == changes
+
+
+def _ordered_wishlist(test_db, count: int) -> tuple:
+    books = [
+        Book(title=f"Book {i}", isbn=f"978-{i:010d}", publication_date=datetime.date(2000, 1, 1))
+        for i in range(count)
+    ]
+    test_db.session.add_all(books)
+    test_db.session.commit()
+    book_ids = [str(book.id) for book in books]
+    wishlist_id = get_uuid()
+    for book_id in book_ids:
+        insert_wishlist_entry(USER_1["id"], book_id, wishlist_id=wishlist_id)
+    return wishlist_id, book_ids
+
+
+def _book_order(wishlist_id) -> list:
+    return [str(book["id"]) for book in list_wishlist_entries(wishlist_id)["books"]]
+
+
+def _positions(test_db, wishlist_id) -> dict:
+    rows = test_db.session.execute(
+        wishlists.select().where(wishlists.c.wishlist_id == wishlist_id)
+    ).fetchall()
+    return {str(row.book_id): row.position for row in rows}
+
+
+def test_wishlist_entries_ordered(test_client, test_db):
+    wishlist_id, book_ids = _ordered_wishlist(test_db, 4)
+    assert _book_order(wishlist_id) == book_ids
+    assert list(_positions(test_db, wishlist_id).values()) == [
+        POSITION_GAP * i for i in range(1, 5)
+    ]
+
+    before = _positions(test_db, wishlist_id)
+    move_wishlist_entry(wishlist_id, book_ids[3], after_book_id=book_ids[0])
+    after = _positions(test_db, wishlist_id)
+    # Only the moved entry was rewritten.
+    assert [book_id for book_id in before if before[book_id] != after[book_id]] == [book_ids[3]]
+    assert _book_order(wishlist_id) == [book_ids[0], book_ids[3], book_ids[1], book_ids[2]]
+
+    move_wishlist_entry(wishlist_id, book_ids[2])
+    assert _book_order(wishlist_id) == [book_ids[2], book_ids[0], book_ids[3], book_ids[1]]
+
+    move_wishlist_entry(wishlist_id, book_ids[2], after_book_id=book_ids[1])
+    assert _book_order(wishlist_id) == [book_ids[0], book_ids[3], book_ids[1], book_ids[2]]
+
+    clone = clone_wishlist(wishlist_id)
+    assert _book_order(clone["wishlist_id"]) == _book_order(wishlist_id)
+
+
+def test_move_wishlist_entry_rebalances(test_client, test_db):
+    wishlist_id, book_ids = _ordered_wishlist(test_db, 3)
+    # Keep moving the last book to second place, halving the gap after the first book every time.
+    # The eleventh move leaves a gap of 32, which schedules a rebalance.
+    for _ in range(11):
+        order = _book_order(wishlist_id)
+        move_wishlist_entry(wishlist_id, order[2], after_book_id=order[0])
+        assert _book_order(wishlist_id) == [order[0], order[2], order[1]]
+    order = _book_order(wishlist_id)
+
+    background_tasks.join()
+    # The rebalance ran on the background thread, start a new transaction to see it.
+    test_db.session.commit()
+    assert sorted(_positions(test_db, wishlist_id).values()) == [POSITION_GAP * i for i in range(1, 4)]
+    assert _book_order(wishlist_id) == order
+
+
+def test_rebalance_wishlist_positions(test_client, test_db):
+    wishlist_id, book_ids = _ordered_wishlist(test_db, 4)
+    # Squeeze the last three entries up against the first, in reverse order.
+    for offset, book_id in enumerate(reversed(book_ids[1:]), start=1):
+        test_db.session.execute(
+            wishlists.update().
+            where(wishlists.c.wishlist_id == wishlist_id).
+            where(wishlists.c.book_id == book_id).
+            values(position=POSITION_GAP + offset)
+        )
+    test_db.session.commit()
+    order = [book_ids[0]] + book_ids[:0:-1]
+    assert _book_order(wishlist_id) == order
+
+    # The first entry is already in place.
+    assert rebalance_wishlist_positions(wishlist_id) == 3
+    positions = _positions(test_db, wishlist_id)
+    assert [positions[book_id] for book_id in order] == [POSITION_GAP * i for i in range(1, 5)]
+    assert _book_order(wishlist_id) == order
+
+    assert rebalance_wishlist_positions(wishlist_id) == 0
+
+
+def test_move_wishlist_entry_without_room(test_client, test_db):
+    wishlist_id, _ = _ordered_wishlist(test_db, 3)
+    test_db.session.execute(
+        wishlists.update().where(wishlists.c.wishlist_id == wishlist_id).values(position=0)
+    )
+    test_db.session.commit()
+
+    # Every entry shares a position, so they are ordered by book id and the move respaces them first.
+    order = _book_order(wishlist_id)
+    move_wishlist_entry(wishlist_id, order[2], after_book_id=order[0])
+    assert _book_order(wishlist_id) == [order[0], order[2], order[1]]
+    assert len(set(_positions(test_db, wishlist_id).values())) == 3
+
+
+def test_move_wishlist_entry_not_found(test_client, test_db):
+    wishlist_id = _create_wishlist()
+    with pytest.raises(WishlistEntryNotFound):
+        move_wishlist_entry(wishlist_id, get_uuid())
+    with pytest.raises(WishlistEntryNotFound):
+        move_wishlist_entry(wishlist_id, BOOK_1["id"], after_book_id=get_uuid())
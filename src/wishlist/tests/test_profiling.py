@@ -0,0 +1,72 @@
+import pstats
+
+import pytest
+
+from app.profiling import InvalidProfileToken, issue_profile_token, verify_profile_token
+from app.models import get_uuid
+
+
+@pytest.fixture
+def profiling_config(app_config, tmp_path):
+    app_config["PROFILING_DIR"] = str(tmp_path)
+    return app_config
+
+
+def test_unprofiled_requests(test_client, test_db, profiling_config, tmp_path):
+    res = test_client.get(f"/wishlist/{get_uuid()}")
+    assert res.status_code == 404
+    assert "X-Profile-Id" not in res.headers
+    assert not list(tmp_path.iterdir())
+
+
+def test_sampled_profile_saved(test_client, test_db, profiling_config, tmp_path):
+    profiling_config["PROFILING_SAMPLE_RATE"] = 1.0
+    res = test_client.get(f"/wishlist/{get_uuid()}", headers={"X-Request-ID": "req-1"})
+    assert res.status_code == 404
+    assert res.headers["X-Profile-Id"] == "req-1"
+
+    path = tmp_path / "api.get_wishlist.req-1.prof"
+    stats = pstats.Stats(str(path))
+    assert any(func[2] == "get_wishlist" for func in stats.stats)
+
+
+def test_header_profile_inline(test_client, test_db, profiling_config):
+    res = test_client.get(
+        f"/wishlist/{get_uuid()}",
+        headers={
+            "X-Profile": issue_profile_token(),
+            "X-Profile-Output": "inline",
+            # An id that isn't safe in a file name is replaced.
+            "X-Request-ID": "../etc/passwd",
+        }
+    )
+    assert res.status_code == 404
+    assert res.mimetype == "text/plain"
+    request_id = res.headers["X-Profile-Id"]
+    assert "/" not in request_id
+    body = res.get_data(as_text=True)
+    assert body.startswith(f"api.get_wishlist {request_id}\n")
+    assert "get_wishlist" in body
+
+
+@pytest.mark.parametrize(
+    "token",
+    [
+        pytest.param("", id="empty"),
+        pytest.param("fred", id="malformed"),
+        pytest.param("99999999999.deadbeef", id="bad signature"),
+    ]
+)
+def test_invalid_profile_token_ignored(token, test_client, test_db, profiling_config, tmp_path):
+    with pytest.raises(InvalidProfileToken):
+        verify_profile_token(token)
+
+    res = test_client.get(f"/wishlist/{get_uuid()}", headers={"X-Profile": token})
+    assert res.status_code == 404
+    assert "X-Profile-Id" not in res.headers
+    assert not list(tmp_path.iterdir())
+
+
+def test_expired_profile_token(test_client):
+    with pytest.raises(InvalidProfileToken, match="expired"):
+        verify_profile_token(issue_profile_token(ttl=-1))
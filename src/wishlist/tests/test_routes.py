@@ -1,9 +1,17 @@
+import csv
+import json
 from copy import deepcopy
+from datetime import timedelta
 
 import pytest
 
+import app.routes
+from app.auth import issue_token
+from app.cache import popular_books_cache
 from app.models import (
+    _LOCK_WISHLISTS,
     Book,
+    compact_wishlist_changes,
     get_uuid,
     insert_wishlist_entry,
     list_wishlist_entries,
@@ -14,6 +22,10 @@ from app.models import (
 from data import USER_1, BOOK_1, BOOK_2
 
 
+def _auth_headers(user_id) -> dict:
+    return {"Authorization": f"Bearer {issue_token(user_id)}"}
+
+
 def test_healthcheck(test_client):
     res = test_client.get("/")
     assert res.status_code == 200
@@ -118,7 +130,8 @@ def test_create_wishlist_entry_no_wishlist(test_client, test_db):
         json={
             "book_id": BOOK_1["id"],
             "user_id": user.id,
-        }
+        },
+        headers=_auth_headers(user.id)
     )
     assert res.status_code == 201
     new_wishlist_id = res.json["wishlist_id"]
@@ -129,7 +142,8 @@ def test_create_wishlist_entry_no_wishlist(test_client, test_db):
             "book_id": BOOK_2["id"],
             "user_id": user.id,
             "wishlist_id": new_wishlist_id
-        }
+        },
+        headers=_auth_headers(user.id)
     )
     assert res.status_code == 201
 
@@ -138,6 +152,7 @@ def test_create_and_retrieve_wishlist(test_client, test_db):
     user = User(email="joe@schmoe.com", raw_password="superS3cr3t")
     test_db.session.add(user)
     test_db.session.commit()
+    headers = _auth_headers(user.id)
     wishlist_id = get_uuid()
 
     for book in [BOOK_1, BOOK_2]:
@@ -147,11 +162,12 @@ def test_create_and_retrieve_wishlist(test_client, test_db):
                 "book_id": book["id"],
                 "user_id": user.id,
                 "wishlist_id": wishlist_id
-            }
+            },
+            headers=headers
         )
         assert res.status_code == 201
     
-    res = test_client.get(f"/wishlist/{wishlist_id}")
+    res = test_client.get(f"/wishlist/{wishlist_id}", headers=headers)
     assert res.status_code == 200
     assert res.json["wishlist_id"] == wishlist_id
     assert res.json["user_id"] == str(user.id)
@@ -162,6 +178,7 @@ def test_remove_wishlist_entry(test_client, test_db):
     user = User(email="joe@schmoe.com", raw_password="superS3cr3t")
     test_db.session.add(user)
     test_db.session.commit()
+    headers = _auth_headers(user.id)
 
     wishlist_id = get_uuid()
 
@@ -172,11 +189,12 @@ def test_remove_wishlist_entry(test_client, test_db):
                 "book_id": book["id"],
                 "user_id": user.id,
                 "wishlist_id": wishlist_id
-            }
+            },
+            headers=headers
         )
         assert res.status_code == 201
     
-    res_get_1 = test_client.get(f"/wishlist/{wishlist_id}")
+    res_get_1 = test_client.get(f"/wishlist/{wishlist_id}", headers=headers)
     assert res_get_1.status_code == 200
     assert len(res_get_1.json["books"]) == 2
 
@@ -185,10 +203,619 @@ def test_remove_wishlist_entry(test_client, test_db):
         json={
             "book_id": BOOK_1["id"],
             "wishlist_id": wishlist_id
-        }
+        },
+        headers=headers
     )
     assert res_delete.status_code == 200
 
-    res_get_2 = test_client.get(f"/wishlist/{wishlist_id}")
+    res_get_2 = test_client.get(f"/wishlist/{wishlist_id}", headers=headers)
     assert res_get_2.status_code == 200
-    assert len(res_get_2.json["books"]) == 1
\ No newline at end of file
+    assert len(res_get_2.json["books"]) == 1
+
+
+def test_get_wishlist_changes(test_client, test_db):
+    wishlist_id = get_uuid()
+    for book in [BOOK_1, BOOK_2]:
+        res = test_client.post(
+            "/wishlist_entry",
+            json={
+                "book_id": book["id"],
+                "user_id": USER_1["id"],
+                "wishlist_id": wishlist_id
+            }
+        )
+        assert res.status_code == 201
+
+    res = test_client.get(f"/wishlist/{wishlist_id}/changes")
+    assert res.status_code == 200
+    assert [c["book_id"] for c in res.json["changes"]] == [BOOK_1["id"], BOOK_2["id"]]
+    cursor = res.json["cursor"]
+
+    test_client.delete("/wishlist_entry", json={"book_id": BOOK_2["id"], "wishlist_id": wishlist_id})
+
+    res = test_client.get(f"/wishlist/{wishlist_id}/changes?since={cursor}")
+    assert res.status_code == 200
+    assert [(c["op"], c["book_id"]) for c in res.json["changes"]] == [("remove", BOOK_2["id"])]
+    test_db.session.commit()
+
+    compact_wishlist_changes(timedelta(0))
+    res = test_client.get(f"/wishlist/{wishlist_id}/changes?since={cursor}")
+    assert res.status_code == 410
+    assert res.json["cursor"] > cursor
+
+
+def test_emptied_wishlist_changes(test_client, test_db):
+    wishlist_id = _create_wishlist(test_client)
+    cursor = test_client.get(f"/wishlist/{wishlist_id}/changes").json["cursor"]
+    other_user = User(email="other@example.com", raw_password="0therS3cr3t")
+    test_db.session.add(other_user)
+    test_db.session.commit()
+    other_headers = _auth_headers(other_user.id)
+
+    res = test_client.delete(f"/wishlist/{wishlist_id}?all=true")
+    assert res.status_code == 200
+
+    # Other devices still sync the removals that emptied the wishlist, no one else sees them.
+    res = test_client.get(f"/wishlist/{wishlist_id}/changes?since={cursor}")
+    assert res.status_code == 200
+    assert {(c["op"], c["book_id"]) for c in res.json["changes"]} == {
+        ("remove", BOOK_1["id"]), ("remove", BOOK_2["id"])
+    }
+    assert test_client.get(f"/wishlist/{wishlist_id}/changes", headers=other_headers).status_code == 404
+
+    # The owner is kept with the horizon once the whole log has been compacted.
+    latest = res.json["cursor"]
+    test_db.session.commit()
+    compact_wishlist_changes(timedelta(0))
+    res = test_client.get(f"/wishlist/{wishlist_id}/changes?since={latest}")
+    assert res.status_code == 200
+    assert res.json["changes"] == []
+    assert test_client.get(f"/wishlist/{wishlist_id}/changes", headers=other_headers).status_code == 404
+
+
+@pytest.mark.parametrize(
+    "query,exp_msg_fragment",
+    [
+        pytest.param("since=-1", "since must be an integer between 0 and", id="negative cursor"),
+        pytest.param("since=fred", "since must be an integer between 0 and", id="invalid cursor"),
+        pytest.param("since=%C2%B2", "since must be an integer between 0 and", id="superscript cursor"),
+        pytest.param(f"since={2 ** 63}", "since must be an integer between 0 and", id="cursor beyond bigint"),
+        pytest.param("limit=0", "limit must be an integer between", id="limit too small"),
+        pytest.param("limit=100000", "limit must be an integer between", id="limit too large"),
+        pytest.param(f"limit={2 ** 63}", "limit must be an integer between", id="limit beyond bigint"),
+    ]
+)
+def test_get_wishlist_changes_raises_400(query, exp_msg_fragment, test_client):
+    res = test_client.get(f"/wishlist/{get_uuid()}/changes?{query}")
+    assert res.status_code == 400
+    assert exp_msg_fragment in str(res.data)
+
+
+def _create_export_user(test_db) -> User:
+    user = User(email="exporter@example.com", raw_password="supers3cr3t")
+    test_db.session.add(user)
+    test_db.session.commit()
+    for _ in range(2):
+        wishlist_id = get_uuid()
+        for book in [BOOK_1, BOOK_2]:
+            insert_wishlist_entry(user.id, book["id"], wishlist_id=wishlist_id)
+    return user
+
+
+def test_export_ndjson(test_client, test_db):
+    user = _create_export_user(test_db)
+
+    headers = _auth_headers(user.id)
+    res = test_client.get("/export", headers=headers)
+    assert res.status_code == 200
+    assert res.mimetype == "application/x-ndjson"
+    records = [json.loads(line) for line in res.data.decode().splitlines()]
+    assert len(records) == 4
+    assert {record["user_id"] for record in records} == {str(user.id)}
+    assert records[0]["publication_date"] in (
+        BOOK_1["publication_date"].isoformat(), BOOK_2["publication_date"].isoformat()
+    )
+
+    last = records[1]
+    checkpoint = f"{last['wishlist_id']},{last['user_id']},{last['book_id']}"
+    res = test_client.get(f"/export?user_id={user.id}&after={checkpoint}", headers=headers)
+    assert [json.loads(line) for line in res.data.decode().splitlines()] == records[2:]
+
+
+def test_export_csv(test_client, test_db):
+    user = _create_export_user(test_db)
+
+    headers = _auth_headers(user.id)
+    res = test_client.get("/export?format=csv", headers=headers)
+    assert res.status_code == 200
+    assert res.mimetype == "text/csv"
+    rows = list(csv.DictReader(res.data.decode().splitlines()))
+    assert len(rows) == 4
+    assert rows[0]["isbn"] in (BOOK_1["isbn"], BOOK_2["isbn"])
+
+    # Resumed CSV exports leave out the header.
+    last = rows[-2]
+    checkpoint = f"{last['wishlist_id']},{last['user_id']},{last['book_id']}"
+    res = test_client.get(f"/export?format=csv&after={checkpoint}", headers=headers)
+    assert list(csv.reader(res.data.decode().splitlines())) == [list(rows[-1].values())]
+
+
+@pytest.mark.parametrize(
+    "query,exp_msg_fragment",
+    [
+        pytest.param("user_id=fred", "must be valid UUID", id="invalid user_id"),
+        pytest.param("format=xml", "format must be one of", id="invalid format"),
+        pytest.param("after=fred", "invalid value for after", id="invalid checkpoint"),
+    ]
+)
+def test_export_raises_400(query, exp_msg_fragment, test_client):
+    res = test_client.get(f"/export?{query}")
+    assert res.status_code == 400
+    assert exp_msg_fragment in str(res.data)
+
+
+def _create_wishlist(test_client) -> str:
+    wishlist_id = get_uuid()
+    for book in [BOOK_1, BOOK_2]:
+        res = test_client.post(
+            "/wishlist_entry",
+            json={
+                "book_id": book["id"],
+                "user_id": USER_1["id"],
+                "wishlist_id": wishlist_id
+            }
+        )
+        assert res.status_code == 201
+    return wishlist_id
+
+
+def test_remove_nonexistent_wishlist_entry_raises_404(test_client, test_db):
+    res = test_client.delete(
+        "/wishlist_entry",
+        json={"book_id": BOOK_1["id"], "wishlist_id": get_uuid()}
+    )
+    assert res.status_code == 404
+
+
+def test_clone_wishlist(test_client, test_db):
+    wishlist_id = _create_wishlist(test_client)
+
+    res = test_client.post(f"/wishlist/{wishlist_id}/clone")
+    assert res.status_code == 201
+    assert res.json["copied"] == 2
+    clone_id = res.json["wishlist_id"]
+    assert res.headers["Location"].endswith(f"/wishlist/{clone_id}")
+
+    res = test_client.get(f"/wishlist/{clone_id}")
+    assert res.status_code == 200
+    assert len(res.json["books"]) == 2
+
+    new_id = get_uuid()
+    res = test_client.post(f"/wishlist/{wishlist_id}/clone", json={"wishlist_id": new_id})
+    assert res.status_code == 201
+    assert res.json["wishlist_id"] == new_id
+
+
+@pytest.mark.parametrize(
+    "payload,exp_status",
+    [
+        pytest.param({"user_id": "fred"}, 400, id="invalid user_id"),
+        pytest.param({"user_id": get_uuid()}, 403, id="another user"),
+    ]
+)
+def test_clone_wishlist_raises(payload, exp_status, test_client, test_db):
+    wishlist_id = _create_wishlist(test_client)
+    res = test_client.post(f"/wishlist/{wishlist_id}/clone", json=payload)
+    assert res.status_code == exp_status
+
+
+def test_clone_wishlist_raises_404(test_client, test_db):
+    res = test_client.post(f"/wishlist/{get_uuid()}/clone")
+    assert res.status_code == 404
+
+
+def test_delete_wishlist_books(test_client, test_db):
+    wishlist_id = _create_wishlist(test_client)
+
+    res = test_client.delete(
+        f"/wishlist/{wishlist_id}",
+        json={"book_ids": [BOOK_1["id"], get_uuid()]}
+    )
+    assert res.status_code == 200
+    assert res.json["removed"] == 1
+    assert len(test_client.get(f"/wishlist/{wishlist_id}").json["books"]) == 1
+
+    res = test_client.delete(f"/wishlist/{wishlist_id}", json={"book_ids": [BOOK_1["id"]]})
+    assert res.status_code == 404
+
+
+def test_delete_wishlist(test_client, test_db):
+    wishlist_id = _create_wishlist(test_client)
+
+    res = test_client.delete(f"/wishlist/{wishlist_id}?all=true")
+    assert res.status_code == 200
+    assert res.json["removed"] == 2
+    assert test_client.get(f"/wishlist/{wishlist_id}").status_code == 404
+
+    res = test_client.delete(f"/wishlist/{wishlist_id}?all=true")
+    assert res.status_code == 404
+
+
+@pytest.mark.parametrize(
+    "payload,exp_msg_fragment",
+    [
+        pytest.param({"book_ids": []}, "non-empty list", id="empty book_ids"),
+        pytest.param({"book_ids": "fred"}, "non-empty list", id="book_ids not a list"),
+        pytest.param({"book_ids": ["fred"]}, "must be valid UUID", id="invalid book_id"),
+    ]
+)
+def test_delete_wishlist_raises_400(payload, exp_msg_fragment, test_client):
+    res = test_client.delete(f"/wishlist/{get_uuid()}", json=payload)
+    assert res.status_code == 400
+    assert exp_msg_fragment in str(res.data)
+
+
+@pytest.mark.parametrize(
+    "query,kwargs,exp_msg_fragment",
+    [
+        pytest.param("", {}, "either book_ids or all=true", id="no body"),
+        pytest.param("?all=yes", {}, "value for all must be true", id="invalid all"),
+        pytest.param(
+            "?all=true", {"json": {"book_ids": [BOOK_1["id"]]}}, "but not both", id="book_ids and all"
+        ),
+        pytest.param(
+            "",
+            {"data": json.dumps({"book_ids": [BOOK_1["id"]]}), "content_type": "text/plain"},
+            "must be a JSON object",
+            id="not sent as JSON"
+        ),
+        pytest.param(
+            "", {"json": {"book_id": [BOOK_1["id"]]}}, "unknown keys: ['book_id']", id="misspelled key"
+        ),
+        pytest.param(
+            "",
+            {"data": '{"book_ids": ["', "content_type": "application/json"},
+            "must be a JSON object",
+            id="truncated JSON"
+        ),
+    ]
+)
+def test_delete_wishlist_never_falls_back_to_all(query, kwargs, exp_msg_fragment, test_client, test_db):
+    wishlist_id = _create_wishlist(test_client)
+    res = test_client.delete(f"/wishlist/{wishlist_id}{query}", **kwargs)
+    assert res.status_code == 400
+    assert exp_msg_fragment in str(res.data)
+    assert len(test_client.get(f"/wishlist/{wishlist_id}").json["books"]) == 2
+
+
+def test_get_materialized_wishlist(test_client, test_db, materialize, monkeypatch):
+    wishlist_id = _create_wishlist(test_client)
+    expected = test_client.get(f"/wishlist/{wishlist_id}").json
+
+    def fail(wishlist_id, owner_id=None):
+        raise AssertionError("wishlist was queried")
+
+    monkeypatch.setattr(app.routes, "list_wishlist_entries", fail)
+    res = test_client.get(f"/wishlist/{wishlist_id}")
+    assert res.status_code == 200
+    assert res.json == expected
+    assert test_client.get(f"/wishlist/{get_uuid()}").status_code == 404
+
+
+def test_get_popular_books(test_client, test_db):
+    popular_books_cache.clear()
+    _create_wishlist(test_client)
+
+    res = test_client.get("/books/popular?window=7d&limit=1")
+    assert res.status_code == 200
+    assert res.json["window"] == "7d"
+    assert len(res.json["books"]) == 1
+    top_count = res.json["books"][0]["wishlist_count"]
+
+    # The ranking is served from memory until it expires.
+    _create_wishlist(test_client)
+    res = test_client.get("/books/popular?window=7d&limit=1")
+    assert res.json["books"][0]["wishlist_count"] == top_count
+
+    popular_books_cache.clear()
+    res = test_client.get("/books/popular?window=7d&limit=1")
+    assert res.json["books"][0]["wishlist_count"] == top_count + 1
+
+    res = test_client.get("/books/popular")
+    assert res.status_code == 200
+    assert len(res.json["books"]) == 2
+
+
+@pytest.mark.parametrize(
+    "query,exp_msg_fragment",
+    [
+        pytest.param("window=1y", "window must be one of", id="invalid window"),
+        pytest.param("limit=0", "limit must be an integer between", id="limit too small"),
+        pytest.param("limit=fred", "limit must be an integer between", id="invalid limit"),
+    ]
+)
+def test_get_popular_books_raises_400(query, exp_msg_fragment, test_client):
+    res = test_client.get(f"/books/popular?{query}")
+    assert res.status_code == 400
+    assert exp_msg_fragment in str(res.data)
+
+
+def test_route_query_budgets(test_client, test_db, query_budget):
+    # Every request below fails if its route goes over the budget declared with `@query_budget`.
+    wishlist_id = _create_wishlist(test_client)
+    requests = [
+        ("GET", "/", None),
+        ("POST", "/login", {"email": USER_1["email"], "password": USER_1["raw_password"]}),
+        ("GET", f"/wishlist/{wishlist_id}", None),
+        ("GET", f"/wishlist/{wishlist_id}/changes", None),
+        ("GET", "/books/popular", None),
+        ("POST", f"/wishlist/{wishlist_id}/clone", None),
+        ("POST", f"/wishlist/{wishlist_id}/move", {"book_id": BOOK_2["id"]}),
+        ("DELETE", "/wishlist_entry", {"wishlist_id": wishlist_id, "book_id": BOOK_1["id"]}),
+        ("DELETE", f"/wishlist/{wishlist_id}?all=true", None),
+    ]
+    for method, path, payload in requests:
+        res = test_client.open(path, method=method, json=payload)
+        assert res.status_code < 400
+
+    res = test_client.get("/export")
+    assert res.status_code == 200
+    res.close()
+
+    for report in query_budget:
+        assert not report.over_budget, report.endpoint
+        assert not report.repeated(1), report.endpoint
+    assert [report.endpoint for report in query_budget][-1] == "api.export_wishlists"
+
+
+def test_route_over_query_budget(test_client, test_db, query_budget, app_config, monkeypatch):
+    monkeypatch.setattr(app.routes.get_popular_books, "query_budget", 0)
+    popular_books_cache.clear()
+    res = test_client.get("/books/popular")
+    assert res.status_code == 500
+    assert query_budget[-1].over_budget
+
+    # Once the ranking is cached the route doesn't touch the database at all.
+    app_config["QUERY_BUDGET_RAISE"] = False
+    test_client.get("/books/popular")
+    app_config["QUERY_BUDGET_RAISE"] = True
+    res = test_client.get("/books/popular")
+    assert res.status_code == 200
+    assert query_budget[-1].count == 0
+
+
+def test_move_wishlist_entry(test_client, test_db):
+    wishlist_id = _create_wishlist(test_client)
+    res = test_client.get(f"/wishlist/{wishlist_id}")
+    assert [book["id"] for book in res.json["books"]] == [BOOK_1["id"], BOOK_2["id"]]
+
+    res = test_client.post(f"/wishlist/{wishlist_id}/move", json={"book_id": BOOK_2["id"]})
+    assert res.status_code == 200
+    assert res.json["book_id"] == BOOK_2["id"]
+
+    res = test_client.get(f"/wishlist/{wishlist_id}")
+    assert [book["id"] for book in res.json["books"]] == [BOOK_2["id"], BOOK_1["id"]]
+
+    res = test_client.post(
+        f"/wishlist/{wishlist_id}/move",
+        json={"book_id": BOOK_2["id"], "after_book_id": BOOK_1["id"]}
+    )
+    assert res.status_code == 200
+    res = test_client.get(f"/wishlist/{wishlist_id}")
+    assert [book["id"] for book in res.json["books"]] == [BOOK_1["id"], BOOK_2["id"]]
+
+
+@pytest.mark.parametrize(
+    "payload,exp_status",
+    [
+        pytest.param({}, 400, id="missing book_id"),
+        pytest.param({"book_id": "fred"}, 400, id="invalid book_id"),
+        pytest.param({"book_id": BOOK_1["id"], "after_book_id": BOOK_1["id"]}, 400, id="after itself"),
+        pytest.param({"book_id": get_uuid()}, 404, id="book not on wishlist"),
+        pytest.param({"book_id": BOOK_1["id"], "after_book_id": get_uuid()}, 404, id="unknown anchor"),
+    ]
+)
+def test_move_wishlist_entry_raises(payload, exp_status, test_client, test_db):
+    wishlist_id = _create_wishlist(test_client)
+    res = test_client.post(f"/wishlist/{wishlist_id}/move", json=payload)
+    assert res.status_code == exp_status
+
+
+def test_batch(test_client, test_db):
+    wishlist_id = _create_wishlist(test_client)
+    new_wishlist_id = get_uuid()
+    res = test_client.post(
+        "/batch",
+        json={
+            "operations": [
+                {"op": "remove", "wishlist_id": wishlist_id, "book_id": BOOK_1["id"]},
+                {"op": "add", "wishlist_id": new_wishlist_id, "user_id": USER_1["id"], "book_id": BOOK_1["id"]},
+                {"op": "add", "wishlist_id": new_wishlist_id, "user_id": USER_1["id"], "book_id": BOOK_2["id"]},
+                {"op": "get", "wishlist_id": new_wishlist_id},
+                {"op": "get", "wishlist_id": wishlist_id},
+                {"op": "remove", "wishlist_id": wishlist_id, "book_id": BOOK_2["id"]},
+            ]
+        }
+    )
+    assert res.status_code == 200
+    assert res.json["committed"] is True
+    results = res.json["results"]
+    assert [result["status"] for result in results] == ["ok"] * 6
+    assert results[1]["result"]["wishlist_id"] == new_wishlist_id
+    # Gets see the batch's earlier writes, in order.
+    assert [book["id"] for book in results[3]["result"]["books"]] == [BOOK_1["id"], BOOK_2["id"]]
+    assert [book["id"] for book in results[4]["result"]["books"]] == [BOOK_2["id"]]
+
+    assert test_client.get(f"/wishlist/{wishlist_id}").status_code == 404
+    res = test_client.get(f"/wishlist/{new_wishlist_id}")
+    assert [book["id"] for book in res.json["books"]] == [BOOK_1["id"], BOOK_2["id"]]
+
+
+def test_batch_atomic_rolls_back(test_client, test_db):
+    wishlist_id = _create_wishlist(test_client)
+    new_wishlist_id = get_uuid()
+    res = test_client.post(
+        "/batch",
+        json={
+            "operations": [
+                {"op": "remove", "wishlist_id": wishlist_id, "book_id": BOOK_1["id"]},
+                {"op": "add", "wishlist_id": new_wishlist_id, "user_id": USER_1["id"], "book_id": BOOK_1["id"]},
+                {"op": "add", "wishlist_id": new_wishlist_id, "user_id": USER_1["id"], "book_id": get_uuid()},
+                {"op": "get", "wishlist_id": new_wishlist_id},
+            ]
+        }
+    )
+    assert res.status_code == 400
+    assert res.json["committed"] is False
+    assert res.json["failed_operation"] == 2
+    assert "Could not find book" in res.json["error"]
+
+    res = test_client.get(f"/wishlist/{wishlist_id}")
+    assert len(res.json["books"]) == 2
+    assert test_client.get(f"/wishlist/{new_wishlist_id}").status_code == 404
+
+
+def test_batch_best_effort(test_client, test_db):
+    wishlist_id = _create_wishlist(test_client)
+    res = test_client.post(
+        "/batch",
+        json={
+            "mode": "best_effort",
+            "operations": [
+                {"op": "add", "wishlist_id": wishlist_id, "user_id": USER_1["id"], "book_id": BOOK_1["id"]},
+                {"op": "add", "user_id": USER_1["id"], "book_id": BOOK_1["id"]},
+                {"op": "remove", "wishlist_id": wishlist_id, "book_id": BOOK_2["id"]},
+                {"op": "remove", "wishlist_id": wishlist_id, "book_id": BOOK_2["id"]},
+                {"op": "get", "wishlist_id": get_uuid()},
+            ]
+        }
+    )
+    assert res.status_code == 200
+    assert res.json["committed"] is True
+    results = res.json["results"]
+    assert [result["status"] for result in results] == ["error", "ok", "ok", "error", "error"]
+    assert [result.get("code") for result in results] == [409, None, None, 404, 404]
+
+    res = test_client.get(f"/wishlist/{results[1]['result']['wishlist_id']}")
+    assert res.status_code == 200
+    res = test_client.get(f"/wishlist/{wishlist_id}")
+    assert [book["id"] for book in res.json["books"]] == [BOOK_1["id"]]
+
+
+@pytest.mark.parametrize("mode", ["atomic", "best_effort"])
+def test_batch_non_canonical_ids(mode, test_client, test_db):
+    wishlist_id = _create_wishlist(test_client)
+    res = test_client.post(
+        "/batch",
+        json={
+            "mode": mode,
+            "operations": [
+                {"op": "remove", "wishlist_id": wishlist_id.upper(), "book_id": BOOK_1["id"].upper()},
+                {"op": "get", "wishlist_id": wishlist_id.replace("-", "")},
+            ]
+        }
+    )
+    assert res.status_code == 200
+    assert res.json["committed"] is True
+    results = res.json["results"]
+    assert [result["status"] for result in results] == ["ok", "ok"]
+    assert results[0]["result"] == {"wishlist_id": wishlist_id, "book_id": BOOK_1["id"]}
+    assert [book["id"] for book in results[1]["result"]["books"]] == [BOOK_2["id"]]
+
+    res = test_client.get(f"/wishlist/{wishlist_id}")
+    assert [book["id"] for book in res.json["books"]] == [BOOK_2["id"]]
+
+
+@pytest.mark.parametrize(
+    "payload,exp_msg_fragment",
+    [
+        pytest.param({}, "operations must be a list", id="missing operations"),
+        pytest.param({"operations": []}, "operations must be a list", id="no operations"),
+        pytest.param(
+            {"operations": [{"op": "get", "wishlist_id": get_uuid()}], "mode": "fred"},
+            "mode must be one of",
+            id="invalid mode"
+        ),
+        pytest.param({"operations": [{"op": "fred"}]}, "operations[0]: value for op", id="invalid op"),
+        pytest.param(
+            {"operations": [{"op": "get", "wishlist_id": get_uuid()}, {"op": "remove", "book_id": BOOK_1["id"]}]},
+            "operations[1]: missing required key wishlist_id",
+            id="missing key"
+        ),
+        pytest.param(
+            {"operations": [{"op": "add", "book_id": "fred", "user_id": USER_1["id"]}]},
+            "operations[0]: value for book_id must be valid UUID",
+            id="invalid uuid"
+        ),
+    ]
+)
+def test_batch_raises_400(payload, exp_msg_fragment, test_client):
+    res = test_client.post("/batch", json=payload)
+    assert res.status_code == 400
+    assert exp_msg_fragment in res.get_data(as_text=True)
+
+
+def test_writers_lock_wishlist_first(test_client, test_db, query_budget):
+    wishlist_id = _create_wishlist(test_client)
+    requests = [
+        ("POST", f"/wishlist/{wishlist_id}/clone", None),
+        ("DELETE", "/wishlist_entry", {"wishlist_id": wishlist_id, "book_id": BOOK_1["id"]}),
+        ("DELETE", f"/wishlist/{wishlist_id}?all=true", None),
+    ]
+    for method, path, payload in requests:
+        res = test_client.open(path, method=method, json=payload)
+        assert res.status_code < 400
+
+    # The same order as `/batch`, so that no two writers can deadlock on the same wishlist.
+    for report in query_budget:
+        assert "pg_advisory_xact_lock" in report.statements[0], report.endpoint
+
+
+def test_writers_lock_any_spelling_of_an_id(test_client, test_db):
+    wishlist_id = _create_wishlist(test_client)
+    spellings = [wishlist_id.upper(), wishlist_id.replace("-", "")]
+    requests = [
+        ("DELETE", "/wishlist_entry", {"wishlist_id": spellings[0], "book_id": BOOK_1["id"]}),
+        (
+            "POST",
+            "/wishlist_entry",
+            {"wishlist_id": spellings[1], "book_id": BOOK_1["id"], "user_id": USER_1["id"]}
+        ),
+        ("POST", f"/wishlist/{spellings[1]}/move", {"book_id": BOOK_1["id"]}),
+        ("DELETE", f"/wishlist/{spellings[0]}?all=true", None),
+    ]
+
+    # Hold the lock `/batch` takes for the wishlist, every single write has to wait for it.
+    with test_db.engine.connect() as conn:
+        transaction = conn.begin()
+        conn.execute(_LOCK_WISHLISTS, {"wishlist_ids": [wishlist_id]})
+        try:
+            for method, path, payload in requests:
+                res = test_client.open(
+                    path, method=method, json=payload, headers={"X-Request-Timeout-Ms": "200"}
+                )
+                assert res.status_code == 504, path
+        finally:
+            transaction.rollback()
+
+    for method, path, payload in requests:
+        res = test_client.open(path, method=method, json=payload)
+        assert res.status_code < 400, path
+
+
+def test_batch_groups_statements(test_client, test_db, query_budget):
+    wishlist_ids = [get_uuid(), get_uuid()]
+    operations = [
+        {"op": "add", "wishlist_id": wishlist_id, "user_id": USER_1["id"], "book_id": book["id"]}
+        for wishlist_id in wishlist_ids for book in (BOOK_1, BOOK_2)
+    ]
+    operations += [{"op": "get", "wishlist_id": wishlist_id} for wishlist_id in wishlist_ids]
+    res = test_client.post("/batch", json={"operations": operations})
+    assert res.status_code == 200
+
+    # Locks, one savepointed insert for the four adds, one select for both gets and the popularity
+    # counters of the whole batch, updated last.
+    statements = query_budget[-1].statements
+    assert len(statements) == 6
+    assert sum("INSERT INTO wishlists" in statement for statement in statements) == 1
+    assert [i for i, statement in enumerate(statements) if "book_popularity" in statement] == [5]